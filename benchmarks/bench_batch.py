@@ -0,0 +1,85 @@
+"""Benchmark the batch write API against one form post per entry.
+
+For batches of growing size, times creating that many entries with
+``POST /journal/new-entry`` one at a time and with a single
+``POST /api/entries/batch``, then does the same for edits to existing
+entries (``/journal/{id}/edit-entry`` against a batch of updates).
+
+Run with ``python benchmarks/bench_batch.py [batch sizes ...]``.
+"""
+
+
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from harness import (  # noqa: E402
+    PASSWORD, USERNAME, build_app, drop_tables, make_entries,
+)
+
+BATCH_SIZES = (10, 100, 500)
+ENTRY_COUNT = 2000
+
+
+def author(app):
+    from webtest import TestApp
+    client = TestApp(app)
+    client.post('/login', {'username': USERNAME, 'password': PASSWORD},
+                status=302)
+    return client
+
+
+def timed(func):
+    started = time.time()
+    func()
+    return time.time() - started
+
+
+def main(argv=sys.argv):
+    sizes = [int(arg) for arg in argv[1:]] or BATCH_SIZES
+    directory = tempfile.mkdtemp()
+    url = 'sqlite:///{}'.format(os.path.join(directory, 'batch.sqlite'))
+    app = build_app(url, ENTRY_COUNT)
+    client = author(app)
+    print('{:>6} {:<7} {:>12} {:>12} {:>9}'.format(
+        'items', 'action', 'single ms', 'batch ms', 'speedup'))
+    try:
+        for size in sizes:
+            rows = [{'title': row['title'], 'body': row['body']}
+                    for row in make_entries(size, seed=size)]
+            ids = list(range(1, size + 1))
+
+            def create_singly():
+                for row in rows:
+                    client.post('/journal/new-entry', row, status=302)
+
+            def create_batch():
+                client.post_json('/api/entries/batch', rows)
+
+            def update_singly():
+                for entry_id, row in zip(ids, rows):
+                    client.post('/journal/{}/edit-entry'.format(entry_id),
+                                row, status=302)
+
+            def update_batch():
+                client.post_json('/api/entries/batch', [
+                    dict(row, id=entry_id) for entry_id, row in zip(ids, rows)
+                ])
+
+            for action, single, batch in (
+                    ('create', create_singly, create_batch),
+                    ('update', update_singly, update_batch)):
+                single_seconds = timed(single)
+                batch_seconds = timed(batch)
+                print('{:>6} {:<7} {:>12.1f} {:>12.1f} {:>8.1f}x'.format(
+                    size, action, single_seconds * 1000,
+                    batch_seconds * 1000, single_seconds / batch_seconds))
+    finally:
+        drop_tables(app)
+
+
+if __name__ == '__main__':
+    main()
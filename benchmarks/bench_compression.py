@@ -0,0 +1,73 @@
+"""Benchmark response compression: bytes on the wire against CPU spent.
+
+Seeds a journal, then serves the same pages with compression off and at
+several gzip levels (and brotli qualities, if brotli is installed),
+reporting the average response size and the process CPU time per
+request for each.
+
+Run with ``python benchmarks/bench_compression.py [entries]``.
+"""
+
+
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from harness import build_app, drop_tables  # noqa: E402
+
+PATHS = ('/', '/journal/1', '/search?q=journal')
+REQUESTS = 200
+SETTINGS = [
+    ('off', {'compression.enabled': 'false'}, None),
+    ('gzip 1', {'compression.level': '1'}, 'gzip'),
+    ('gzip 6', {'compression.level': '6'}, 'gzip'),
+    ('gzip 9', {'compression.level': '9'}, 'gzip'),
+    ('br 4', {'compression.brotli_quality': '4'}, 'br'),
+    ('br 9', {'compression.brotli_quality': '9'}, 'br'),
+]
+
+
+def run(app, path, encoding):
+    """Average bytes sent and CPU milliseconds for ``REQUESTS`` hits."""
+    from webob import Request
+    headers = {'Accept-Encoding': encoding} if encoding else {}
+    sent = 0
+    cpu_started = time.process_time()
+    for _ in range(REQUESTS):
+        response = Request.blank(path, headers=headers).get_response(app)
+        sent += len(response.body)
+    cpu = time.process_time() - cpu_started
+    return sent / REQUESTS, cpu * 1000 / REQUESTS
+
+
+def main(argv=sys.argv):
+    from learning_journal.compression import brotli
+    entries = int(argv[1]) if len(argv) > 1 else 200
+    directory = tempfile.mkdtemp()
+    url = 'sqlite:///{}'.format(os.path.join(directory, 'bench.sqlite'))
+    print('{:<8} {:<20} {:>10} {:>10} {:>12}'.format(
+        'setting', 'path', 'bytes', 'ratio', 'cpu ms/req'))
+    baseline = {}
+    for name, settings, encoding in SETTINGS:
+        if encoding == 'br' and brotli is None:
+            continue
+        settings = dict(settings)
+        settings.setdefault('compression.enabled', 'true')
+        app = build_app(url, entries, **settings)
+        try:
+            for path in PATHS:
+                size, cpu = run(app, path, encoding)
+                baseline.setdefault(path, size)
+                print('{:<8} {:<20} {:>10.0f} {:>10.2f} {:>12.3f}'.format(
+                    name, path, size, size / baseline[path], cpu))
+        finally:
+            drop_tables(app)
+    if brotli is None:
+        print('(brotli is not installed: brotli settings skipped)')
+
+
+if __name__ == '__main__':
+    main()
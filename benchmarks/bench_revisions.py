@@ -0,0 +1,107 @@
+"""Benchmark revision storage: delta chains against full copies.
+
+Applies a series of small random edits to a long entry and stores every
+version with several snapshot intervals (an interval of 1 stores a full
+copy each time), then reports the bytes stored and the time to rebuild
+a version, which grows with the interval, not with the history length.
+
+Run with ``python benchmarks/bench_revisions.py [edits]``.
+"""
+
+
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from harness import percentile  # noqa: E402
+
+INTERVALS = (1, 5, 10, 25, 50)
+REBUILDS = 200
+
+
+def edit(body, rng, words):
+    """Replace, insert or delete a few words somewhere in ``body``."""
+    tokens = body.split(' ')
+    at = rng.randrange(len(tokens))
+    action = rng.random()
+    if action < 0.5:
+        tokens[at] = rng.choice(words)
+    elif action < 0.8:
+        tokens[at:at] = rng.sample(words, 5)
+    else:
+        del tokens[at:at + 3]
+    return ' '.join(tokens)
+
+
+def versions(count, seed=1):
+    rng = random.Random(seed)
+    words = [
+        ''.join(rng.choice('abcdefghijklmnopqrstuvwxyz')
+                for _ in range(rng.randint(2, 9)))
+        for _ in range(2000)
+    ]
+    # Word frequencies fall off like natural text's.
+    body = ' '.join(words[int(rng.paretovariate(1.2)) % len(words)]
+                    for _ in range(1500))
+    bodies = [body]
+    for _ in range(count - 1):
+        body = edit(body, rng, words)
+        bodies.append(body)
+    return bodies
+
+
+def main(argv=sys.argv):
+    from sqlalchemy import create_engine, func
+    from sqlalchemy.orm import sessionmaker
+    from learning_journal.models import Entry, EntryRevision
+    from learning_journal.models.meta import Base
+    from learning_journal.revisions import add_revision, reconstruct
+
+    edits = int(argv[1]) if len(argv) > 1 else 500
+    bodies = versions(edits)
+    directory = tempfile.mkdtemp()
+    engine = create_engine('sqlite:///{}'.format(
+        os.path.join(directory, 'revisions.sqlite')))
+    Base.metadata.create_all(engine)
+    dbsession = sessionmaker(bind=engine)()
+    rng = random.Random(2)
+    print('{} versions of a {}-word entry'.format(
+        edits, len(bodies[0].split())))
+    print('{:>9} {:>14} {:>8} {:>14} {:>14}'.format(
+        'interval', 'bytes stored', 'ratio', 'rebuild p50 ms',
+        'rebuild p99 ms'))
+    full = None
+    for interval in INTERVALS:
+        entry = Entry(title='Benchmark', body=bodies[-1])
+        dbsession.add(entry)
+        dbsession.flush()
+        previous = None
+        for number, body in enumerate(bodies, 1):
+            add_revision(dbsession, entry.id, 'Benchmark', body, previous,
+                         number=number, interval=interval)
+            previous = body
+        dbsession.commit()
+        stored = dbsession.query(
+            func.sum(func.length(EntryRevision.content))
+        ).filter(EntryRevision.entry_id == entry.id).scalar()
+        full = full or stored
+        samples = []
+        for _ in range(REBUILDS):
+            number = rng.randint(1, edits)
+            started = time.time()
+            revision, body = reconstruct(dbsession, entry.id, number)
+            samples.append((time.time() - started) * 1000)
+            assert body == bodies[number - 1]
+            dbsession.expunge_all()
+        samples.sort()
+        print('{:>9} {:>14} {:>8.3f} {:>14.3f} {:>14.3f}'.format(
+            interval, stored, float(stored) / full,
+            percentile(samples, 0.5), percentile(samples, 0.99)))
+
+
+if __name__ == '__main__':
+    main()
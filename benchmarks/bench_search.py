@@ -0,0 +1,108 @@
+"""Benchmark the in-process search index against a linear scan.
+
+Builds journals of growing size from a synthetic, Zipf-distributed
+vocabulary. Each query term is also planted in the same fixed number of
+entries at every size and appears nowhere else, so a query's posting
+lists stay the same length however big the journal gets. The same
+two-term queries are timed against the inverted index and against
+scanning every entry, the way a LIKE query would. Both are measured in
+full at every size; the scan takes minutes at a million.
+
+Common words are timed too: their posting lists grow with the journal,
+and so does the time to walk and score every match.
+
+Exits non-zero if rare-term queries at the largest size take more than
+``FLAT_LIMIT`` times as long as at the smallest.
+
+Run with ``python benchmarks/bench_search.py [max_entries]``.
+"""
+
+
+import random
+import sys
+import timeit
+
+from learning_journal.search import InvertedIndex, tokenize
+
+VOCABULARY = ['term{}'.format(i) for i in range(20000)]
+WEIGHTS = [1.0 / (rank + 1) for rank in range(len(VOCABULARY))]
+WORDS_PER_ENTRY = 150
+# Each pair shares PLANTED_BOTH entries and has PLANTED_ONE more per term.
+QUERIES = ['rare0 rare1', 'rare2 rare3', 'rare4 rare5']
+PLANTED_BOTH = 20
+PLANTED_ONE = 20
+COMMON_QUERIES = ['term40 term900', 'term150 term3000', 'term7 term12000']
+FLAT_LIMIT = 3.0
+
+
+def planted_terms(count, rng):
+    """``{position: [term, ...]}`` placing every query term a fixed number
+    of times."""
+    pairs = [query.split() for query in QUERIES]
+    positions = rng.sample(
+        range(count), len(pairs) * (PLANTED_BOTH + 2 * PLANTED_ONE))
+    planted = {}
+    for first, second in pairs:
+        for terms, times in (([first, second], PLANTED_BOTH),
+                             ([first], PLANTED_ONE), ([second], PLANTED_ONE)):
+            for _ in range(times):
+                planted[positions.pop()] = terms
+    return planted
+
+
+def make_entries(count, seed=401):
+    rng = random.Random(seed)
+    planted = planted_terms(count, rng)
+    for position in range(count):
+        words = rng.choices(VOCABULARY, WEIGHTS, k=WORDS_PER_ENTRY)
+        words.extend(planted.get(position, ()))
+        yield position + 1, ' '.join(words[:4]), ' '.join(words[4:])
+
+
+def linear_scan(entries, query):
+    terms = set(tokenize(query))
+    return [
+        entry_id for entry_id, title, body in entries
+        if terms <= set(tokenize(title + ' ' + body))
+    ]
+
+
+def per_query(func, queries, runs):
+    return timeit.timeit(
+        lambda: [func(query) for query in queries], number=runs
+    ) / (runs * len(queries))
+
+
+def main(argv=sys.argv):
+    max_entries = int(argv[1]) if len(argv) > 1 else 100000
+    sizes = [size for size in (1000, 10000, 100000, 1000000)
+             if size <= max_entries]
+    print('{:>9} {:>14} {:>14} {:>9} {:>14} {:>9}'.format(
+        'entries', 'index ms/query', 'scan ms/query', 'matches',
+        'common ms', 'matches'))
+    timings = []
+    for size in sizes:
+        entries = list(make_entries(size))
+        index = InvertedIndex()
+        for entry in entries:
+            index.add(*entry)
+        indexed = per_query(index.search, QUERIES, 200)
+        scanned = per_query(
+            lambda query: linear_scan(entries, query), QUERIES, 1)
+        common = per_query(index.search, COMMON_QUERIES, 20)
+        timings.append(indexed)
+        print('{:>9} {:>14.3f} {:>14.1f} {:>9} {:>14.3f} {:>9}'.format(
+            size, indexed * 1000, scanned * 1000,
+            sum(index.search(query)[0] for query in QUERIES),
+            common * 1000,
+            sum(index.search(query)[0] for query in COMMON_QUERIES)))
+    growth = timings[-1] / timings[0]
+    print('rare-term queries: {:.1f}x the time for {}x the entries'.format(
+        growth, sizes[-1] // sizes[0]))
+    if len(sizes) > 1 and growth > FLAT_LIMIT:
+        print('not flat: over the {:.1f}x limit'.format(FLAT_LIMIT))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
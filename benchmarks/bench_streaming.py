@@ -0,0 +1,93 @@
+"""Benchmark the streamed archive page against rendering it all at once.
+
+For journals of growing size, requests ``/archive`` and reports the time
+to its first chunk and the peak memory allocated while sending it, next
+to rendering the same template from a fully loaded list of entries the
+way a ``renderer=`` view would.
+
+Run with ``python benchmarks/bench_streaming.py [entries ...]``.
+"""
+
+
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from harness import build_app, drop_tables  # noqa: E402
+
+ENTRY_COUNTS = (1000, 10000, 50000)
+TEMPLATE = 'learning_journal:templates/archive.jinja2'
+
+
+def streamed(app):
+    """First-chunk seconds, total seconds and bytes sent for /archive."""
+    from webob import Request
+    started = time.time()
+    response = Request.blank('/archive').get_response(app)
+    first, size = None, 0
+    for chunk in response.app_iter:
+        if first is None:
+            first = time.time() - started
+        size += len(chunk)
+    return first, time.time() - started, size
+
+
+def buffered(app):
+    """The same numbers, loading every entry and rendering in one go."""
+    from pyramid.renderers import render
+    from pyramid.request import Request
+    from pyramid.threadlocal import manager
+    from learning_journal.models import Entry, EntrySummary
+    request = Request.blank('/archive')
+    request.registry = app.registry
+    manager.push({'request': request, 'registry': app.registry})
+    started = time.time()
+    dbsession = app.registry['dbsession_factory']()
+    try:
+        entries = [EntrySummary(*row)
+                   for row in EntrySummary.query(dbsession).order_by(
+                       Entry.creation_date.desc(), Entry.id.desc())]
+        body = render(TEMPLATE, {'entries': entries, 'total': len(entries)},
+                      request=request).encode('utf-8')
+    finally:
+        dbsession.close()
+        manager.pop()
+    elapsed = time.time() - started
+    return elapsed, elapsed, len(body)
+
+
+def peak(func, app):
+    tracemalloc.start()
+    try:
+        result = func(app)
+        return result, tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def main(argv=sys.argv):
+    counts = [int(arg) for arg in argv[1:]] or ENTRY_COUNTS
+    directory = tempfile.mkdtemp()
+    url = 'sqlite:///{}'.format(os.path.join(directory, 'stream.sqlite'))
+    print('{:>8} {:<9} {:>10} {:>10} {:>12} {:>10}'.format(
+        'entries', 'mode', 'first ms', 'total ms', 'bytes', 'peak KiB'))
+    for count in counts:
+        app = build_app(url, count)
+        try:
+            for name, func in (('streamed', streamed),
+                               ('buffered', buffered)):
+                func(app)
+                (first, total, size), memory = peak(func, app)
+                print('{:>8} {:<9} {:>10.1f} {:>10.1f} {:>12} {:>10.0f}'
+                      .format(count, name, first * 1000, total * 1000, size,
+                              memory / 1024.0))
+        finally:
+            drop_tables(app)
+
+
+if __name__ == '__main__':
+    main()
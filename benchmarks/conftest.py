@@ -0,0 +1,66 @@
+"""Fixtures for the benchmark suite: a seeded app behind WebTest.
+
+Run with ``pytest benchmarks``. The journal is seeded with
+``BENCH_ENTRIES`` (default 2000) synthetic entries in a temporary SQLite
+database, or in ``BENCH_DATABASE_URL`` if that is set to a scratch
+PostgreSQL database.
+"""
+
+
+import os
+
+import pytest
+from webtest import TestApp
+
+from harness import (
+    PASSWORD, RESULTS, USERNAME, build_app, drop_tables, save_baselines
+)
+
+
+@pytest.fixture(scope='session')
+def entry_count():
+    return int(os.environ.get('BENCH_ENTRIES', 2000))
+
+
+@pytest.fixture(scope='session')
+def bench_app(tmpdir_factory, entry_count):
+    """The full app from ``learning_journal.main`` over a seeded database."""
+    url = os.environ.get('BENCH_DATABASE_URL') or 'sqlite:///{}'.format(
+        tmpdir_factory.mktemp('bench').join('bench.sqlite'))
+    app = build_app(url, entry_count, **{
+        'cache.backend': os.environ.get('BENCH_CACHE', 'none'),
+    })
+    yield app
+    drop_tables(app)
+
+
+@pytest.fixture(scope='session')
+def client(bench_app):
+    """An anonymous WebTest client."""
+    return TestApp(bench_app)
+
+
+@pytest.fixture(scope='session')
+def author(bench_app):
+    """A WebTest client logged in as the journal's author."""
+    app = TestApp(bench_app)
+    app.post('/login', {'username': USERNAME, 'password': PASSWORD},
+             status=302)
+    return app
+
+
+def pytest_sessionfinish(session, exitstatus):
+    if RESULTS and os.environ.get('BENCH_UPDATE_BASELINES'):
+        save_baselines(RESULTS)
+
+
+def pytest_terminal_summary(terminalreporter):
+    if not RESULTS:
+        return
+    terminalreporter.section('benchmarks')
+    terminalreporter.write_line('{:<20} {:>10} {:>10} {:>10}'.format(
+        'benchmark', 'req/s', 'p50 ms', 'p99 ms'))
+    for result in RESULTS:
+        terminalreporter.write_line(
+            '{name:<20} {throughput:>10.1f} {p50_ms:>10.2f} {p99_ms:>10.2f}'
+            .format(**result))
@@ -0,0 +1,146 @@
+"""Timing helpers, app seeding and baselines for the benchmark suite.
+
+Each benchmark times a callable a fixed number of times and reports its
+throughput and latency percentiles. Results are compared with
+``baselines.json``; a benchmark whose p50 is more than
+``BENCH_TOLERANCE`` (default 2.0) times its baseline, or whose noisier
+p99 is more than twice that, fails. Run with
+``BENCH_UPDATE_BASELINES=1`` to record new baselines instead.
+"""
+
+
+import json
+import os
+import random
+import time
+
+BASELINES_PATH = os.path.join(os.path.dirname(__file__), 'baselines.json')
+RESULTS = []
+USERNAME = 'bench'
+PASSWORD = 'bench-password'
+
+
+def make_entries(count, seed=401):
+    """Yield ``count`` synthetic entry rows."""
+    from faker import Faker
+    from learning_journal.models import Entry
+    fake = Faker()
+    fake.seed_instance(seed)
+    rng = random.Random(seed)
+    for _ in range(count):
+        creation_date = fake.date_time_between('-3y', 'now')
+        row = {
+            'id': None,
+            'title': fake.sentence(nb_words=5),
+            'body': ''.join(
+                '<p>{}</p>'.format(fake.paragraph(nb_sentences=8))
+                for _ in range(rng.randint(2, 6))
+            ),
+            'creation_date': creation_date,
+            'updated_at': creation_date,
+        }
+        row.update(Entry.derived_fields(row['body'], creation_date))
+        yield row
+
+
+def build_app(url, entry_count, **settings):
+    """Build the app from ``learning_journal.main`` over a seeded database.
+
+    The author can log in as ``USERNAME``/``PASSWORD``.
+    """
+    from passlib.apps import custom_app_context
+    from learning_journal import main
+    from learning_journal.models.meta import Base
+    from learning_journal.links import rebuild_links
+    from learning_journal.months import rebuild_month_counts
+    from learning_journal.scripts.transfer import batched, insert_batch
+    from sqlalchemy import create_engine
+
+    os.environ['DATABASE_URL'] = url
+    os.environ['AUTH_USERNAME'] = USERNAME
+    os.environ['AUTH_PASSWORD'] = custom_app_context.hash(PASSWORD)
+    os.environ.setdefault('AUTH_SECRET', 'bench-secret')
+    settings.setdefault('instrumentation.slow_request_ms', '60000')
+    # Seeded before the app starts, since main() builds the related-entry
+    # index from the database.
+    engine = create_engine(url)
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+    for batch in batched(make_entries(entry_count), 1000):
+        insert_batch(engine, batch)
+    with engine.begin() as conn:
+        rebuild_month_counts(conn)
+        rebuild_links(conn)
+    engine.dispose()
+    return main({}, **settings)
+
+
+def drop_tables(app):
+    from learning_journal.models.meta import Base
+    Base.metadata.drop_all(app.registry['dbsession_factory'].kw['bind'])
+
+
+def percentile(samples, fraction):
+    """Nearest-rank percentile of a sorted list of samples."""
+    index = max(int(round(fraction * len(samples))) - 1, 0)
+    return samples[min(index, len(samples) - 1)]
+
+
+def measure(name, func, iterations=200, warmup=10):
+    """Time ``func`` and return its stats in milliseconds."""
+    for i in range(warmup):
+        func(i)
+    samples = []
+    started = time.time()
+    for i in range(iterations):
+        before = time.time()
+        func(warmup + i)
+        samples.append((time.time() - before) * 1000)
+    elapsed = time.time() - started
+    samples.sort()
+    result = {
+        'name': name,
+        'iterations': iterations,
+        'throughput': iterations / elapsed,
+        'p50_ms': percentile(samples, 0.50),
+        'p99_ms': percentile(samples, 0.99),
+        'mean_ms': sum(samples) / len(samples),
+    }
+    RESULTS.append(result)
+    return result
+
+
+def load_baselines():
+    if not os.path.exists(BASELINES_PATH):
+        return {}
+    with open(BASELINES_PATH) as f:
+        return json.load(f)
+
+
+def save_baselines(results):
+    baselines = load_baselines()
+    for result in results:
+        baselines[result['name']] = {
+            'p50_ms': round(result['p50_ms'], 3),
+            'p99_ms': round(result['p99_ms'], 3),
+        }
+    with open(BASELINES_PATH, 'w') as f:
+        json.dump(baselines, f, indent=2, sort_keys=True)
+        f.write('\n')
+
+
+def check_baseline(result):
+    """Fail loudly if ``result`` regressed past its stored baseline."""
+    if os.environ.get('BENCH_UPDATE_BASELINES'):
+        return
+    baseline = load_baselines().get(result['name'])
+    if baseline is None:
+        return
+    tolerance = float(os.environ.get('BENCH_TOLERANCE', 2.0))
+    for stat, factor in (('p50_ms', tolerance), ('p99_ms', 2 * tolerance)):
+        limit = baseline[stat] * factor
+        assert result[stat] <= limit, (
+            '{} regressed: {} {:.2f}ms > {:.2f}ms ({}x baseline {:.2f}ms)'
+            .format(result['name'], stat, result[stat], limit, factor,
+                    baseline[stat])
+        )
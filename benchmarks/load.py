@@ -0,0 +1,181 @@
+"""A concurrent load driver for the journal over real HTTP.
+
+Serves a seeded app on a local port, with waitress or, with ``--mode
+asgi``, through ``learning_journal.asgi`` under uvicorn (or targets
+``--url``), and keeps ``--concurrency`` client threads requesting the
+given paths for ``--duration`` seconds, then reports throughput and
+latency percentiles per path. ``--slow-clients`` more threads meanwhile
+send their requests and read their responses a few bytes at a time,
+``--slow-delay`` seconds apart, like clients on a bad mobile link.
+
+Run with ``python benchmarks/load.py --concurrency 16 / /journal/1`` or
+``python benchmarks/load.py --mode asgi --slow-clients 32 /``.
+"""
+
+
+import argparse
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+try:
+    from http.client import HTTPConnection
+    from urllib.parse import urlsplit
+except ImportError:  # pragma: no cover
+    from httplib import HTTPConnection
+    from urlparse import urlsplit
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from harness import build_app, percentile  # noqa: E402
+
+
+def serve_in_thread(app, port, threads, mode='waitress'):
+    """Start waitress, or uvicorn over the ASGI bridge, in a daemon thread."""
+    if mode == 'asgi':
+        import uvicorn
+        from learning_journal.asgi import make_asgi_app
+        server = uvicorn.Server(uvicorn.Config(
+            make_asgi_app(app, workers=threads), host='127.0.0.1',
+            port=port, log_level='warning'))
+    else:
+        from waitress.server import create_server
+        server = create_server(
+            app, host='127.0.0.1', port=port, threads=threads)
+    thread = threading.Thread(target=server.run)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def run_slow_clients(base_url, path, count, delay, deadline):
+    """Start ``count`` threads trickling requests and reads until deadline.
+
+    Returns a list that gets a 1 appended for each completed request.
+    """
+    target = urlsplit(base_url)
+    request = ('GET {} HTTP/1.1\r\nHost: {}\r\n'
+               'Connection: close\r\n\r\n').format(
+        path, target.netloc).encode('ascii')
+    completed = []
+
+    def slow_client():
+        while time.time() < deadline:
+            try:
+                sock = socket.create_connection(
+                    (target.hostname, target.port), timeout=30)
+                for start in range(0, len(request), 8):
+                    sock.sendall(request[start:start + 8])
+                    time.sleep(delay)
+                while sock.recv(4096):
+                    time.sleep(delay)
+                sock.close()
+                completed.append(1)
+            except (OSError, socket.error):
+                time.sleep(delay)
+
+    for _ in range(count):
+        thread = threading.Thread(target=slow_client)
+        thread.daemon = True
+        thread.start()
+    return completed
+
+
+def run_load(base_url, paths, concurrency, duration):
+    """Hammer ``paths`` and return ``{path: [latency_ms, ...]}``."""
+    target = urlsplit(base_url)
+    samples = defaultdict(list)
+    errors = []
+    lock = threading.Lock()
+    deadline = time.time() + duration
+
+    def worker(offset):
+        conn = HTTPConnection(target.hostname, target.port, timeout=30)
+        i = offset
+        while time.time() < deadline:
+            path = paths[i % len(paths)]
+            i += 1
+            before = time.time()
+            try:
+                conn.request('GET', path)
+                response = conn.getresponse()
+                response.read()
+            except Exception as error:
+                conn.close()
+                conn = HTTPConnection(target.hostname, target.port, timeout=30)
+                with lock:
+                    errors.append(error)
+                continue
+            with lock:
+                samples[path].append((time.time() - before) * 1000)
+        conn.close()
+
+    workers = [
+        threading.Thread(target=worker, args=(n,)) for n in range(concurrency)
+    ]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return samples, errors
+
+
+def report(samples, errors, duration):
+    print('{:<24} {:>8} {:>10} {:>10} {:>10}'.format(
+        'path', 'requests', 'req/s', 'p50 ms', 'p99 ms'))
+    for path, latencies in sorted(samples.items()):
+        latencies.sort()
+        print('{:<24} {:>8} {:>10.1f} {:>10.2f} {:>10.2f}'.format(
+            path, len(latencies), len(latencies) / duration,
+            percentile(latencies, 0.5), percentile(latencies, 0.99)))
+    if errors:
+        print('{} requests failed, first error: {!r}'.format(
+            len(errors), errors[0]))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('paths', nargs='*', default=['/', '/journal/1'])
+    parser.add_argument('--url', help='load an already running server')
+    parser.add_argument('--entries', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--threads', type=int, default=4,
+                        help='worker threads for the local server')
+    parser.add_argument('--port', type=int, default=6544)
+    parser.add_argument('--mode', choices=('waitress', 'asgi'),
+                        default='waitress', help='how to serve the app')
+    parser.add_argument('--slow-clients', type=int, default=0)
+    parser.add_argument('--slow-delay', type=float, default=0.05,
+                        help='seconds between each slow client read/write')
+    args = parser.parse_args(argv)
+
+    base_url = args.url
+    if base_url is None:
+        path = os.path.join(tempfile.mkdtemp(), 'load.sqlite')
+        url = os.environ.get('BENCH_DATABASE_URL', 'sqlite:///' + path)
+        app = build_app(url, args.entries, **{
+            'server.threads': str(args.threads),
+            'cache.backend': os.environ.get('BENCH_CACHE', 'none'),
+        })
+        serve_in_thread(app, args.port, args.threads, args.mode)
+        base_url = 'http://127.0.0.1:{}'.format(args.port)
+        time.sleep(1)
+
+    slow = run_slow_clients(
+        base_url, args.paths[0], args.slow_clients, args.slow_delay,
+        time.time() + args.duration)
+    samples, errors = run_load(
+        base_url, args.paths, args.concurrency, args.duration)
+    report(samples, errors, args.duration)
+    if args.slow_clients:
+        print('{} slow clients completed {} requests'.format(
+            args.slow_clients, sum(slow)))
+
+
+if __name__ == '__main__':
+    main()
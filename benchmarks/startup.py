@@ -0,0 +1,140 @@
+"""Measure how long a fresh process takes to serve its first response.
+
+Each run starts a new interpreter under ``python -X importtime`` that
+imports ``learning_journal``, builds the app with ``main`` and serves
+``/`` once from a seeded SQLite journal. Reports the median time spent in
+each phase and the slowest top-level imports, and exits non-zero if time
+to first response is over ``--budget`` seconds (default
+``STARTUP_BUDGET``, 1.5).
+
+Run with ``python benchmarks/startup.py --runs 5``.
+"""
+
+
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from harness import build_app, drop_tables  # noqa: E402
+
+IMPORT_LINE_RE = re.compile(
+    r'^import time:\s+(\d+) \|\s+(\d+) \| ( *)(\S+)$')
+PACKAGE = 'learning_journal'
+PHASES = ('interpreter', 'import', 'main', 'first_response')
+
+
+def child():
+    """Run in the measured process: time import, main and one request."""
+    started = time.time()
+    from learning_journal import main
+    imported = time.time()
+    app = main({})
+    built = time.time()
+    from webob import Request
+    response = Request.blank('/').get_response(app)
+    served = time.time()
+    print(json.dumps({
+        'started': started, 'imported': imported, 'built': built,
+        'served': served, 'status': response.status_int,
+    }))
+
+
+def parse_importtime(stderr, max_depth=3):
+    """Cumulative microseconds of the modules importing the package loaded.
+
+    ``-X importtime`` lists a module's imports, indented one level more,
+    just before the module itself, so what ``PACKAGE`` imported is the
+    indented lines since the previous top-level import. Modules nested
+    deeper than ``max_depth`` are left out.
+    """
+    block = []
+    for line in stderr.splitlines():
+        match = IMPORT_LINE_RE.match(line)
+        if not match:
+            continue
+        micros, depth, module = (
+            int(match.group(2)), len(match.group(3)) // 2, match.group(4))
+        if 0 < depth <= max_depth:
+            block.append((micros, module))
+        elif depth == 0:
+            if module == PACKAGE:
+                return sorted(block + [(micros, module)], reverse=True)
+            block = []
+    return []
+
+
+def run_once():
+    """Start a measured process and return its phases and imports."""
+    spawned = time.time()
+    process = subprocess.Popen(
+        [sys.executable, '-X', 'importtime', os.path.abspath(__file__),
+         '--child'],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        universal_newlines=True)
+    stdout, stderr = process.communicate()
+    if process.returncode:
+        raise RuntimeError('startup run failed:\n' + stderr[-2000:])
+    times = json.loads(stdout.strip().splitlines()[-1])
+    phases = {
+        'interpreter': times['started'] - spawned,
+        'import': times['imported'] - times['started'],
+        'main': times['built'] - times['imported'],
+        'first_response': times['served'] - times['built'],
+        'total': times['served'] - spawned,
+    }
+    return phases, parse_importtime(stderr)
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--entries', type=int, default=200)
+    parser.add_argument('--budget', type=float, default=float(
+        os.environ.get('STARTUP_BUDGET', 1.5)))
+    parser.add_argument('--imports', type=int, default=15,
+                        help='how many of the slowest imports to list')
+    parser.add_argument('--child', action='store_true',
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    if args.child:
+        return child()
+
+    directory = tempfile.mkdtemp()
+    url = 'sqlite:///{}'.format(os.path.join(directory, 'startup.sqlite'))
+    app = build_app(url, args.entries)
+    try:
+        runs = [run_once() for _ in range(args.runs)]
+    finally:
+        drop_tables(app)
+
+    print('{:<16} {:>10}'.format('phase', 'median ms'))
+    for phase in PHASES + ('total',):
+        print('{:<16} {:>10.1f}'.format(
+            phase, median([phases[phase] for phases, _ in runs]) * 1000))
+    print('\n{:<40} {:>10}'.format('slowest imports of ' + PACKAGE, 'ms'))
+    for micros, module in runs[-1][1][:args.imports]:
+        print('{:<40} {:>10.1f}'.format(module, micros / 1000.0))
+
+    total = median([phases['total'] for phases, _ in runs])
+    if total > args.budget:
+        print('\nover budget: first response after {:.2f}s, budget {:.2f}s'
+              .format(total, args.budget))
+        return 1
+    print('\nwithin budget: first response after {:.2f}s, budget {:.2f}s'
+          .format(total, args.budget))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,65 @@
+"""Throughput and latency of every route, checked against baselines."""
+
+
+from harness import PASSWORD, USERNAME, check_baseline, measure
+
+
+def test_home(client):
+    check_baseline(measure('home', lambda i: client.get('/')))
+
+
+def test_home_older_page(client):
+    older = client.get('/').html.find('a', string='Older Entries →')
+    url = older['href']
+    check_baseline(measure('home_older_page', lambda i: client.get(url)))
+
+
+def test_archive_month(client):
+    url = client.get('/').html.select('.archive-months a')[-1]['href']
+    check_baseline(measure('archive_month', lambda i: client.get(url)))
+
+
+def test_detail(client, entry_count):
+    def detail(i):
+        client.get('/journal/{}'.format(i % entry_count + 1))
+    check_baseline(measure('detail', detail))
+
+
+def test_api_entries(client):
+    check_baseline(measure('api_entries', lambda i: client.get('/api/entries')))
+
+
+def test_api_entry(client, entry_count):
+    def api_entry(i):
+        client.get('/api/entries/{}'.format(i % entry_count + 1))
+    check_baseline(measure('api_entry', api_entry))
+
+
+def test_feed(client):
+    check_baseline(measure('feed', lambda i: client.get('/feed.atom')))
+
+
+def test_create(author):
+    def create(i):
+        author.post('/journal/new-entry', {
+            'title': 'Benchmark entry {}'.format(i),
+            'body': '<p>Created by the benchmark suite.</p>',
+        }, status=302)
+    check_baseline(measure('create', create, iterations=100))
+
+
+def test_update(author, entry_count):
+    def update(i):
+        author.post('/journal/{}/edit-entry'.format(i % entry_count + 1), {
+            'title': 'Edited entry {}'.format(i),
+            'body': '<p>Edited by the benchmark suite.</p>',
+        }, status=302)
+    check_baseline(measure('update', update, iterations=100))
+
+
+def test_login(client):
+    def login(i):
+        client.post('/login', {'username': USERNAME, 'password': PASSWORD},
+                    status=302)
+        client.reset()
+    check_baseline(measure('login', login, iterations=10, warmup=1))
@@ -1,4 +1,7 @@
 from pyramid.config import Configurator
+from pyramid.settings import asbool
+from .links import build_index
+from .templating import warm_up
 import os
 
 
@@ -6,10 +9,24 @@ def main(global_config, **settings):
     """ This function returns a Pyramid WSGI application.
     """
     settings['sqlalchemy.url'] = os.environ['DATABASE_URL']
+    settings['replicas.urls'] = os.environ.get(
+        'DATABASE_REPLICA_URLS', settings.get('replicas.urls', '')
+    )
+    settings['server.threads'] = os.environ.get(
+        'WAITRESS_THREADS', settings.get('server.threads', '4')
+    )
     config = Configurator(settings=settings)
     config.include('pyramid_jinja2')
+    config.include('.templating')
     config.include('.models')
     config.include('.routes')
     config.include('.security')
-    config.scan()
-    return config.make_wsgi_app()
+    config.include('.cache')
+    config.include('.instrumentation')
+    config.include('.compression')
+    config.include('.views')
+    app = config.make_wsgi_app()
+    build_index(app.registry)
+    if asbool(settings.get('warmup.enabled', False)):
+        warm_up(app)
+    return app
@@ -0,0 +1,334 @@
+"""Serve the WSGI app from an asyncio event loop (ASGI).
+
+``WSGIBridge`` reads each request body on the event loop, runs the
+Pyramid app on a bounded thread pool, and hands the response back to the
+loop to send, so a thread is only held while the app itself is working:
+slow uploads and slow readers wait on the loop instead. Once ``workers``
+requests are running and ``backlog`` more are queued, further requests
+get an immediate 503. Static files are read and sent by the loop
+directly, never reaching a worker thread.
+
+``runapp.py`` uses this with uvicorn when ``SERVER_MODE=asgi``.
+"""
+
+
+import asyncio
+import logging
+import mimetypes
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import formatdate, parsedate_tz, mktime_tz
+from io import BytesIO
+
+from .assets import (
+    BUILD_DIRECTORY,
+    BUILD_NAME,
+    COMPRESSIBLE,
+    ENCODINGS,
+    IMMUTABLE_CACHE_CONTROL,
+    STATIC_DIRECTORY,
+    accepted_encodings,
+)
+
+log = logging.getLogger(__name__)
+
+DEFAULT_BACKLOG = 64
+MAX_BODY_BYTES = 10 * 1024 * 1024
+STATIC_PREFIX = '/static/'
+STATIC_CACHE_CONTROL = 'public, max-age=3600'
+STATIC_CHUNK_BYTES = 64 * 1024
+# Response messages a worker may get ahead of a slow client by; beyond
+# that its thread waits, so a streamed page is never held in memory whole.
+RESPONSE_QUEUE_SIZE = 8
+
+
+def build_environ(scope, body):
+    """The PEP 3333 environ for an ASGI HTTP ``scope`` and its body."""
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode(
+            'latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+        'REMOTE_ADDR': client[0],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            key = name
+        else:
+            key = 'HTTP_' + name
+        if key in environ:
+            value = environ[key] + ',' + value
+        environ[key] = value
+    return environ
+
+
+class WSGIResponder(object):
+    """Run one WSGI call on a worker thread, posting messages to the loop."""
+
+    def __init__(self, app, environ, emit):
+        self.app = app
+        self.environ = environ
+        self.emit = emit
+        self.start = None
+        self.started = False
+        self.cancelled = False
+
+    def start_response(self, status, headers, exc_info=None):
+        if exc_info is not None and self.started:
+            raise exc_info[1].with_traceback(exc_info[2])
+        self.start = {
+            'type': 'http.response.start',
+            'status': int(status.split(' ', 1)[0]),
+            'headers': [
+                (name.lower().encode('latin-1'), value.encode('latin-1'))
+                for name, value in headers
+            ],
+        }
+        return self.write
+
+    def write(self, data):
+        if not self.started:
+            self.emit(self.start)
+            self.started = True
+        if data:
+            self.emit({'type': 'http.response.body', 'body': data,
+                       'more_body': True})
+
+    def __call__(self):
+        try:
+            result = self.app(self.environ, self.start_response)
+            try:
+                for chunk in result:
+                    if self.cancelled:
+                        break
+                    self.write(chunk)
+            finally:
+                close = getattr(result, 'close', None)
+                if close is not None:
+                    close()
+            self.write(b'')
+            self.emit({'type': 'http.response.body', 'body': b'',
+                       'more_body': False})
+        except Exception:
+            log.exception('Error serving %s', self.environ.get('PATH_INFO'))
+            self.emit(None if self.started else 'error')
+        else:
+            self.emit(None)
+
+
+class WSGIBridge(object):
+    """An ASGI application wrapping a WSGI one on a bounded thread pool."""
+
+    def __init__(self, app, workers=4, backlog=DEFAULT_BACKLOG,
+                 serve_static=True):
+        self.app = app
+        self.workers = workers
+        self.backlog = backlog
+        self.serve_static = serve_static
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.file_executor = ThreadPoolExecutor(max_workers=2)
+        self.pending = 0
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] != 'http':
+            return
+        if self.serve_static and scope['path'].startswith(STATIC_PREFIX):
+            return await self.static(scope, send)
+        if self.pending >= self.workers + self.backlog:
+            return await simple_response(send, 503, b'Server busy')
+        self.pending += 1
+        try:
+            await self.call_app(scope, receive, send)
+        finally:
+            self.pending -= 1
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=True)
+                self.file_executor.shutdown(wait=True)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def read_body(self, receive):
+        chunks, size = [], 0
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return None
+            chunk = message.get('body', b'')
+            size += len(chunk)
+            if size > MAX_BODY_BYTES:
+                return False
+            chunks.append(chunk)
+            if not message.get('more_body'):
+                return b''.join(chunks)
+
+    async def call_app(self, scope, receive, send):
+        body = await self.read_body(receive)
+        if body is None:
+            return
+        if body is False:
+            return await simple_response(send, 413, b'Request too large')
+        loop = asyncio.get_event_loop()
+        queue = asyncio.Queue(RESPONSE_QUEUE_SIZE)
+
+        def emit(message):
+            asyncio.run_coroutine_threadsafe(queue.put(message), loop).result()
+        responder = WSGIResponder(self.app, build_environ(scope, body), emit)
+        try:
+            loop.run_in_executor(self.executor, responder)
+        except RuntimeError:
+            # The pool has been shut down: the server is stopping.
+            return await simple_response(send, 503, b'Server stopping')
+        finished = False
+        try:
+            while True:
+                message = await queue.get()
+                if message is None or message == 'error':
+                    finished = True
+                if message is None:
+                    return
+                if message == 'error':
+                    return await simple_response(
+                        send, 500, b'Internal Server Error')
+                if responder.cancelled:
+                    continue
+                try:
+                    await send(message)
+                except Exception:
+                    # The client went away; let the worker stop early.
+                    responder.cancelled = True
+        finally:
+            if not finished:
+                # This task was cancelled: keep taking the worker's
+                # messages so it is never left blocked on a full queue.
+                responder.cancelled = True
+                asyncio.ensure_future(drain(queue))
+
+    async def static(self, scope, send):
+        """Send a file from ``static/``, the build first, from the loop."""
+        path, headers = static_file(scope)
+        try:
+            modified = os.path.getmtime(path) if path is not None else None
+        except OSError:
+            modified = None
+        if modified is None:
+            return await simple_response(send, 404, b'Not Found')
+        since = dict(scope.get('headers', [])).get(b'if-modified-since')
+        if since is not None:
+            parsed = parsedate_tz(since.decode('latin-1'))
+            if parsed is not None and int(modified) <= mktime_tz(parsed):
+                return await send_response(send, 304, headers, b'')
+        headers.append((b'last-modified', formatdate(
+            modified, usegmt=True).encode('latin-1')))
+        headers.append((b'content-length', str(
+            os.path.getsize(path)).encode('latin-1')))
+        loop = asyncio.get_event_loop()
+        await send({'type': 'http.response.start', 'status': 200,
+                    'headers': headers})
+        with open(path, 'rb') as f:
+            while True:
+                chunk = await loop.run_in_executor(
+                    self.file_executor, f.read, STATIC_CHUNK_BYTES)
+                await send({'type': 'http.response.body', 'body': chunk,
+                            'more_body': bool(chunk)})
+                if not chunk:
+                    return
+
+
+def static_file(scope):
+    """The file a static request names, and the headers to send with it.
+
+    Returns ``(None, None)``, before touching the filesystem, for paths
+    with NUL bytes or segments that could leave the static directories,
+    and for anything that does not resolve to a file inside them.
+    """
+    parts = scope['path'][len(STATIC_PREFIX):].split('/')
+    if not parts or any(part in ('', '.', '..') or os.sep in part or
+                        '\x00' in part for part in parts):
+        return None, None
+    built = parts[0] == BUILD_NAME
+    directory = BUILD_DIRECTORY if built else STATIC_DIRECTORY
+    path = os.path.join(directory, *(parts[1:] if built else parts))
+    try:
+        resolved = os.path.realpath(path)
+        inside = os.path.commonpath(
+            [resolved, os.path.realpath(directory)]
+        ) == os.path.realpath(directory)
+        if not inside or not os.path.isfile(resolved):
+            return None, None
+    except (OSError, ValueError):
+        return None, None
+    content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    headers = [(b'content-type', content_type.encode('latin-1'))]
+    if not built:
+        headers.append((b'cache-control', STATIC_CACHE_CONTROL.encode()))
+        return path, headers
+    headers.append((b'cache-control', IMMUTABLE_CACHE_CONTROL.encode()))
+    if path.endswith(COMPRESSIBLE):
+        headers.append((b'vary', b'Accept-Encoding'))
+        accept = dict(scope.get('headers', [])).get(b'accept-encoding', b'')
+        accepted = accepted_encodings(accept.decode('latin-1'))
+        for name, suffix in ENCODINGS:
+            if name in accepted and os.path.isfile(path + suffix):
+                headers.append((b'content-encoding', name.encode('latin-1')))
+                return path + suffix, headers
+    return path, headers
+
+
+async def drain(queue):
+    """Discard a worker's messages until it has finished."""
+    while await queue.get() not in (None, 'error'):
+        pass
+
+
+async def send_response(send, status, headers, body):
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': headers})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def simple_response(send, status, text):
+    await send_response(send, status, [
+        (b'content-type', b'text/plain; charset=utf-8'),
+        (b'content-length', str(len(text)).encode('latin-1')),
+    ], text)
+
+
+def make_asgi_app(app, workers=None, backlog=None):
+    """Wrap a WSGI app built by ``learning_journal.main`` for ASGI."""
+    settings = app.registry.settings
+    return WSGIBridge(
+        app,
+        workers=int(workers or settings.get('server.threads', 4)),
+        backlog=int(backlog or settings.get('asgi.backlog', DEFAULT_BACKLOG)),
+    )
+
+
+def serve(app, host='0.0.0.0', port=5000, **kwargs):
+    """Serve a WSGI app through ``WSGIBridge`` with uvicorn."""
+    import uvicorn
+    uvicorn.run(make_asgi_app(app, **kwargs), host=host, port=port,
+                lifespan='on')
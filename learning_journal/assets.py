@@ -0,0 +1,103 @@
+"""Serve fingerprinted, precompressed static files.
+
+``buildassets2`` (see ``scripts/assets.py``) copies each file under
+``static/`` into ``static/_build/`` under a name carrying a hash of its
+content, writes gzip (and brotli) versions of the text files, and lists
+the names in ``static/_build/manifest.json``. With ``assets.fingerprint``
+on and the manifest built, ``request.static_path`` links to those copies.
+They never change, so they are served with a year-long immutable
+Cache-Control, precompressed when the client accepts it. Anything not in
+the manifest is still served by the plain static view.
+"""
+
+
+import logging
+import mimetypes
+import os
+
+from pyramid.httpexceptions import HTTPNotFound
+from pyramid.response import FileResponse
+from pyramid.settings import asbool
+from pyramid.static import ManifestCacheBuster
+
+log = logging.getLogger(__name__)
+
+STATIC_DIRECTORY = os.path.join(os.path.dirname(__file__), 'static')
+BUILD_NAME = '_build'
+BUILD_DIRECTORY = os.path.join(STATIC_DIRECTORY, BUILD_NAME)
+MANIFEST_PATH = os.path.join(BUILD_DIRECTORY, 'manifest.json')
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+# Preferred first. Only text formats get compressed copies; images and
+# web fonts are compressed already.
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+COMPRESSIBLE = ('.css', '.js', '.svg', '.eot', '.ttf', '.otf', '.json')
+
+
+def accepted_encodings(header):
+    """The content codings an Accept-Encoding header allows."""
+    accepted = set()
+    for item in (header or '').split(','):
+        parts = item.strip().split(';')
+        coding = parts[0].strip().lower()
+        quality = 1.0
+        for param in parts[1:]:
+            name, _, value = param.strip().partition('=')
+            if name.strip() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if coding and quality > 0:
+            accepted.add(coding)
+    return accepted
+
+
+class AssetView(object):
+    """Serve a built file, its precompressed copy if accepted, forever."""
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def __call__(self, context, request):
+        parts = request.subpath
+        if not parts or any(
+                part in ('', '.', '..') or os.sep in part or '/' in part
+                for part in parts):
+            raise HTTPNotFound(request.url)
+        path = os.path.join(self.directory, *parts)
+        if not os.path.isfile(path):
+            raise HTTPNotFound(request.url)
+        content_type = mimetypes.guess_type(path)[0]
+        served, encoding = path, None
+        compressible = path.endswith(COMPRESSIBLE)
+        if compressible:
+            accepted = accepted_encodings(
+                request.headers.get('Accept-Encoding'))
+            for name, suffix in ENCODINGS:
+                if name in accepted and os.path.isfile(path + suffix):
+                    served, encoding = path + suffix, name
+                    break
+        response = FileResponse(served, request, content_type=content_type)
+        response.content_encoding = encoding
+        response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+        if compressible:
+            response.vary = ('Accept-Encoding',)
+        return response
+
+
+def includeme(config):
+    """Serve the fingerprinted build when ``assets.fingerprint`` is on.
+
+    Activate this setup using ``config.include('learning_journal.assets')``
+    before the static view is added, so its route is matched first.
+    """
+    if not asbool(config.get_settings().get('assets.fingerprint', False)):
+        return
+    if not os.path.exists(MANIFEST_PATH):
+        log.warning('assets.fingerprint is on but %s is missing; run '
+                    'buildassets2 to build it', MANIFEST_PATH)
+        return
+    config.add_route('assets', '/static/{}/*subpath'.format(BUILD_NAME))
+    config.add_view(AssetView(BUILD_DIRECTORY), route_name='assets')
+    config.add_cache_buster(
+        'learning_journal:static/', ManifestCacheBuster(MANIFEST_PATH))
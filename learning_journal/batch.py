@@ -0,0 +1,182 @@
+"""Create and update many entries in one request and one transaction.
+
+A batch is a JSON array of ``{"title": ..., "body": ...}`` objects; one
+with an ``"id"`` updates that entry, one without creates an entry. The
+whole batch is checked before anything is written, so it is applied
+completely or not at all. Entries and their revisions are then written
+with one executemany per table instead of a flush per entry, along with
+the month counts, entry links, cache invalidation and search indexing
+a single write does.
+"""
+
+
+from collections import namedtuple
+from datetime import datetime
+
+from zope.sqlalchemy import mark_changed
+
+from .cache import invalidate_after_commit
+from .links import refresh_links
+from .models import Entry, EntryRevision
+from .months import add_month_counts
+from .revisions import get_snapshot_interval, latest_numbers, revision_values
+from .search import index_many_after_commit
+
+DEFAULT_MAX_ITEMS = 500
+FIELDS = frozenset(['id', 'title', 'body'])
+
+Item = namedtuple('Item', 'id title body')
+
+
+class BatchError(ValueError):
+    """A batch that cannot be applied; ``errors`` says why, per item."""
+
+    def __init__(self, errors):
+        super(BatchError, self).__init__(errors)
+        self.errors = errors
+
+
+def get_max_items(settings):
+    return max(int((settings or {}).get(
+        'api.batch_max_items', DEFAULT_MAX_ITEMS)), 1)
+
+
+def item_error(record, seen):
+    """Why ``record`` is not a valid item, or None."""
+    if not isinstance(record, dict):
+        return 'expected an object'
+    unknown = sorted(set(record) - FIELDS)
+    if unknown:
+        return 'unknown fields: {}'.format(', '.join(unknown))
+    if 'id' in record:
+        entry_id = record['id']
+        if (isinstance(entry_id, bool) or not isinstance(entry_id, int) or
+                entry_id < 1):
+            return 'id must be a positive integer'
+        if entry_id in seen:
+            return 'entry {} appears more than once'.format(entry_id)
+        seen.add(entry_id)
+    for field in ('title', 'body'):
+        if not isinstance(record.get(field), str):
+            return '{} must be a string'.format(field)
+    return None
+
+
+def parse_items(data, max_items=DEFAULT_MAX_ITEMS):
+    """Turn a decoded JSON batch into ``Item``s, or raise ``BatchError``."""
+    if not isinstance(data, list) or not data:
+        raise BatchError([{'index': None,
+                           'error': 'expected a non-empty array'}])
+    if len(data) > max_items:
+        raise BatchError([{'index': None, 'error': 'at most {} items'.format(
+            max_items)}])
+    errors, seen = [], set()
+    for index, record in enumerate(data):
+        error = item_error(record, seen)
+        if error:
+            errors.append({'index': index, 'error': error})
+    if errors:
+        raise BatchError(errors)
+    return [Item(record.get('id'), record['title'], record['body'])
+            for record in data]
+
+
+def apply_batch(request, items):
+    """Write ``items`` in the request's transaction.
+
+    Returns ``[(entry_id, created), ...]`` in the order of ``items``.
+    Raises ``BatchError``, having written nothing, if an update names an
+    entry that does not exist.
+    """
+    dbsession = request.dbsession
+    update_ids = [item.id for item in items if item.id is not None]
+    previous = {}
+    if update_ids:
+        # Locked in id order, like single edits, so concurrent writers
+        # queue up behind each other instead of numbering the same
+        # revision or deadlocking.
+        previous = dict(
+            (row.id, row) for row in dbsession.query(
+                Entry.id, Entry.title, Entry.body, Entry.creation_date,
+                Entry.updated_at,
+            ).filter(Entry.id.in_(update_ids)).order_by(
+                Entry.id).with_for_update()
+        )
+    missing = [
+        {'index': index, 'error': 'no entry {}'.format(item.id)}
+        for index, item in enumerate(items)
+        if item.id is not None and item.id not in previous
+    ]
+    if missing:
+        raise BatchError(missing)
+
+    now = datetime.now()
+    created, updated = [], []
+    for item in items:
+        creation_date = (now if item.id is None
+                         else previous[item.id].creation_date)
+        values = {'title': item.title, 'body': item.body, 'updated_at': now}
+        values.update(Entry.derived_fields(item.body, creation_date))
+        if item.id is None:
+            values['creation_date'] = now
+            created.append(values)
+        else:
+            values['id'] = item.id
+            updated.append(values)
+    if created:
+        # return_defaults would insert row by row to learn each id, so
+        # insert in one executemany and read the ids back: the rows all
+        # carry this batch's timestamp, and ids are handed out in the
+        # order the rows were inserted.
+        dbsession.bulk_insert_mappings(Entry, created)
+        new_ids = [row.id for row in dbsession.query(Entry.id).filter(
+            Entry.creation_date == now).order_by(Entry.id)]
+        for values, entry_id in zip(created, new_ids):
+            values['id'] = entry_id
+        add_month_counts(dbsession.connection(), [now] * len(created))
+    if updated:
+        dbsession.bulk_update_mappings(Entry, updated)
+
+    interval = get_snapshot_interval(request.registry.settings)
+    numbers = latest_numbers(dbsession, update_ids)
+    revisions = [
+        revision_values(values['id'], 1, values['title'], values['body'],
+                        interval=interval, created_at=now)
+        for values in created
+    ]
+    for values in updated:
+        before = previous[values['id']]
+        number = numbers.get(values['id'], 0)
+        if number == 0:
+            # Written before revisions were kept; store that version first.
+            revisions.append(revision_values(
+                before.id, 1, before.title, before.body,
+                interval=interval, created_at=before.updated_at))
+            number = 1
+        revisions.append(revision_values(
+            before.id, number + 1, values['title'], values['body'],
+            before.body, interval, now))
+    dbsession.bulk_insert_mappings(EntryRevision, revisions)
+    refresh_links(request, [
+        (values['id'], values['creation_date'], values['body'])
+        for values in created
+    ], created=True)
+    refresh_links(request, [
+        (values['id'], previous[values['id']].creation_date, values['body'])
+        for values in updated
+    ])
+    # Bulk writes skip the flush that tells pyramid_tm there is work to
+    # commit.
+    mark_changed(dbsession, request.tm)
+
+    invalidate_after_commit(request, 'entries', *[
+        'entry:{}'.format(values['id']) for values in updated])
+    index_many_after_commit(request, [
+        (values['id'], values['title'], values['body'])
+        for values in created + updated])
+    created, updated = iter(created), iter(updated)
+    return [
+        (next(created)['id'], True) if item.id is None
+        else (next(updated)['id'], False)
+        for item in items
+    ]
@@ -0,0 +1,339 @@
+"""Cache rendered pages and drop them when the entries they show change.
+
+Pages are stored under a key built from the route, the query string, the
+logged in user and a generation token for every tag the page depends on
+(``entries`` for listings, ``entry:<id>`` for a single entry). Invalidating
+a tag just replaces its token, so every page built from the old data stops
+being reachable at once, whatever backend holds it.
+"""
+
+
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import wraps
+
+from pyramid.response import Response
+
+DEFAULT_MAX_ENTRIES = 1000
+DEFAULT_TTL = 300
+
+
+class CacheBackend(object):
+    """Interface every cache backend implements."""
+
+    def get(self, key):
+        """Return the stored value, or None if missing or expired."""
+        raise NotImplementedError
+
+    def set(self, key, value):
+        """Store a value."""
+        raise NotImplementedError
+
+    def delete(self, key):
+        """Remove a value if present."""
+        raise NotImplementedError
+
+    def clear(self):
+        """Remove every value."""
+        raise NotImplementedError
+
+
+class MemoryBackend(CacheBackend):
+    """A thread safe in-process LRU cache with a TTL and a size bound."""
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, ttl=DEFAULT_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            expires, value = item
+            if expires < time.time():
+                del self._data[key]
+                return None
+            self._data[key] = self._data.pop(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (time.time() + self.ttl, value)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class SQLiteBackend(CacheBackend):
+    """A cache in a local SQLite file, shared by every process on a host.
+
+    Stands in for a networked cache such as memcached or Redis. Values
+    are stored as plain columns, never pickled, since anything able to
+    write the file could otherwise run code in the app: a page is its
+    status and headers as JSON plus its body, a string is stored as JSON
+    and bytes as they are. Expired and surplus values are evicted every
+    ``EVICT_EVERY`` writes, oldest first, through an index on expiry, so
+    the file may hold that many more than ``max_entries`` in between.
+    """
+
+    EVICT_EVERY = 64
+
+    def __init__(self, path, max_entries=DEFAULT_MAX_ENTRIES, ttl=DEFAULT_TTL):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._writes = 0
+        self._lock = threading.Lock()
+        with self._connect() as conn:
+            # Older versions kept pickles in the ``cache`` table.
+            conn.execute('DROP TABLE IF EXISTS cache')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS cache_entries '
+                '(key TEXT PRIMARY KEY, meta TEXT, body BLOB, expires REAL)'
+            )
+            conn.execute(
+                'CREATE INDEX IF NOT EXISTS ix_cache_entries_expires '
+                'ON cache_entries (expires)'
+            )
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=5)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _encode(value):
+        if isinstance(value, bytes):
+            return None, sqlite3.Binary(value)
+        if isinstance(value, str):
+            return json.dumps(value), None
+        status, headerlist, body = value
+        return json.dumps([status, headerlist]), sqlite3.Binary(body)
+
+    @staticmethod
+    def _decode(meta, body):
+        if meta is None:
+            return bytes(body)
+        meta = json.loads(meta)
+        if body is None:
+            return meta
+        status, headerlist = meta
+        return status, [tuple(header) for header in headerlist], bytes(body)
+
+    def get(self, key):
+        with self._connect() as conn:
+            row = conn.execute(
+                'SELECT meta, body FROM cache_entries '
+                'WHERE key = ? AND expires >= ?',
+                (key, time.time())
+            ).fetchone()
+        return self._decode(*row) if row else None
+
+    def set(self, key, value):
+        meta, body = self._encode(value)
+        now = time.time()
+        with self._lock:
+            self._writes += 1
+            evict = self._writes % self.EVICT_EVERY == 0
+        with self._connect() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO cache_entries VALUES (?, ?, ?, ?)',
+                (key, meta, body, now + self.ttl)
+            )
+            if evict:
+                self._evict(conn, now)
+
+    def _evict(self, conn, now):
+        conn.execute('DELETE FROM cache_entries WHERE expires < ?', (now,))
+        surplus = conn.execute(
+            'SELECT count(*) FROM cache_entries').fetchone()[0] - \
+            self.max_entries
+        if surplus > 0:
+            conn.execute(
+                'DELETE FROM cache_entries WHERE key IN '
+                '(SELECT key FROM cache_entries ORDER BY expires LIMIT ?)',
+                (surplus,)
+            )
+
+    def delete(self, key):
+        with self._connect() as conn:
+            conn.execute('DELETE FROM cache_entries WHERE key = ?', (key,))
+
+    def clear(self):
+        with self._connect() as conn:
+            conn.execute('DELETE FROM cache_entries')
+
+
+class PageCache(object):
+    """Store rendered responses in a backend, grouped by tags."""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self._pending = {}
+        self._wakeup = threading.Condition()
+        self._worker = None
+
+    def _generation(self, tag):
+        key = 'gen:' + tag
+        token = self.backend.get(key)
+        if token is None:
+            token = uuid.uuid4().hex
+            self.backend.set(key, token)
+        return token
+
+    def key_for(self, request, tags):
+        """Build the cache key for a request to a page with ``tags``."""
+        params = sorted(request.GET.items())
+        generations = [self._generation(tag) for tag in tags]
+        return 'page:{}:{!r}:{}:{}'.format(
+            request.matched_route.name if request.matched_route else '',
+            params,
+            request.authenticated_userid or '',
+            ','.join(generations),
+        )
+
+    def invalidate(self, *tags):
+        """Make every page that depends on any of ``tags`` stale."""
+        for tag in tags:
+            self.backend.set('gen:' + tag, uuid.uuid4().hex)
+
+    def invalidate_later(self, delay, *tags):
+        """Invalidate ``tags`` again once ``delay`` seconds have passed.
+
+        One background thread does this for every write; a tag that is
+        already waiting is invalidated once, at the later deadline.
+        """
+        deadline = time.time() + delay
+        with self._wakeup:
+            for tag in tags:
+                self._pending[tag] = max(deadline, self._pending.get(tag, 0))
+            if self._worker is None:
+                self._worker = threading.Thread(
+                    target=self._invalidate_pending,
+                    name='page-cache-invalidator')
+                self._worker.daemon = True
+                self._worker.start()
+            self._wakeup.notify()
+
+    def _invalidate_pending(self):
+        while True:
+            with self._wakeup:
+                while not self._pending:
+                    self._wakeup.wait()
+                now = time.time()
+                due = [tag for tag, deadline in self._pending.items()
+                       if deadline <= now]
+                if not due:
+                    self._wakeup.wait(min(self._pending.values()) - now)
+                    continue
+                for tag in due:
+                    del self._pending[tag]
+            self.invalidate(*due)
+
+
+def cache_page(*tags):
+    """View decorator caching the rendered response of a GET request.
+
+    Each tag is formatted with the request's matchdict, so
+    ``cache_page('entry:{id}')`` ties a page to the entry it shows.
+    Clients that have just written, and so read from the primary, skip
+    the cache, which may still hold pages built from a lagging replica.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(context, request):
+            cache = request.registry.get('page_cache')
+            if cache is None or request.method != 'GET':
+                return view(context, request)
+            policy = request.registry.get('replica_policy')
+            if policy is not None and policy.is_sticky(request):
+                return view(context, request)
+            key = cache.key_for(
+                request, [tag.format(**request.matchdict) for tag in tags]
+            )
+            cached = cache.backend.get(key)
+            if cached is not None:
+                status, headerlist, body = cached
+                # Let webob answer revalidations with a 304 from the
+                # ETag/Last-Modified stored alongside the page.
+                return Response(
+                    body=body, status=status, headerlist=list(headerlist),
+                    conditional_response=True,
+                )
+            response = view(context, request)
+            cacheable = 'Set-Cookie' not in response.headers
+            if response.status_int == 200 and cacheable:
+                cache.backend.set(
+                    key, (response.status, response.headerlist, response.body)
+                )
+            return response
+        return wrapper
+    return decorator
+
+
+def invalidate_after_commit(request, *tags):
+    """Invalidate ``tags`` once the request's transaction commits.
+
+    With read replicas, pages rebuilt from a replica that has not caught
+    up yet would be cached stale, so the tags are invalidated again once
+    ``replicas.sticky_seconds`` have passed.
+    """
+    cache = request.registry.get('page_cache')
+    if cache is None:
+        return
+    policy = request.registry.get('replica_policy')
+
+    def hook(success):
+        if not success:
+            return
+        cache.invalidate(*tags)
+        if policy is not None:
+            cache.invalidate_later(policy.sticky_seconds, *tags)
+    request.tm.get().addAfterCommitHook(hook)
+
+
+def get_backend(settings):
+    """Build the cache backend named by the ``cache.*`` settings."""
+    name = settings.get('cache.backend', 'none')
+    max_entries = int(settings.get('cache.max_entries', DEFAULT_MAX_ENTRIES))
+    ttl = int(settings.get('cache.ttl', DEFAULT_TTL))
+    if name == 'memory':
+        return MemoryBackend(max_entries=max_entries, ttl=ttl)
+    if name == 'sqlite':
+        path = settings.get('cache.path') or os.path.join(
+            os.getcwd(), 'page_cache.sqlite'
+        )
+        return SQLiteBackend(path, max_entries=max_entries, ttl=ttl)
+    if name in ('none', ''):
+        return None
+    raise ValueError('Unknown cache.backend: {}'.format(name))
+
+
+def includeme(config):
+    """Set up the page cache from the app settings.
+
+    Activate this setup using ``config.include('learning_journal.cache')``.
+    """
+    backend = get_backend(config.get_settings())
+    config.registry['page_cache'] = PageCache(backend) if backend else None
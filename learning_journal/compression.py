@@ -0,0 +1,204 @@
+"""Compress responses on the way out.
+
+A tween gzips (or, with the ``brotli`` package installed, brotli
+compresses) responses whose content type is in ``compression.types``,
+when the client accepts it. Responses smaller than
+``compression.min_size`` bytes are left alone, as are ones that already
+have a Content-Encoding, like the precompressed static files. Bodies up
+to ``compression.stream_threshold`` bytes are compressed in one go;
+larger ones, and streamed ones of unknown length, are compressed chunk
+by chunk as they are sent. Sizes, ratios and time spent go into the
+instrumentation metrics.
+"""
+
+
+import time
+import zlib
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+from pyramid.settings import asbool, aslist
+
+from .assets import accepted_encodings
+
+DEFAULT_TYPES = (
+    'text/html', 'text/css', 'text/plain', 'text/xml', 'text/csv',
+    'text/javascript', 'application/javascript', 'application/json',
+    'application/xml', 'application/atom+xml', 'image/svg+xml',
+)
+DEFAULT_MIN_SIZE = 1024
+DEFAULT_STREAM_THRESHOLD = 256 * 1024
+DEFAULT_LEVEL = 6
+DEFAULT_BROTLI_QUALITY = 5
+
+
+class Compressor(object):
+    """Incremental compression with one encoding, gzip or brotli."""
+
+    def __init__(self, encoding, level=DEFAULT_LEVEL,
+                 quality=DEFAULT_BROTLI_QUALITY):
+        self.encoding = encoding
+        if encoding == 'br':
+            self._compressor = brotli.Compressor(quality=quality)
+            self._compress = self._compressor.process
+        else:
+            # wbits 16 + MAX_WBITS writes a gzip header and trailer.
+            self._compressor = zlib.compressobj(
+                level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            self._compress = self._compressor.compress
+
+    def compress(self, data):
+        return self._compress(data)
+
+    def flush(self):
+        if self.encoding == 'br':
+            return self._compressor.finish()
+        return self._compressor.flush()
+
+
+class CompressionStats(object):
+    """Record what compressing one response cost and saved."""
+
+    def __init__(self, metrics, encoding, route):
+        self.metrics = metrics
+        self.labels = {'encoding': encoding, 'route': route}
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.seconds = 0.0
+
+    def timed(self, func, data=None):
+        started = time.time()
+        output = func(data) if data is not None else func()
+        self.seconds += time.time() - started
+        self.bytes_in += len(data or b'')
+        self.bytes_out += len(output)
+        return output
+
+    def record(self):
+        if self.metrics is None:
+            return
+        self.metrics.inc('journal_compression_bytes_in_total',
+                         self.bytes_in, **self.labels)
+        self.metrics.inc('journal_compression_bytes_out_total',
+                         self.bytes_out, **self.labels)
+        self.metrics.observe('journal_compression_seconds', self.seconds,
+                             **self.labels)
+        if self.bytes_in:
+            self.metrics.observe('journal_compression_ratio',
+                                 float(self.bytes_out) / self.bytes_in,
+                                 **self.labels)
+
+
+def stream_compressed(app_iter, compressor, stats):
+    """Compress ``app_iter`` chunk by chunk, closing it when done."""
+    try:
+        for chunk in app_iter:
+            if chunk:
+                output = stats.timed(compressor.compress, chunk)
+                if output:
+                    yield output
+        yield stats.timed(compressor.flush)
+    finally:
+        stats.record()
+        close = getattr(app_iter, 'close', None)
+        if close is not None:
+            close()
+
+
+class CompressionPolicy(object):
+    """The ``compression.*`` settings and the choices they lead to."""
+
+    def __init__(self, settings):
+        self.types = frozenset(
+            aslist(settings.get('compression.types', ''))
+            or DEFAULT_TYPES)
+        self.min_size = int(
+            settings.get('compression.min_size', DEFAULT_MIN_SIZE))
+        self.stream_threshold = int(settings.get(
+            'compression.stream_threshold', DEFAULT_STREAM_THRESHOLD))
+        self.level = int(settings.get('compression.level', DEFAULT_LEVEL))
+        self.brotli_quality = int(settings.get(
+            'compression.brotli_quality', DEFAULT_BROTLI_QUALITY))
+        self.use_brotli = brotli is not None and asbool(
+            settings.get('compression.brotli', True))
+
+    def applies_to(self, request, response):
+        """Whether ``response`` is worth compressing at all."""
+        if request.method == 'HEAD' or response.status_int in (204, 304):
+            return False
+        if response.content_encoding:
+            return False
+        if response.content_type not in self.types:
+            return False
+        if 'no-transform' in response.headers.get('Cache-Control', ''):
+            return False
+        length = response.content_length
+        return length is None or length >= self.min_size
+
+    def choose_encoding(self, request):
+        """The best encoding the client accepts, or None."""
+        accepted = accepted_encodings(request.headers.get('Accept-Encoding'))
+        if self.use_brotli and 'br' in accepted:
+            return 'br'
+        if 'gzip' in accepted:
+            return 'gzip'
+        return None
+
+
+def compress_response(response, encoding, policy, stats):
+    """Compress ``response`` in place, streaming it if it is large."""
+    compressor = Compressor(encoding, policy.level, policy.brotli_quality)
+    length = response.content_length
+    if length is not None and length <= policy.stream_threshold:
+        body = stats.timed(compressor.compress, response.body)
+        body += stats.timed(compressor.flush)
+        stats.record()
+        response.body = body
+    else:
+        response.app_iter = stream_compressed(
+            response.app_iter, compressor, stats)
+        response.content_length = None
+    response.content_encoding = encoding
+    # The compressed bytes differ from the identity ones, so a strong
+    # validator would be wrong; a weak one still matches revalidations.
+    etag = response.headers.get('ETag')
+    if etag and not etag.startswith('W/'):
+        response.headers['ETag'] = 'W/' + etag
+
+
+def compression_tween_factory(handler, registry):
+    """Compress eligible responses for clients that accept it."""
+    policy = CompressionPolicy(registry.settings or {})
+    metrics = registry.get('metrics')
+
+    def compression_tween(request):
+        response = handler(request)
+        if not policy.applies_to(request, response):
+            return response
+        vary = tuple(response.vary or ())
+        if 'Accept-Encoding' not in vary:
+            response.vary = vary + ('Accept-Encoding',)
+        encoding = policy.choose_encoding(request)
+        if encoding is None:
+            return response
+        route = request.matched_route
+        route = route.name if route is not None else 'none'
+        compress_response(response, encoding, policy,
+                          CompressionStats(metrics, encoding, route))
+        return response
+    return compression_tween
+
+
+def includeme(config):
+    """Compress responses when ``compression.enabled`` is on.
+
+    Activate this setup using
+    ``config.include('learning_journal.compression')`` after
+    ``learning_journal.instrumentation``, so it wraps the timing tween.
+    """
+    if asbool(config.get_settings().get('compression.enabled', False)):
+        config.add_tween(
+            'learning_journal.compression.compression_tween_factory')
@@ -0,0 +1,59 @@
+"""Conditional GET support: validators on responses and 304 short-cuts.
+
+Views compute an ETag and Last-Modified time from cheap, indexed columns
+and call ``not_modified`` before loading anything else, so a revalidation
+by a client that already has the page never reaches the template.
+"""
+
+
+import calendar
+import hashlib
+import time
+
+from pyramid.httpexceptions import HTTPNotModified
+from webob.datetime_utils import parse_date
+from webob.etag import ETagMatcher
+
+VALIDATOR_HEADERS = ('ETag', 'Last-Modified', 'Vary')
+
+
+def make_etag(*parts):
+    """Hash ``parts`` into a strong entity tag."""
+    return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()
+
+
+def to_timestamp(local_dt):
+    """Turn one of our naive local datetimes into a Unix timestamp."""
+    return int(time.mktime(local_dt.timetuple()))
+
+
+def not_modified(request, etag, last_modified=None):
+    """Set validators on the response and check the request against them.
+
+    Returns an ``HTTPNotModified`` to send back if the client's copy is
+    still fresh, or None if the view should go on to build the page.
+    ``last_modified`` is a naive local datetime.
+    """
+    response = request.response
+    response.etag = etag
+    response.vary = ('Cookie',)
+    if last_modified is not None:
+        response.last_modified = to_timestamp(last_modified)
+
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match:
+        # If-None-Match uses weak comparison, and the compression tween
+        # sends our tags weakened when it gzips a page.
+        fresh = etag in ETagMatcher.parse(if_none_match, strong=False)
+    else:
+        since = parse_date(request.headers.get('If-Modified-Since'))
+        fresh = (
+            since is not None and last_modified is not None and
+            to_timestamp(last_modified) <= calendar.timegm(since.utctimetuple())
+        )
+    if not fresh:
+        return None
+    return HTTPNotModified(headers=[
+        (name, value) for name, value in response.headerlist
+        if name in VALIDATOR_HEADERS
+    ])
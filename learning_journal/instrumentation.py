@@ -0,0 +1,331 @@
+"""Request timing, SQL and template instrumentation.
+
+A tween times every request and files the result under its route name,
+SQLAlchemy engine events count and time the queries each request runs,
+and a pair of view derivers around Pyramid's renderer measure how long
+templates take to render; ``learning_journal.compression`` adds what
+compressing responses saved and cost. Requests slower than
+``instrumentation.slow_request_ms`` are logged. Everything is served in
+Prometheus' text format at ``/metrics``.
+"""
+
+
+import logging
+import threading
+import time
+from bisect import bisect_left
+from collections import OrderedDict
+from inspect import isgenerator
+
+from pyramid.interfaces import IResponse
+from sqlalchemy import event
+
+log = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+FAST_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1
+)
+RATIO_BUCKETS = (0.05, 0.1, 0.15, 0.2, 0.3, 0.4, 0.5, 0.7, 0.9, 1.0)
+DEFAULT_SLOW_REQUEST_MS = 500
+
+_local = threading.local()
+
+
+class Histogram(object):
+    """Counts of observed values falling in each bucket."""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+
+class MetricsRegistry(object):
+    """Thread safe store of counters and histograms, grouped by labels."""
+
+    def __init__(self):
+        self._families = OrderedDict()
+        self._lock = threading.Lock()
+
+    def counter(self, name, help_text):
+        self._families[name] = ('counter', help_text, None, {})
+
+    def histogram(self, name, help_text, buckets=LATENCY_BUCKETS):
+        self._families[name] = ('histogram', help_text, buckets, {})
+
+    def inc(self, name, amount=1, **labels):
+        series = self._families[name][3]
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series[key] = series.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        kind, _, buckets, series = self._families[name]
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            if key not in series:
+                series[key] = Histogram(buckets)
+            series[key].observe(value)
+
+    def render(self):
+        """Format every metric in the Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            for name, (kind, help_text, _, series) in self._families.items():
+                lines.append('# HELP {} {}'.format(name, help_text))
+                lines.append('# TYPE {} {}'.format(name, kind))
+                for key, value in sorted(series.items()):
+                    if kind == 'counter':
+                        lines.append(_sample(name, key, value))
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(value.buckets, value.counts):
+                        cumulative += count
+                        lines.append(_sample(
+                            name + '_bucket', key + (('le', repr(bound)),),
+                            cumulative))
+                    lines.append(_sample(
+                        name + '_bucket', key + (('le', '+Inf'),), value.count))
+                    lines.append(_sample(name + '_sum', key, value.sum))
+                    lines.append(_sample(name + '_count', key, value.count))
+        return '\n'.join(lines) + '\n'
+
+
+def _sample(name, labels, value):
+    if labels:
+        name += '{' + ','.join(
+            '{}="{}"'.format(label, str(text).replace('"', '\\"'))
+            for label, text in labels
+        ) + '}'
+    return '{} {}'.format(name, value)
+
+
+class RequestStats(object):
+    """What the request currently served by this thread has spent."""
+
+    def __init__(self):
+        self.sql_queries = 0
+        self.sql_seconds = 0.0
+        self.view_finished = None
+        self.rendered = False
+        self.render_seconds = 0.0
+
+
+def current_stats():
+    """The stats of the request this thread is serving, if any."""
+    return getattr(_local, 'stats', None)
+
+
+def instrument_engine(engine):
+    """Count and time every query the engine runs for a request."""
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context,
+                              executemany):
+        conn.info.setdefault('query_started', []).append(time.time())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context,
+                             executemany):
+        started = conn.info['query_started'].pop()
+        stats = current_stats()
+        if stats is not None:
+            stats.sql_queries += 1
+            stats.sql_seconds += time.time() - started
+
+
+class MeteredBody(object):
+    """A streamed response body that keeps its request's stats current.
+
+    Queries run while the server reads the body, on whichever thread
+    reads it, are counted with the request's, and ``finish`` records
+    them all once the server closes the body.
+    """
+
+    def __init__(self, app_iter, stats, finish):
+        self.app_iter = app_iter
+        self.stats = stats
+        self.finish = finish
+        self._iterator = None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        previous, _local.stats = current_stats(), self.stats
+        try:
+            if self._iterator is None:
+                self._iterator = iter(self.app_iter)
+            return next(self._iterator)
+        finally:
+            _local.stats = previous
+
+    def close(self):
+        previous, _local.stats = current_stats(), self.stats
+        try:
+            close = getattr(self.app_iter, 'close', None)
+            if close is not None:
+                close()
+        finally:
+            _local.stats = previous
+            self.finish()
+
+
+def timing_tween_factory(handler, registry):
+    """Time each request and record it under its route name.
+
+    A streamed response is recorded when the server closes its body, so
+    the queries and time spent producing the body are included.
+    """
+    metrics = registry['metrics']
+    settings = registry.settings or {}
+    slow_seconds = float(settings.get(
+        'instrumentation.slow_request_ms', DEFAULT_SLOW_REQUEST_MS)) / 1000
+
+    def record(request, stats, started, status):
+        elapsed = time.time() - started
+        route = request.matched_route
+        route = route.name if route is not None else 'none'
+        metrics.inc('journal_requests_total', route=route,
+                    method=request.method, status=status)
+        metrics.observe('journal_request_duration_seconds', elapsed,
+                        route=route, method=request.method)
+        metrics.observe('journal_request_sql_queries', stats.sql_queries,
+                        route=route)
+        metrics.observe('journal_request_sql_seconds', stats.sql_seconds,
+                        route=route)
+        if stats.rendered:
+            metrics.observe('journal_template_render_seconds',
+                            stats.render_seconds, route=route)
+        if elapsed >= slow_seconds:
+            metrics.inc('journal_slow_requests_total', route=route)
+            log.warning(
+                'Slow request: %s %s (route %s) took %.0fms, '
+                '%d queries in %.0fms, rendering %.0fms',
+                request.method, request.path, route, elapsed * 1000,
+                stats.sql_queries, stats.sql_seconds * 1000,
+                stats.render_seconds * 1000)
+
+    def timing_tween(request):
+        stats = _local.stats = RequestStats()
+        started = time.time()
+        status = 500
+        try:
+            response = handler(request)
+            status = response.status_int
+        except Exception:
+            record(request, stats, started, status)
+            raise
+        finally:
+            _local.stats = None
+        if not isgenerator(response.app_iter):
+            record(request, stats, started, status)
+            return response
+        # Generated bodies run their code, queries included, as the
+        # server reads them; file bodies are left alone for sendfile.
+        length = response.content_length
+        response.app_iter = MeteredBody(
+            response.app_iter, stats,
+            lambda: record(request, stats, started, status))
+        response.content_length = length
+        return response
+    return timing_tween
+
+
+def view_timer(view, info):
+    """View deriver, inside the renderer, noting when the view returned."""
+    def timed_view(context, request):
+        result = view(context, request)
+        stats = current_stats()
+        if stats is not None and not IResponse.providedBy(result):
+            stats.view_finished = time.time()
+        return result
+    return timed_view
+
+
+def render_timer(view, info):
+    """View deriver, outside the renderer, timing the render step."""
+    def timed_render(context, request):
+        response = view(context, request)
+        stats = current_stats()
+        if stats is not None and stats.view_finished is not None:
+            stats.render_seconds += time.time() - stats.view_finished
+            stats.view_finished = None
+            stats.rendered = True
+        return response
+    return timed_render
+
+
+POOL_COUNTERS = frozenset(['connects', 'checkouts', 'waits',
+                           'wait_seconds_total'])
+
+
+def pool_metrics_text(snapshot):
+    """Format a PoolMetrics snapshot as Prometheus gauges and counters."""
+    lines = []
+    for name, value in sorted(snapshot.items()):
+        if value is None:
+            continue
+        kind = 'gauge'
+        if name in POOL_COUNTERS:
+            kind = 'counter'
+            if not name.endswith('_total'):
+                name += '_total'
+        lines.append('# TYPE journal_db_pool_{} {}'.format(name, kind))
+        lines.append('journal_db_pool_{} {}'.format(name, value))
+    return '\n'.join(lines) + '\n'
+
+
+def create_metrics():
+    """Build a registry declaring every metric the app records."""
+    metrics = MetricsRegistry()
+    metrics.counter('journal_requests_total', 'Requests served.')
+    metrics.histogram('journal_request_duration_seconds',
+                      'Time spent serving a request.')
+    metrics.histogram('journal_request_sql_queries',
+                      'SQL queries run per request.', COUNT_BUCKETS)
+    metrics.histogram('journal_request_sql_seconds',
+                      'Time spent in SQL per request.')
+    metrics.histogram('journal_template_render_seconds',
+                      'Time spent rendering templates per request.')
+    metrics.counter('journal_slow_requests_total',
+                    'Requests slower than instrumentation.slow_request_ms.')
+    metrics.counter('journal_compression_bytes_in_total',
+                    'Response bytes before compression.')
+    metrics.counter('journal_compression_bytes_out_total',
+                    'Response bytes after compression.')
+    metrics.histogram('journal_compression_ratio',
+                      'Compressed size over original size per response.',
+                      RATIO_BUCKETS)
+    metrics.histogram('journal_compression_seconds',
+                      'Time spent compressing per response.', FAST_BUCKETS)
+    return metrics
+
+
+def includeme(config):
+    """Set up request, SQL and template instrumentation.
+
+    Activate this setup using
+    ``config.include('learning_journal.instrumentation')`` after the
+    models have been included.
+    """
+    config.registry['metrics'] = create_metrics()
+    factory = config.registry['dbsession_factory']
+    instrument_engine(factory.kw['bind'])
+    for replica in getattr(factory.kw.get('replicas'), 'engines', ()):
+        instrument_engine(replica)
+    config.add_view_deriver(view_timer, under='rendered_view',
+                            over='mapped_view')
+    config.add_view_deriver(render_timer)
+    config.add_tween('learning_journal.instrumentation.timing_tween_factory')
@@ -0,0 +1,447 @@
+"""Previous/next and related-entry links for the detail page.
+
+``entry_links`` holds, for every entry, the entries written just before
+and after it and the ``links.related_count`` entries whose bodies are
+most alike, by cosine similarity of their TF-IDF weighted terms, so the
+detail page reads all of its navigation, titles included, with one
+indexed query. ``rebuild_links`` computes the whole table in a batch
+(see the ``linkdb2`` script); writes keep it current with
+``refresh_links``, which only touches the entries around the ones
+written.
+
+Entries indexed between rebuilds are weighted with the document
+frequencies of the time, so related links drift slowly as the journal
+grows until the next rebuild.
+
+The TF-IDF index lives in process memory. The app builds it at startup,
+before any pre-forked workers are started, and each write first adds the
+entries other processes have written since (by ``updated_at``), so every
+worker finds related entries among the whole journal.
+"""
+
+
+import heapq
+import logging
+import math
+import threading
+from collections import Counter, defaultdict, namedtuple
+from operator import itemgetter
+
+from sqlalchemy import and_, bindparam, func, or_, select, tuple_
+
+from .cache import invalidate_after_commit
+from .models import Entry, EntryLink
+from .search import CATCH_UP_OVERLAP, tokenize
+
+log = logging.getLogger(__name__)
+
+PREVIOUS, NEXT, RELATED = u'previous', u'next', u'related'
+DEFAULT_RELATED_COUNT = 5
+# Candidates are found through the posting lists of an entry's strongest
+# terms only, then ranked on their full vectors.
+QUERY_TERMS = 20
+CANDIDATES_PER_LINK = 4
+
+LinkTarget = namedtuple('LinkTarget', 'id title')
+Links = namedtuple('Links', 'previous next related')
+
+
+def get_related_count(settings):
+    return max(int((settings or {}).get(
+        'links.related_count', DEFAULT_RELATED_COUNT)), 0)
+
+
+class TfidfIndex(object):
+    """Unit length TF-IDF vectors of entry bodies, with posting lists."""
+
+    def __init__(self):
+        self._vectors = {}
+        self._postings = defaultdict(dict)
+        self._frequencies = Counter()
+        self._lock = threading.Lock()
+        # The newest updated_at of the entries indexed from the database.
+        self.seen = None
+
+    def __len__(self):
+        return len(self._vectors)
+
+    @classmethod
+    def build(cls, rows):
+        """Index ``(id, body)`` rows, weighted by their final frequencies."""
+        index = cls()
+        terms = {}
+        for entry_id, body in rows:
+            terms[entry_id] = Counter(tokenize(body))
+            index._frequencies.update(terms[entry_id].keys())
+        for entry_id, counts in terms.items():
+            index._store(entry_id, index._weigh(counts, len(terms)))
+        return index
+
+    def _weigh(self, counts, documents):
+        vector = {}
+        for term, count in counts.items():
+            idf = math.log((1.0 + documents) /
+                           (1 + self._frequencies[term])) + 1
+            vector[term] = (1 + math.log(count)) * idf
+        norm = math.sqrt(sum(weight * weight for weight in vector.values()))
+        return dict((term, weight / norm) for term, weight in vector.items())
+
+    def _store(self, entry_id, vector):
+        self._vectors[entry_id] = vector
+        for term, weight in vector.items():
+            self._postings[term][entry_id] = weight
+
+    def _remove(self, entry_id):
+        vector = self._vectors.pop(entry_id, None)
+        if vector is None:
+            return
+        for term in vector:
+            self._frequencies[term] -= 1
+            postings = self._postings[term]
+            del postings[entry_id]
+            if not postings:
+                del self._postings[term]
+
+    def vector(self, body):
+        """The weights of a body, without indexing it."""
+        with self._lock:
+            return self._weigh(Counter(tokenize(body)), len(self._vectors))
+
+    def add(self, entry_id, body):
+        """Index an entry, replacing anything indexed for it before."""
+        counts = Counter(tokenize(body))
+        with self._lock:
+            self._remove(entry_id)
+            self._frequencies.update(counts.keys())
+            self._store(entry_id,
+                        self._weigh(counts, len(self._vectors) + 1))
+
+    def remove(self, entry_id):
+        with self._lock:
+            self._remove(entry_id)
+
+    def similar(self, vector, limit, exclude=()):
+        """The ``limit`` ``(id, score)`` most like ``vector``, best first."""
+        query = heapq.nlargest(QUERY_TERMS, vector.items(),
+                               key=itemgetter(1))
+        scores = defaultdict(float)
+        with self._lock:
+            for term, weight in query:
+                for entry_id, other in self._postings.get(term, {}).items():
+                    scores[entry_id] += weight * other
+            for entry_id in exclude:
+                scores.pop(entry_id, None)
+            candidates = heapq.nlargest(
+                limit * CANDIDATES_PER_LINK, scores, key=scores.get)
+            ranked = [(dot(vector, self._vectors[entry_id]), entry_id)
+                      for entry_id in candidates]
+        return [(entry_id, score)
+                for score, entry_id in heapq.nlargest(limit, ranked)
+                if score > 0]
+
+    def all_similar(self, limit):
+        """Yield ``(id, [(id, score), ...])`` for every indexed entry."""
+        for entry_id, vector in list(self._vectors.items()):
+            yield entry_id, self.similar(vector, limit, exclude=[entry_id])
+
+
+def dot(first, second):
+    if len(second) < len(first):
+        first, second = second, first
+    return sum(weight * second.get(term, 0.0)
+               for term, weight in first.items())
+
+
+def load_index(conn):
+    """Build a TF-IDF index of every entry in the database."""
+    table = Entry.__table__
+    seen = conn.execute(select([func.max(table.c.updated_at)])).scalar()
+    index = TfidfIndex.build(conn.execute(
+        select([table.c.id, table.c.body])))
+    index.seen = seen
+    return index
+
+
+def catch_up(conn, index):
+    """Index the entries written since ``index`` was last brought up to date.
+
+    Returns how many entries were (re)indexed.
+    """
+    if index.seen is None:
+        return 0
+    table = Entry.__table__
+    rows = conn.execute(select(
+        [table.c.id, table.c.body, table.c.updated_at]
+    ).where(table.c.updated_at > index.seen - CATCH_UP_OVERLAP)).fetchall()
+    for entry_id, body, _ in rows:
+        index.add(entry_id, body)
+    if rows:
+        index.seen = max(index.seen, max(row[2] for row in rows))
+    return len(rows)
+
+
+def build_index(registry):
+    """Build the related-entry index into ``registry`` at startup.
+
+    Failures are logged, not raised: the first write builds it instead.
+    """
+    if not get_related_count(registry.settings):
+        return None
+    engine = registry['dbsession_factory'].kw['bind']
+    try:
+        with engine.connect() as conn:
+            index = registry['related_index'] = load_index(conn)
+    except Exception:
+        log.exception('Could not build the related-entry index')
+        return None
+    return index
+
+
+_index_lock = threading.Lock()
+
+
+def get_index(request):
+    """Return this process's TF-IDF index, caught up with the database.
+
+    The index is normally built at startup by ``build_index``; apps set
+    up some other way build it here, on first use.
+    """
+    conn = request.dbsession.connection()
+    index = request.registry.get('related_index')
+    if index is None:
+        with _index_lock:
+            index = request.registry.get('related_index')
+            if index is None:
+                index = request.registry['related_index'] = load_index(conn)
+                return index
+    catch_up(conn, index)
+    return index
+
+
+def link(entry_id, kind, target_id, score=None):
+    return {'entry_id': entry_id, 'kind': kind, 'target_id': target_id,
+            'score': score}
+
+
+def chain(entry_ids):
+    """Previous/next links between ids given in date order."""
+    for earlier, later in zip(entry_ids, entry_ids[1:]):
+        yield link(earlier, NEXT, later)
+        yield link(later, PREVIOUS, earlier)
+
+
+def insert_links(conn, links, batch_size=1000):
+    links = list(links)
+    for start in range(0, len(links), batch_size):
+        conn.execute(EntryLink.__table__.insert(),
+                     links[start:start + batch_size])
+
+
+def rebuild_links(conn, related_count=DEFAULT_RELATED_COUNT,
+                  batch_size=1000):
+    """Recompute every entry's links, for bulk loads and nightly runs.
+
+    Returns the TF-IDF index built on the way.
+    """
+    table = Entry.__table__
+    seen = conn.execute(select([func.max(table.c.updated_at)])).scalar()
+    result = conn.execution_options(stream_results=True).execute(
+        select([table.c.id, table.c.body]).order_by(
+            table.c.creation_date, table.c.id))
+    order = []
+
+    def rows():
+        while True:
+            batch = result.fetchmany(batch_size)
+            if not batch:
+                return
+            for entry_id, body in batch:
+                order.append(entry_id)
+                yield entry_id, body
+    index = TfidfIndex.build(rows())
+    index.seen = seen
+    conn.execute(EntryLink.__table__.delete())
+    insert_links(conn, chain(order), batch_size)
+    if related_count:
+        insert_links(conn, (
+            link(entry_id, RELATED, target_id, score)
+            for entry_id, related in index.all_similar(related_count)
+            for target_id, score in related
+        ), batch_size)
+    return index
+
+
+def entry_before(conn, start):
+    """The id of the entry just before sort key ``start``, or None."""
+    entries = Entry.__table__
+    return conn.execute(
+        select([entries.c.id]).where(
+            tuple_(entries.c.creation_date, entries.c.id) < tuple_(*start)
+        ).order_by(
+            entries.c.creation_date.desc(), entries.c.id.desc()).limit(1)
+    ).scalar()
+
+
+def relink_order(conn, start):
+    """Rechain every entry from sort key ``start`` on, and the one before.
+
+    The entry before is locked first, so concurrent writes chaining new
+    entries in after it take turns: the later one waits, then finds the
+    entry the earlier one committed in between and chains in after that.
+
+    Returns the ids whose previous/next links were rewritten.
+    """
+    entries, links = Entry.__table__, EntryLink.__table__
+    sort_key = tuple_(entries.c.creation_date, entries.c.id)
+    before = entry_before(conn, start)
+    while before is not None:
+        conn.execute(select([entries.c.id]).where(
+            entries.c.id == before).with_for_update())
+        locked, before = before, entry_before(conn, start)
+        if before == locked:
+            break
+    ids = [row[0] for row in conn.execute(
+        select([entries.c.id]).where(sort_key >= tuple_(*start)).order_by(
+            entries.c.creation_date, entries.c.id))]
+    if before is not None:
+        ids.insert(0, before)
+    # The entry before keeps its own previous link.
+    followers = ids[1:] if before is not None else ids
+    conn.execute(links.delete().where(or_(
+        and_(links.c.entry_id.in_(ids), links.c.kind == NEXT),
+        and_(links.c.entry_id.in_(followers), links.c.kind == PREVIOUS),
+    )))
+    insert_links(conn, chain(ids))
+    return ids
+
+
+def related_lists(conn, entry_ids):
+    """``{id: {target_id: score}}`` for those of ``entry_ids`` that exist."""
+    entries, links = Entry.__table__, EntryLink.__table__
+    found = {}
+    for entry_id, target_id, score in conn.execute(
+            select([entries.c.id, links.c.target_id, links.c.score])
+            .select_from(entries.outerjoin(links, and_(
+                links.c.entry_id == entries.c.id, links.c.kind == RELATED)))
+            .where(entries.c.id.in_(entry_ids))):
+        related = found.setdefault(entry_id, {})
+        if target_id is not None:
+            related[target_id] = score
+    return found
+
+
+def offer_related(conn, current, offers, count):
+    """Put ``(entry_id, target_id, score)`` offers into the related lists
+    of those entries, ``current`` as read by ``related_lists``, where they
+    make the top ``count``.
+
+    Returns the ids of the entries whose lists changed.
+    """
+    links = EntryLink.__table__
+    lists = dict((entry_id, dict(related))
+                 for entry_id, related in current.items())
+    for entry_id, target_id, score in offers:
+        related = lists[entry_id]
+        related[target_id] = score
+        if len(related) > count:
+            del related[min(related, key=related.get)]
+    deletes, inserts = [], []
+    for entry_id, new in lists.items():
+        old = current[entry_id]
+        deletes.extend(
+            {'link_entry_id': entry_id, 'link_target_id': target_id}
+            for target_id in old if new.get(target_id) != old[target_id])
+        inserts.extend(
+            link(entry_id, RELATED, target_id, score)
+            for target_id, score in new.items()
+            if old.get(target_id) != score)
+    if deletes:
+        conn.execute(links.delete().where(and_(
+            links.c.entry_id == bindparam('link_entry_id'),
+            links.c.kind == RELATED,
+            links.c.target_id == bindparam('link_target_id'),
+        )), deletes)
+    insert_links(conn, inserts)
+    return set(row['entry_id'] for row in inserts) | set(
+        row['link_entry_id'] for row in deletes)
+
+
+def refresh_links(request, rows, created=False):
+    """Relink entries just written in the request's transaction.
+
+    ``rows`` are the flushed ``(id, creation_date, body)`` of entries
+    that were all created (``created``) or all edited. New entries are
+    chained in among the entries around them. Every written entry gets
+    its related entries found again and is offered to their lists in
+    turn. The pages whose links changed are invalidated after the commit.
+    """
+    rows = list(rows)
+    if not rows:
+        return
+    conn = request.dbsession.connection()
+    links = EntryLink.__table__
+    ids = [entry_id for entry_id, _, _ in rows]
+    if created:
+        changed = set(relink_order(conn, min(
+            (creation_date, entry_id) for entry_id, creation_date, _ in rows)))
+    else:
+        # Pages linking to an edited entry show its title.
+        changed = set(row[0] for row in conn.execute(
+            select([links.c.entry_id]).where(links.c.target_id.in_(ids))))
+    count = get_related_count(request.registry.settings)
+    if count:
+        changed.update(relink_related(conn, get_index(request), rows, count))
+    invalidate_after_commit(
+        request, *['entry:{}'.format(entry_id) for entry_id in changed])
+
+
+def relink_related(conn, index, rows, count):
+    """Find the ``count`` related entries of the written ``rows`` again.
+
+    ``rows`` are ``(id, creation_date, body)``. Each is (re)added to
+    ``index`` and offered to the related lists of the entries it is like.
+
+    Returns the ids of the entries whose related links changed.
+    """
+    links = EntryLink.__table__
+    ids = [entry_id for entry_id, _, _ in rows]
+    related = {}
+    for entry_id, _, body in rows:
+        related[entry_id] = index.similar(
+            index.vector(body), count, [entry_id])
+        index.add(entry_id, body)
+    # The index is per process, and may hold entries from transactions
+    # that were rolled back, so only targets found in the database are
+    # linked.
+    current = related_lists(conn, set(
+        target_id for found in related.values()
+        for target_id, _ in found if target_id not in related))
+    conn.execute(links.delete().where(and_(
+        links.c.entry_id.in_(ids), links.c.kind == RELATED)))
+    insert_links(conn, (
+        link(entry_id, RELATED, target_id, score)
+        for entry_id, found in related.items()
+        for target_id, score in found
+        if target_id in current or target_id in related))
+    return set(ids) | offer_related(conn, current, [
+        (target_id, entry_id, score)
+        for entry_id, found in related.items()
+        for target_id, score in found if target_id in current
+    ], count)
+
+
+def entry_links(dbsession, entry_id):
+    """The ``Links`` shown on an entry's page, in one indexed query."""
+    rows = dbsession.query(
+        EntryLink.kind, Entry.id, Entry.title
+    ).join(Entry, Entry.id == EntryLink.target_id).filter(
+        EntryLink.entry_id == entry_id
+    ).order_by(EntryLink.score.desc(), Entry.id)
+    found = defaultdict(list)
+    for kind, target_id, title in rows:
+        found[kind].append(LinkTarget(target_id, title))
+    return Links(
+        found[PREVIOUS][0] if found[PREVIOUS] else None,
+        found[NEXT][0] if found[NEXT] else None,
+        found[RELATED],
+    )
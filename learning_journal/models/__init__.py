@@ -1,24 +1,82 @@
 from sqlalchemy import engine_from_config
+from sqlalchemy.engine.url import make_url
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy.orm import configure_mappers
+from pyramid.settings import asbool, aslist
 import zope.sqlalchemy
 
 # import or define all models here to ensure they are attached to the
 # Base.metadata prior to any initialization routines
-from .mymodel import Entry  # flake8: noqa
+from .mymodel import (  # flake8: noqa
+    Entry,
+    EntryLink,
+    EntryMonthCount,
+    EntryRevision,
+    EntrySummary,
+)
+from .pool import PoolMetrics, TimedQueuePool
+from .routing import ReplicaPolicy, ReplicaSet, RoutingSession
 
-# run configure_mappers after defining all of the models to ensure
-# all relationships can be setup
-configure_mappers()
+# Mappers are configured by SQLAlchemy on first use (the first query or
+# new instance) rather than here, keeping the cost out of every import;
+# the warm-up in ``learning_journal.main`` triggers it before serving.
+
+
+DEFAULT_THREADS = 4
 
 
 def get_engine(settings, prefix='sqlalchemy.'):
-    return engine_from_config(settings, prefix)
+    """
+    Build the engine from the ``sqlalchemy.*`` settings.
+
+    Unless ``sqlalchemy.pool_size`` is set, the pool holds one connection
+    per waitress thread (``server.threads``), so a busy server never waits
+    on its own pool. ``sqlalchemy.statement_timeout`` (milliseconds) is
+    applied to every PostgreSQL connection.
+
+    """
+    options = dict(
+        (key, value) for key, value in settings.items()
+        if key.startswith(prefix)
+    )
+    statement_timeout = options.pop(prefix + 'statement_timeout', None)
+    if prefix + 'pool_pre_ping' in options:
+        options[prefix + 'pool_pre_ping'] = asbool(
+            options[prefix + 'pool_pre_ping'])
+    backend = make_url(options[prefix + 'url']).get_backend_name()
+    kwargs = {}
+    if backend != 'sqlite':
+        options.setdefault(
+            prefix + 'pool_size',
+            settings.get('server.threads', DEFAULT_THREADS)
+        )
+        kwargs['poolclass'] = TimedQueuePool
+    if backend in ('postgres', 'postgresql') and statement_timeout:
+        kwargs['connect_args'] = {
+            'options': '-c statement_timeout={}'.format(int(statement_timeout))
+        }
+    engine = engine_from_config(options, prefix, **kwargs)
+    PoolMetrics().attach(engine)
+    return engine
+
+
+def get_replicas(settings):
+    """
+    Build an engine for each of the ``replicas.urls``, or return None.
+
+    Replicas share the primary's ``sqlalchemy.*`` pool settings.
 
+    """
+    urls = aslist(settings.get('replicas.urls', ''))
+    if not urls:
+        return None
+    return ReplicaSet(
+        get_engine(dict(settings, **{'sqlalchemy.url': url})) for url in urls
+    )
 
-def get_session_factory(engine):
-    factory = sessionmaker()
-    factory.configure(bind=engine)
+
+def get_session_factory(engine, replicas=None):
+    factory = sessionmaker(class_=RoutingSession)
+    factory.configure(bind=engine, replicas=replicas)
     return factory
 
 
@@ -65,13 +123,20 @@ def includeme(config):
     # use pyramid_retry to retry a request when transient exceptions occur
     config.include('pyramid_retry')
 
-    session_factory = get_session_factory(get_engine(settings))
+    engine = get_engine(settings)
+    replicas = get_replicas(settings)
+    session_factory = get_session_factory(engine, replicas)
     config.registry['dbsession_factory'] = session_factory
+    config.registry['pool_metrics'] = engine.pool.metrics
+    policy = ReplicaPolicy(settings) if replicas else None
+    config.registry['replica_policy'] = policy
+
+    def dbsession(request):
+        # request.tm is the transaction manager used by pyramid_tm
+        session = get_tm_session(session_factory, request.tm)
+        if policy is not None:
+            policy.route(request, session)
+        return session
 
     # make request.dbsession available for use in Pyramid
-    config.add_request_method(
-        # r.tm is the transaction manager used by pyramid_tm
-        lambda r: get_tm_session(session_factory, r.tm),
-        'dbsession',
-        reify=True
-    )
+    config.add_request_method(dbsession, 'dbsession', reify=True)
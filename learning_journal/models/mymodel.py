@@ -1,15 +1,35 @@
 from sqlalchemy import (
+    Boolean,
     Column,
+    DDL,
+    ForeignKey,
     Index,
     Integer,
     Unicode,
     DateTime,
+    Float,
+    event,
+    select,
 )
 
 from .meta import Base
+from ..rendering import make_excerpt, render_body
 from datetime import datetime, timedelta
 import calendar
 
+DATE_FORMAT = '%A, %B %d, %Y at %I:%M%p'
+
+# The document searched by /search on PostgreSQL. Queries must use this
+# exact expression for the planner to pick the GIN index below.
+SEARCH_VECTOR_SQL = (
+    "to_tsvector('english', coalesce(title, '') || ' ' || coalesce(body, ''))"
+)
+# Idempotent, so backfilldb2 can add it to existing PostgreSQL databases.
+SEARCH_INDEX_DDL = (
+    'CREATE INDEX IF NOT EXISTS ix_entries_search ON entries '
+    'USING gin ({})'.format(SEARCH_VECTOR_SQL)
+)
+
 
 def utc_to_local(utc_dt):
     """Set the proper timezone."""
@@ -29,6 +49,22 @@ class Entry(Base):
     title = Column(Unicode)
     body = Column(Unicode)
     creation_date = Column(DateTime)
+    updated_at = Column(DateTime)
+
+    # Derived from the columns above whenever they are written, so pages
+    # never have to sanitize, strip or format anything when reading.
+    body_html = Column(Unicode)
+    excerpt = Column(Unicode)
+    word_count = Column(Integer)
+    display_date = Column(Unicode)
+
+    __table_args__ = (
+        # Serves the newest-first keyset pagination of the home feed.
+        Index('ix_entries_creation_date_id', 'creation_date', 'id'),
+        # Finds the entries written since a process's in-memory indexes
+        # were last brought up to date.
+        Index('ix_entries_updated_at', 'updated_at'),
+    )
 
     def __init__(self, creation_date=None, *args, **kwargs):
         """Initialize a new journal entry with the current date & time."""
@@ -37,6 +73,25 @@ class Entry(Base):
             self.creation_date = utc_to_local(creation_date)
         else:
             self.creation_date = datetime.now()
+        self.updated_at = self.creation_date
+        self.refresh_derived()
+
+    @staticmethod
+    def derived_fields(body, creation_date):
+        """Compute the stored display fields for a body and date."""
+        body_html, text = render_body(body)
+        return {
+            'body_html': body_html,
+            'excerpt': make_excerpt(text),
+            'word_count': len(text.split()),
+            'display_date': creation_date.strftime(DATE_FORMAT),
+        }
+
+    def refresh_derived(self):
+        """Recompute the derived fields after the body or date changed."""
+        fields = self.derived_fields(self.body, self.creation_date)
+        for name, value in fields.items():
+            setattr(self, name, value)
 
     def to_dict(self):
         """Take all model attributes and render them as a dictionary."""
@@ -44,5 +99,116 @@ class Entry(Base):
             'id': self.id,
             'title': self.title,
             'body': self.body,
-            'creation_date': self.creation_date.strftime('%A, %B %d, %Y at %I:%M%p')
+            'creation_date': self.display_date
         }
+
+
+event.listen(
+    Entry.__table__,
+    'after_create',
+    DDL(SEARCH_INDEX_DDL).execute_if(dialect='postgresql')
+)
+
+
+class EntryRevision(Base):
+    """One saved version of an entry's title and body.
+
+    ``content`` is the full body for snapshots and a delta against the
+    previous revision otherwise (see ``learning_journal.revisions``).
+    """
+
+    __tablename__ = 'entry_revisions'
+    id = Column(Integer, primary_key=True)
+    entry_id = Column(Integer, ForeignKey('entries.id'), nullable=False)
+    number = Column(Integer, nullable=False)
+    title = Column(Unicode)
+    snapshot = Column(Boolean, nullable=False, default=False)
+    content = Column(Unicode)
+    created_at = Column(DateTime)
+
+    __table_args__ = (
+        Index('ix_entry_revisions_entry_id_number', 'entry_id', 'number',
+              unique=True),
+    )
+
+
+class EntryMonthCount(Base):
+    """How many entries were written in one calendar month.
+
+    Kept current by every write (see ``learning_journal.months``).
+    """
+
+    __tablename__ = 'entry_month_counts'
+    year = Column(Integer, primary_key=True, autoincrement=False)
+    month = Column(Integer, primary_key=True, autoincrement=False)
+    count = Column(Integer, nullable=False, default=0)
+
+
+class EntryLink(Base):
+    """A link on an entry's page to the entry before or after it, or to
+    one of the entries most like it.
+
+    Kept current by every write (see ``learning_journal.links``).
+    """
+
+    __tablename__ = 'entry_links'
+    entry_id = Column(Integer, ForeignKey('entries.id'), primary_key=True,
+                      autoincrement=False)
+    kind = Column(Unicode(8), primary_key=True)
+    target_id = Column(Integer, ForeignKey('entries.id'), primary_key=True,
+                       autoincrement=False)
+    # Cosine similarity of a related entry; empty for previous and next.
+    score = Column(Float)
+
+    __table_args__ = (
+        # Finds the pages linking to an entry whose title changed.
+        Index('ix_entry_links_target_id', 'target_id'),
+    )
+
+
+class EntrySummary(object):
+    """A bodiless, read-only entry for listing pages.
+
+    Built straight from column tuples, so listings never transfer the
+    ``body`` column or put full ``Entry`` objects in the identity map.
+    """
+
+    __slots__ = ('id', 'title', 'creation_date', 'updated_at', 'display_date')
+    columns = (
+        Entry.id, Entry.title, Entry.creation_date, Entry.updated_at,
+        Entry.display_date,
+    )
+
+    def __init__(self, id, title, creation_date, updated_at, display_date):
+        self.id = id
+        self.title = title
+        self.creation_date = creation_date
+        self.updated_at = updated_at
+        self.display_date = display_date
+
+    @classmethod
+    def query(cls, dbsession):
+        """Build a query selecting only the summary columns."""
+        return dbsession.query(*cls.columns)
+
+    @classmethod
+    def stream(cls, engine, batch_size=500):
+        """Yield every summary, newest first, from a server-side cursor.
+
+        Runs on a connection of its own, so it can outlive the request's
+        transaction while a streamed page is still being sent.
+        """
+        query = select(list(cls.columns)).order_by(
+            Entry.creation_date.desc(), Entry.id.desc())
+        conn = engine.connect()
+        try:
+            result = conn.execution_options(stream_results=True).execute(
+                query)
+            while True:
+                rows = result.fetchmany(batch_size)
+                if not rows:
+                    return
+                for row in rows:
+                    yield cls(*row)
+        finally:
+            conn.close()
@@ -0,0 +1,83 @@
+"""Connection pool instrumentation.
+
+``TimedQueuePool`` measures how long requests wait for a connection and
+``PoolMetrics`` keeps those numbers, together with checkout counts, for
+the monitoring endpoints.
+"""
+
+
+import threading
+import time
+
+from sqlalchemy import event
+from sqlalchemy.pool import QueuePool
+
+
+class PoolMetrics(object):
+    """Counters describing how an engine's pool is being used."""
+
+    def __init__(self):
+        self.connects = 0
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+        self._lock = threading.Lock()
+        self.engine = None
+
+    def attach(self, engine):
+        """Start counting connections made and checked out by ``engine``."""
+        self.engine = engine
+        engine.pool.metrics = self
+        event.listen(engine, 'connect', self._on_connect)
+        event.listen(engine, 'checkout', self._on_checkout)
+        return self
+
+    def _on_connect(self, dbapi_connection, connection_record):
+        with self._lock:
+            self.connects += 1
+
+    def _on_checkout(self, dbapi_connection, connection_record, proxy):
+        with self._lock:
+            self.checkouts += 1
+
+    def record_wait(self, seconds):
+        with self._lock:
+            self.waits += 1
+            self.wait_seconds_total += seconds
+            self.wait_seconds_max = max(self.wait_seconds_max, seconds)
+
+    def snapshot(self):
+        """Return the current pool state and counters as a dict."""
+        pool = self.engine.pool
+        sized = isinstance(pool, QueuePool)
+        with self._lock:
+            return {
+                'size': pool.size() if sized else None,
+                'checked_out': pool.checkedout() if sized else None,
+                'overflow': max(pool.overflow(), 0) if sized else None,
+                'connects': self.connects,
+                'checkouts': self.checkouts,
+                'waits': self.waits,
+                'wait_seconds_total': self.wait_seconds_total,
+                'wait_seconds_max': self.wait_seconds_max,
+            }
+
+
+class TimedQueuePool(QueuePool):
+    """A QueuePool that reports how long each checkout waited."""
+
+    metrics = None
+
+    def _do_get(self):
+        started = time.time()
+        try:
+            return super(TimedQueuePool, self)._do_get()
+        finally:
+            if self.metrics is not None:
+                self.metrics.record_wait(time.time() - started)
+
+    def recreate(self):
+        pool = super(TimedQueuePool, self).recreate()
+        pool.metrics = self.metrics
+        return pool
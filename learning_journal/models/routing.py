@@ -0,0 +1,115 @@
+"""Read-replica routing.
+
+With ``replicas.urls`` set, GET and HEAD requests to the routes in
+``replicas.routes`` read from one of the replica databases, picked round
+robin per request; everything else uses the primary, and so does a
+session from its first flush on.
+A client that has just sent a write gets a short-lived cookie, and reads
+from the primary until it expires (``replicas.sticky_seconds``), so it
+sees its own change even while the replicas catch up.
+"""
+
+
+import itertools
+import threading
+import time
+
+from pyramid.settings import aslist
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+PRIMARY_COOKIE = 'primary_until'
+DEFAULT_ROUTES = (
+    'home', 'detail', 'archive', 'feed', 'api_entries', 'api_entry',
+)
+DEFAULT_STICKY_SECONDS = 10
+SAFE_METHODS = ('GET', 'HEAD')
+
+
+class ReplicaSet(object):
+    """The replica engines, handed out in turn."""
+
+    def __init__(self, engines):
+        self.engines = list(engines)
+        self._cycle = itertools.cycle(self.engines)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.engines)
+
+    def next(self):
+        with self._lock:
+            return next(self._cycle)
+
+
+class RoutingSession(Session):
+    """A session that reads from a replica once ``use_replica`` is called.
+
+    Flushes always go to the primary the session is bound to, and so do
+    the reads after them, which may need to see what was flushed.
+    """
+
+    def __init__(self, replicas=None, **kwargs):
+        super(RoutingSession, self).__init__(**kwargs)
+        self.replicas = replicas
+        self.replica = None
+
+    def use_replica(self):
+        """Read from the next replica, if there are any."""
+        if self.replicas:
+            self.replica = self.replicas.next()
+        return self.replica is not None
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if self.replica is not None:
+            return self.replica
+        return super(RoutingSession, self).get_bind(mapper, clause, **kwargs)
+
+
+@event.listens_for(RoutingSession, 'before_flush')
+def use_primary(session, flush_context, instances):
+    session.replica = None
+
+
+class ReplicaPolicy(object):
+    """The ``replicas.*`` settings and which requests they send where."""
+
+    def __init__(self, settings):
+        self.routes = frozenset(
+            aslist(settings.get('replicas.routes', '')) or DEFAULT_ROUTES)
+        self.sticky_seconds = int(settings.get(
+            'replicas.sticky_seconds', DEFAULT_STICKY_SECONDS))
+
+    def is_sticky(self, request, now=None):
+        """Whether ``request`` comes from a client that has just written."""
+        try:
+            until = float(request.cookies.get(PRIMARY_COOKIE, 0))
+        except ValueError:
+            until = 0
+        return until >= (now or time.time())
+
+    def reads_from_replica(self, request, now=None):
+        """Whether ``request`` may read slightly stale data."""
+        if request.method not in SAFE_METHODS:
+            return False
+        route = request.matched_route
+        if route is None or route.name not in self.routes:
+            return False
+        return not self.is_sticky(request, now)
+
+    def stick_to_primary(self, request):
+        """Send this client's reads to the primary for a while."""
+        until = int(time.time()) + self.sticky_seconds
+
+        def set_cookie(request, response):
+            response.set_cookie(PRIMARY_COOKIE, str(until),
+                                max_age=self.sticky_seconds, httponly=True)
+        request.add_response_callback(set_cookie)
+
+    def route(self, request, dbsession):
+        """Point ``dbsession`` at a replica or the primary for ``request``."""
+        if self.reads_from_replica(request):
+            dbsession.use_replica()
+        elif request.method not in SAFE_METHODS:
+            self.stick_to_primary(request)
+        return dbsession
@@ -0,0 +1,93 @@
+"""Per-month entry counts for the date archive.
+
+``entry_month_counts`` holds how many entries were written in each month.
+Writes keep it current inside their own transaction, so the month
+sidebar is one small indexed read instead of a GROUP BY over every
+entry, and month pages can 404 without touching ``entries``.
+"""
+
+
+import calendar
+from collections import Counter, namedtuple
+from datetime import datetime
+
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+
+from .models import Entry, EntryMonthCount
+
+MonthLink = namedtuple('MonthLink', 'year month count label')
+
+
+def month_bounds(year, month):
+    """The first moment of a month and of the month after it."""
+    start = datetime(year, month, 1)
+    if month == 12:
+        return start, datetime(year + 1, 1, 1)
+    return start, datetime(year, month + 1, 1)
+
+
+def add_month_counts(conn, creation_dates, delta=1):
+    """Count entries written on ``creation_dates`` in their months.
+
+    ``conn`` is a Connection in the writing transaction (for a session,
+    ``dbsession.connection()``). A month seen for the first time is
+    inserted in a savepoint, so a concurrent insert of the same month
+    just falls back to the update.
+    """
+    table = EntryMonthCount.__table__
+    months = Counter((date.year, date.month) for date in creation_dates)
+    for (year, month), count in sorted(months.items()):
+        where = (table.c.year == year) & (table.c.month == month)
+        update = table.update().where(where).values(
+            count=table.c.count + count * delta)
+        if conn.execute(update).rowcount:
+            continue
+        savepoint = conn.begin_nested()
+        try:
+            conn.execute(table.insert(), year=year, month=month,
+                         count=max(count * delta, 0))
+            savepoint.commit()
+        except IntegrityError:
+            savepoint.rollback()
+            conn.execute(update)
+
+
+def rebuild_month_counts(conn, batch_size=1000):
+    """Recount every month from ``entries``, for bulk loads and backfills."""
+    table = EntryMonthCount.__table__
+    months = Counter()
+    result = conn.execution_options(stream_results=True).execute(
+        select([Entry.__table__.c.creation_date]))
+    while True:
+        rows = result.fetchmany(batch_size)
+        if not rows:
+            break
+        months.update((row[0].year, row[0].month) for row in rows)
+    conn.execute(table.delete())
+    if months:
+        conn.execute(table.insert(), [
+            {'year': year, 'month': month, 'count': count}
+            for (year, month), count in months.items()
+        ])
+    return len(months)
+
+
+def month_links(dbsession):
+    """Every month with entries, newest first, for the sidebar."""
+    rows = dbsession.query(
+        EntryMonthCount.year, EntryMonthCount.month, EntryMonthCount.count
+    ).filter(EntryMonthCount.count > 0).order_by(
+        EntryMonthCount.year.desc(), EntryMonthCount.month.desc())
+    return [
+        MonthLink(year, month, count,
+                  '{} {}'.format(calendar.month_name[month], year))
+        for year, month, count in rows
+    ]
+
+
+def month_count(dbsession, year, month):
+    """How many entries were written in a month (0 if none)."""
+    return dbsession.query(EntryMonthCount.count).filter(
+        EntryMonthCount.year == year, EntryMonthCount.month == month
+    ).scalar() or 0
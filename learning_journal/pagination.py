@@ -0,0 +1,75 @@
+"""Keyset (cursor) pagination for listings ordered newest first.
+
+Pages are found by seeking on the ``(creation_date, id)`` index instead of
+using OFFSET, so fetching any page costs the same no matter how deep into
+the journal it is.
+"""
+
+
+from datetime import datetime
+
+from sqlalchemy import tuple_
+
+from learning_journal.models import Entry
+
+CURSOR_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+DEFAULT_PAGE_SIZE = 20
+
+
+class Page(object):
+    """One page of a listing, with cursors for the neighbouring pages."""
+
+    def __init__(self, items, older=None, newer=None):
+        self.items = items
+        self.older = older
+        self.newer = newer
+
+
+def encode_cursor(creation_date, entry_id):
+    """Turn a row's sort key into an opaque cursor string."""
+    return '{}_{}'.format(creation_date.strftime(CURSOR_FORMAT), entry_id)
+
+
+def decode_cursor(cursor):
+    """Turn a cursor string back into a sort key, or raise ValueError."""
+    timestamp, _, entry_id = cursor.rpartition('_')
+    return datetime.strptime(timestamp, CURSOR_FORMAT), int(entry_id)
+
+
+def get_page_size(request):
+    """Read the configured page size for listings."""
+    settings = request.registry.settings or {}
+    return int(settings.get('journal.page_size', DEFAULT_PAGE_SIZE))
+
+
+def keyset_page(query, before=None, after=None, per_page=DEFAULT_PAGE_SIZE):
+    """Fetch one page of ``query`` newest first.
+
+    ``before`` asks for the page of rows older than that cursor, ``after``
+    for the page of rows newer than it. With neither, the newest page is
+    returned. Only ``per_page + 1`` rows are ever read from the database.
+    """
+    sort_key = tuple_(Entry.creation_date, Entry.id)
+    if after is not None:
+        rows = query.filter(sort_key > tuple_(*decode_cursor(after)))
+        rows = rows.order_by(Entry.creation_date.asc(), Entry.id.asc())
+        rows = rows.limit(per_page + 1).all()
+        has_newer = len(rows) > per_page
+        items = list(reversed(rows[:per_page]))
+        older = _cursor_for(items[-1]) if items else None
+        newer = _cursor_for(items[0]) if has_newer else None
+        return Page(items, older=older, newer=newer)
+
+    rows = query
+    if before is not None:
+        rows = rows.filter(sort_key < tuple_(*decode_cursor(before)))
+    rows = rows.order_by(Entry.creation_date.desc(), Entry.id.desc())
+    rows = rows.limit(per_page + 1).all()
+    items = rows[:per_page]
+    older = _cursor_for(items[-1]) if len(rows) > per_page else None
+    newer = _cursor_for(items[0]) if before is not None and items else None
+    return Page(items, older=older, newer=newer)
+
+
+def _cursor_for(row):
+    return encode_cursor(row.creation_date, row.id)
@@ -0,0 +1,204 @@
+"""Serve the app from several pre-forked waitress processes.
+
+The master process loads the app once (templates compiled, mappers
+configured, pages warmed up), binds the listening socket, and forks
+``workers`` copies of itself that all accept on that socket. Each worker
+runs waitress with ``server.threads`` threads and throws away the
+database pool it inherited, so no connection is ever shared between
+processes. The master only watches: a worker that dies is replaced,
+SIGHUP loads the app again from the ini file and swaps in a fresh set of
+workers before stopping the old ones (code changes still need a
+restart, since the master has imported it already), and SIGTERM or
+SIGINT stops everything.
+
+Anything kept in process memory, like the ``memory`` page cache, the
+login rate limits and the search and related-entry indexes, is per
+worker; the indexes catch up with other workers' writes from the
+database before use.
+
+``runapp.py`` uses this when ``SERVER_MODE=prefork``.
+"""
+
+
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import sys
+import time
+
+from sqlalchemy.orm import configure_mappers
+
+log = logging.getLogger(__name__)
+
+STOP_TIMEOUT = 30
+
+
+def worker_count(settings=None, environ=os.environ):
+    """``$WEB_CONCURRENCY``, else ``server.workers``, else the CPU count."""
+    count = environ.get('WEB_CONCURRENCY') or (settings or {}).get(
+        'server.workers')
+    if count:
+        return max(int(count), 1)
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:  # pragma: no cover
+        return 1
+
+
+def listen(host, port, backlog=1024):
+    """A listening TCP socket for the workers to share."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    return sock
+
+
+def dispose_engine(app):
+    """Drop the app's pooled connections (the next query opens new ones)."""
+    factory = app.registry['dbsession_factory']
+    factory.kw['bind'].dispose()
+    for replica in getattr(factory.kw.get('replicas'), 'engines', ()):
+        replica.dispose()
+
+
+class PreforkServer(object):
+    """Fork and supervise waitress workers sharing one socket."""
+
+    def __init__(self, load_app, host='0.0.0.0', port=5000, workers=None,
+                 threads=None):
+        self.load_app = load_app
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.threads = threads
+        self.count = workers
+        self.app = None
+        self.sock = None
+        self.children = {}
+        self.signals = []
+
+    def load(self):
+        """Build and warm the app in the master, ready to fork."""
+        app = self.load_app()
+        configure_mappers()
+        # Warm-up may have left connections in the pool; forked copies of
+        # them would be shared by every worker.
+        dispose_engine(app)
+        return app
+
+    def spawn(self):
+        pid = os.fork()
+        if pid:
+            self.children[pid] = self.app
+            return pid
+        # In the worker.
+        code = 0
+        try:
+            self.run_worker()
+        except Exception:
+            log.exception('Worker %d failed', os.getpid())
+            code = 1
+        finally:
+            os._exit(code)
+
+    def run_worker(self):
+        from waitress.server import create_server
+        # Reloads are the master's business.
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        dispose_engine(self.app)
+        settings = self.app.registry.settings
+        threads = int(self.threads or settings.get('server.threads', 4))
+        server = create_server(self.app, sockets=[self.sock], threads=threads)
+
+        def stop(signum, frame):
+            # waitress shuts its threads down on SystemExit.
+            raise SystemExit(0)
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+        log.info('Worker %d serving with %d threads', os.getpid(), threads)
+        server.run()
+
+    def spawn_missing(self):
+        current = [pid for pid, app in self.children.items()
+                   if app is self.app]
+        for _ in range(self.count - len(current)):
+            self.spawn()
+
+    def stop(self, pids, timeout=STOP_TIMEOUT):
+        """SIGTERM ``pids``, then SIGKILL any still running after timeout."""
+        for pid in pids:
+            self.kill(pid, signal.SIGTERM)
+        deadline = time.time() + timeout
+        while any(pid in self.children for pid in pids):
+            if time.time() > deadline:
+                for pid in pids:
+                    self.kill(pid, signal.SIGKILL)
+            self.reap()
+            time.sleep(0.1)
+
+    def kill(self, pid, signum):
+        try:
+            os.kill(pid, signum)
+        except OSError:
+            pass
+
+    def reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError:
+                return
+            if not pid:
+                return
+            self.children.pop(pid, None)
+
+    def reload(self):
+        """Load the app again, start new workers, then stop the old ones."""
+        log.info('Reloading')
+        try:
+            app = self.load()
+        except Exception:
+            log.exception('Reload failed; keeping the current workers')
+            return
+        old = list(self.children)
+        self.app = app
+        self.spawn_missing()
+        self.stop(old)
+
+    def handle(self, signum, frame):
+        self.signals.append(signum)
+
+    def run(self):
+        self.app = self.load()
+        self.count = self.workers or worker_count(self.app.registry.settings)
+        self.sock = listen(self.host, self.port)
+        for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, self.handle)
+        log.info('Serving on %s:%d with %d workers',
+                 self.host, self.port, self.count)
+        self.spawn_missing()
+        try:
+            while True:
+                if self.signals:
+                    signum = self.signals.pop(0)
+                    if signum == signal.SIGHUP:
+                        self.reload()
+                    else:
+                        break
+                self.reap()
+                self.spawn_missing()
+                time.sleep(0.2)
+        finally:
+            log.info('Stopping %d workers', len(self.children))
+            self.stop(list(self.children))
+            self.sock.close()
+
+
+def serve(load_app, host='0.0.0.0', port=5000, workers=None, threads=None):
+    """Serve the app ``load_app()`` builds from pre-forked workers."""
+    if not hasattr(os, 'fork'):  # pragma: no cover
+        sys.exit('SERVER_MODE=prefork needs os.fork()')
+    PreforkServer(load_app, host, port, workers, threads).run()
@@ -0,0 +1,106 @@
+"""Turn an entry's raw HTML body into the forms the pages display.
+
+These run when an entry is written, never when it is read: the results
+are stored on the entry (see ``Entry.derived_fields``).
+"""
+
+
+import re
+
+try:
+    from html import escape
+    from html.parser import HTMLParser
+except ImportError:  # pragma: no cover
+    from cgi import escape
+    from HTMLParser import HTMLParser
+
+ALLOWED_TAGS = frozenset([
+    'a', 'b', 'blockquote', 'br', 'code', 'div', 'em', 'h1', 'h2', 'h3',
+    'h4', 'h5', 'h6', 'hr', 'i', 'img', 'li', 'ol', 'p', 'pre', 'span',
+    'strong', 'u', 'ul',
+])
+ALLOWED_ATTRIBUTES = {
+    'a': ('href', 'title'),
+    'img': ('src', 'alt', 'title'),
+}
+URL_ATTRIBUTES = ('href', 'src')
+SAFE_URL_RE = re.compile(r'^(https?:|mailto:|/|#|[^:]*$)', re.IGNORECASE)
+VOID_TAGS = frozenset(['br', 'hr', 'img'])
+DROP_CONTENT_TAGS = frozenset(['script', 'style'])
+EXCERPT_LENGTH = 200
+
+
+class _Sanitizer(HTMLParser):
+    """Keep whitelisted tags and attributes, escape everything else."""
+
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.html = []
+        self.text = []
+        self.open_tags = []
+        self.dropping = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in DROP_CONTENT_TAGS:
+            self.dropping += 1
+            return
+        if tag not in ALLOWED_TAGS or self.dropping:
+            return
+        kept = []
+        for name, value in attrs:
+            if name not in ALLOWED_ATTRIBUTES.get(tag, ()):
+                continue
+            value = value or ''
+            if name in URL_ATTRIBUTES and not SAFE_URL_RE.match(value.strip()):
+                continue
+            kept.append(' {}="{}"'.format(name, escape(value, True)))
+        self.html.append('<{}{}>'.format(tag, ''.join(kept)))
+        if tag not in VOID_TAGS:
+            self.open_tags.append(tag)
+        else:
+            self.text.append(' ')
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if tag not in VOID_TAGS and self.open_tags[-1:] == [tag]:
+            self.handle_endtag(tag)
+
+    def handle_endtag(self, tag):
+        if tag in DROP_CONTENT_TAGS:
+            self.dropping = max(self.dropping - 1, 0)
+            return
+        if tag not in self.open_tags or self.dropping:
+            return
+        while self.open_tags:
+            open_tag = self.open_tags.pop()
+            self.html.append('</{}>'.format(open_tag))
+            if open_tag == tag:
+                break
+        self.text.append(' ')
+
+    def handle_data(self, data):
+        if self.dropping:
+            return
+        self.html.append(escape(data, False))
+        self.text.append(data)
+
+    def close(self):
+        HTMLParser.close(self)
+        while self.open_tags:
+            self.html.append('</{}>'.format(self.open_tags.pop()))
+
+
+def render_body(body):
+    """Return ``(safe_html, plain_text)`` for a raw HTML body."""
+    parser = _Sanitizer()
+    parser.feed(u'' if body is None else u'{}'.format(body))
+    parser.close()
+    text = ' '.join(''.join(parser.text).split())
+    return ''.join(parser.html), text
+
+
+def make_excerpt(text, length=EXCERPT_LENGTH):
+    """Cut plain text down to about ``length`` characters at a word break."""
+    if len(text) <= length:
+        return text
+    return text[:length].rsplit(' ', 1)[0].rstrip('.,;:') + u'…'
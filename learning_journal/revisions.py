@@ -0,0 +1,170 @@
+"""Keep every version of an entry as a compact delta.
+
+Each edit adds an ``EntryRevision`` holding the new title and, instead
+of the whole body, the difference from the previous body: a JSON list
+whose items are either ``[start, end]``, a run of tokens copied from the
+previous version, or a string of new text. Every
+``revisions.snapshot_interval``-th revision holds the full body instead,
+so rebuilding any version replays at most that many deltas from the
+nearest snapshot before it.
+"""
+
+
+import difflib
+import json
+import re
+from datetime import datetime
+
+from sqlalchemy import func
+
+from .models import EntryRevision
+
+DEFAULT_SNAPSHOT_INTERVAL = 10
+# A word with the whitespace after it; joining the tokens gives the text.
+TOKEN_RE = re.compile(r'\s*\S+\s*|\s+')
+
+
+def tokenize(text):
+    return TOKEN_RE.findall(text or u'')
+
+
+def make_delta(old, new):
+    """The JSON delta turning ``old`` into ``new``."""
+    old_tokens, new_tokens = tokenize(old), tokenize(new)
+    # Most edits touch one spot: only diff what lies between the common
+    # start and end, keeping the matcher's quadratic worst case small.
+    limit = min(len(old_tokens), len(new_tokens))
+    start = 0
+    while start < limit and old_tokens[start] == new_tokens[start]:
+        start += 1
+    end = 0
+    while (end < limit - start and
+           old_tokens[-1 - end] == new_tokens[-1 - end]):
+        end += 1
+    matcher = difflib.SequenceMatcher(
+        None, old_tokens[start:len(old_tokens) - end],
+        new_tokens[start:len(new_tokens) - end], False)
+    ops = [[0, start]] if start else []
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            ops.append([start + i1, start + i2])
+        elif j2 > j1:
+            ops.append(u''.join(new_tokens[start + j1:start + j2]))
+    if end:
+        ops.append([len(old_tokens) - end, len(old_tokens)])
+    return json.dumps(ops, separators=(',', ':'))
+
+
+def apply_delta(old, delta):
+    """Rebuild the text a delta from ``old`` describes."""
+    old_tokens = tokenize(old)
+    return u''.join(
+        u''.join(old_tokens[op[0]:op[1]]) if isinstance(op, list) else op
+        for op in json.loads(delta)
+    )
+
+
+def get_snapshot_interval(settings):
+    return max(int((settings or {}).get(
+        'revisions.snapshot_interval', DEFAULT_SNAPSHOT_INTERVAL)), 1)
+
+
+def revision_values(entry_id, number, title, body, previous_body=None,
+                    interval=DEFAULT_SNAPSHOT_INTERVAL, created_at=None):
+    """The column values of revision ``number`` of an entry."""
+    snapshot = (number - 1) % interval == 0 or previous_body is None
+    return {
+        'entry_id': entry_id,
+        'number': number,
+        'title': title,
+        'snapshot': snapshot,
+        'content': body if snapshot else make_delta(previous_body, body),
+        'created_at': created_at or datetime.now(),
+    }
+
+
+def add_revision(dbsession, entry_id, title, body, previous_body=None,
+                 number=None, interval=DEFAULT_SNAPSHOT_INTERVAL,
+                 created_at=None):
+    """Store revision ``number`` (by default the next one) of an entry."""
+    if number is None:
+        number = latest_number(dbsession, entry_id) + 1
+    revision = EntryRevision(**revision_values(
+        entry_id, number, title, body, previous_body, interval, created_at))
+    dbsession.add(revision)
+    return revision
+
+
+def latest_number(dbsession, entry_id):
+    return dbsession.query(func.max(EntryRevision.number)).filter(
+        EntryRevision.entry_id == entry_id).scalar() or 0
+
+
+def latest_numbers(dbsession, entry_ids):
+    """The newest revision number of each of ``entry_ids`` that has one."""
+    if not entry_ids:
+        return {}
+    return dict(dbsession.query(
+        EntryRevision.entry_id, func.max(EntryRevision.number)
+    ).filter(
+        EntryRevision.entry_id.in_(entry_ids)
+    ).group_by(EntryRevision.entry_id))
+
+
+def record_revision(request, entry, previous=None):
+    """Store the entry's current title and body as its newest revision.
+
+    ``previous`` is the ``(title, body, updated_at)`` the entry had
+    before an edit. Entries written before revisions were kept get that
+    version stored first, as revision 1. The caller must have read
+    ``previous`` with the entry's row locked (``with_for_update``), or
+    two concurrent edits would both take the next number.
+    """
+    dbsession = request.dbsession
+    interval = get_snapshot_interval(request.registry.settings)
+    number = latest_number(dbsession, entry.id) if previous else 0
+    previous_body = None
+    if previous is not None:
+        previous_body = previous[1]
+        if number == 0:
+            add_revision(dbsession, entry.id, previous[0], previous_body,
+                         number=1, interval=interval, created_at=previous[2])
+            number = 1
+    return add_revision(
+        dbsession, entry.id, entry.title, entry.body, previous_body,
+        number=number + 1, interval=interval, created_at=entry.updated_at)
+
+
+def revision_bodies(dbsession, entry_id, number):
+    """Yield ``(revision, body)`` from the snapshot before ``number`` to it.
+
+    Returns after replaying at most one snapshot interval of deltas.
+    """
+    start = dbsession.query(func.max(EntryRevision.number)).filter(
+        EntryRevision.entry_id == entry_id,
+        EntryRevision.number <= number,
+        EntryRevision.snapshot.is_(True),
+    ).scalar()
+    if start is None:
+        return
+    revisions = dbsession.query(EntryRevision).filter(
+        EntryRevision.entry_id == entry_id,
+        EntryRevision.number.between(start, number),
+    ).order_by(EntryRevision.number)
+    body = None
+    for revision in revisions:
+        if revision.snapshot:
+            body = revision.content
+        else:
+            body = apply_delta(body, revision.content)
+        yield revision, body
+
+
+def reconstruct(dbsession, entry_id, number):
+    """The ``(revision, body)`` of one version of an entry, or None."""
+    found = None
+    for found in revision_bodies(dbsession, entry_id, number):
+        pass
+    if found is None or found[0].number != number:
+        return None
+    return found
@@ -1,8 +1,19 @@
 def includeme(config):
+    config.include('.assets')
     config.add_static_view('static', 'static', cache_max_age=3600)
     config.add_route('home', '/')
     config.add_route('detail', '/journal/{id:\d+}')
     config.add_route('create', '/journal/new-entry')
     config.add_route('update', '/journal/{id:\d+}/edit-entry')
+    config.add_route('history', r'/journal/{id:\d+}/history')
     config.add_route('login', '/login')
     config.add_route('logout', '/logout')
+    config.add_route('search', '/search')
+    config.add_route('archive', '/archive')
+    config.add_route('archive_month', r'/archive/{year:\d+}/{month:\d+}')
+    config.add_route('feed', '/feed.atom')
+    config.add_route('api_entries', '/api/entries')
+    config.add_route('api_batch', '/api/entries/batch')
+    config.add_route('api_entry', r'/api/entries/{id:\d+}')
+    config.add_route('pool_status', '/status/pool')
+    config.add_route('metrics', '/metrics')
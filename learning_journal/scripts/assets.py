@@ -0,0 +1,136 @@
+"""Build the fingerprinted, precompressed copy of the static files.
+
+Every servable file under ``static/`` is copied to ``static/_build/``
+with the first 12 hex digits of its content's SHA-1 in its name, text
+files also get gzip and brotli (if the ``brotli`` package is installed)
+copies, and ``manifest.json`` maps each original path to its copy.
+``url()`` references in stylesheets are rewritten to the fingerprinted
+names first, so a changed font or image also changes the stylesheet's
+name.
+"""
+
+
+import gzip
+import hashlib
+import json
+import os
+import posixpath
+import re
+import shutil
+import sys
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+from ..assets import (
+    BUILD_DIRECTORY,
+    BUILD_NAME,
+    COMPRESSIBLE,
+    MANIFEST_PATH,
+    STATIC_DIRECTORY,
+)
+
+ASSET_EXTENSIONS = COMPRESSIBLE + (
+    '.jpg', '.jpeg', '.png', '.gif', '.ico', '.webp', '.woff', '.woff2',
+)
+CSS_URL_RE = re.compile(r'''url\((['"]?)([^'")]+)\1\)''')
+MIN_COMPRESS_BYTES = 256
+
+
+def usage(argv):
+    cmd = os.path.basename(argv[0])
+    print('usage: %s\n'
+          'Rebuilds %s and its manifest from the static directory.'
+          % (cmd, BUILD_DIRECTORY))
+    sys.exit(1)
+
+
+def fingerprint(path, content):
+    """``css/site.css`` becomes ``css/site.<hash>.css``."""
+    digest = hashlib.sha1(content).hexdigest()[:12]
+    root, extension = posixpath.splitext(path)
+    return '{}.{}{}'.format(root, digest, extension)
+
+
+def find_assets(directory):
+    """Paths, relative to ``directory`` and '/'-separated, to build."""
+    found = []
+    for root, dirs, files in os.walk(directory):
+        dirs[:] = sorted(d for d in dirs if d != BUILD_NAME)
+        for name in sorted(files):
+            if name.lower().endswith(ASSET_EXTENSIONS):
+                relative = os.path.relpath(os.path.join(root, name), directory)
+                found.append(relative.replace(os.sep, '/'))
+    return found
+
+
+def rewrite_css_urls(path, css, manifest):
+    """Point relative ``url()`` references at their fingerprinted copies."""
+    def replace(match):
+        quote, url = match.group(1), match.group(2)
+        if url.startswith(('data:', 'http:', 'https:', '//', '/', '#')):
+            return match.group(0)
+        target, suffix = re.match(r'([^?#]*)(.*)', url).groups()
+        resolved = posixpath.normpath(
+            posixpath.join(posixpath.dirname(path), target))
+        if resolved not in manifest:
+            return match.group(0)
+        # The copy keeps the original's directory, under BUILD_NAME.
+        rewritten = posixpath.relpath(
+            manifest[resolved],
+            posixpath.join(BUILD_NAME, posixpath.dirname(path)))
+        return 'url({0}{1}{2}{0})'.format(quote, rewritten, suffix)
+    return CSS_URL_RE.sub(replace, css)
+
+
+def write_compressed(path, content):
+    """Write ``path``.gz and, with brotli installed, ``path``.br."""
+    if len(content) < MIN_COMPRESS_BYTES:
+        return
+    with open(path + '.gz', 'wb') as f:
+        with gzip.GzipFile(filename='', mode='wb', fileobj=f, mtime=0,
+                           compresslevel=9) as compressed:
+            compressed.write(content)
+    if brotli is not None:
+        with open(path + '.br', 'wb') as f:
+            f.write(brotli.compress(content))
+
+
+def build(source=STATIC_DIRECTORY, target=BUILD_DIRECTORY):
+    """Rebuild ``target`` from ``source`` and return the manifest."""
+    if os.path.isdir(target):
+        shutil.rmtree(target)
+    paths = find_assets(source)
+    # Stylesheets go last so the files they reference are named already.
+    paths.sort(key=lambda path: path.endswith('.css'))
+    manifest = {}
+    for path in paths:
+        with open(os.path.join(source, path), 'rb') as f:
+            content = f.read()
+        if path.endswith('.css'):
+            content = rewrite_css_urls(
+                path, content.decode('utf-8'), manifest).encode('utf-8')
+        built = fingerprint(path, content)
+        manifest[path] = '{}/{}'.format(BUILD_NAME, built)
+        destination = os.path.join(target, *built.split('/'))
+        if not os.path.isdir(os.path.dirname(destination)):
+            os.makedirs(os.path.dirname(destination))
+        with open(destination, 'wb') as f:
+            f.write(content)
+        if path.endswith(COMPRESSIBLE):
+            write_compressed(destination, content)
+    manifest_path = os.path.join(target, os.path.basename(MANIFEST_PATH))
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+
+def main(argv=sys.argv):
+    if len(argv) > 1:
+        usage(argv)
+    manifest = build()
+    print('built %d assets into %s%s' % (
+        len(manifest), BUILD_DIRECTORY,
+        '' if brotli is not None else ' (brotli not installed: gzip only)'))
@@ -0,0 +1,141 @@
+"""Add and fill the derived display columns on an existing entries table.
+
+Entries written before ``body_html``, ``excerpt``, ``word_count`` and
+``display_date`` existed have them empty. This adds any missing column
+and computes the values in id order, one committed batch at a time, so
+it can be stopped and rerun safely. Tables the models have gained since
+the database was created, like ``entry_revisions``, are created first,
+as are indexes declared since their table was created (such as the
+pagination and full-text search indexes on ``entries``), and the
+per-month entry counts and the entry links are rebuilt at the end.
+"""
+
+
+import os
+import sys
+
+from pyramid.paster import (
+    get_appsettings,
+    setup_logging,
+)
+
+from pyramid.scripts.common import parse_vars
+from pyramid.settings import asbool
+from sqlalchemy import bindparam, inspect, select
+
+from ..models import get_engine
+from ..models import Entry
+from ..models.meta import Base
+from ..models.mymodel import SEARCH_INDEX_DDL
+from ..links import get_related_count, rebuild_links
+from ..months import rebuild_month_counts
+from .transfer import DERIVED_COLUMNS, Progress
+
+DEFAULT_BATCH_SIZE = 500
+
+
+def usage(argv):
+    cmd = os.path.basename(argv[0])
+    print('usage: %s <config_uri> [var=value]\n'
+          '(example: "%s development.ini batch_size=1000")\n'
+          'Fills the derived columns of entries that lack them. Pass\n'
+          'all=true to recompute every entry.' % (cmd, cmd))
+    sys.exit(1)
+
+
+def add_missing_columns(engine):
+    """ALTER the entries table to add columns the model has gained."""
+    table = Entry.__table__
+    existing = set(c['name'] for c in inspect(engine).get_columns(table.name))
+    added = []
+    with engine.begin() as conn:
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            conn.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(
+                table.name, column.name, column.type.compile(engine.dialect)))
+            added.append(column.name)
+    return added
+
+
+def add_missing_indexes(engine):
+    """CREATE the indexes the models have gained on existing tables.
+
+    ``create_all`` only builds indexes along with a new table, so tables
+    created before an index was declared never get it otherwise.
+    """
+    inspector = inspect(engine)
+    added = []
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            existing = set(
+                index['name'] for index in inspector.get_indexes(table.name))
+            for index in sorted(table.indexes, key=lambda index: index.name):
+                if index.name not in existing:
+                    index.create(conn)
+                    added.append(index.name)
+        # Reflection skips expression indexes, so look this one up by name.
+        if engine.dialect.name == 'postgresql' and conn.execute(
+                "SELECT count(*) FROM pg_indexes "
+                "WHERE indexname = 'ix_entries_search'").scalar() == 0:
+            conn.execute(SEARCH_INDEX_DDL)
+            added.append('ix_entries_search')
+    return added
+
+
+def backfill_entries(engine, batch_size, everything, progress):
+    """Compute the derived columns batch by batch, keyed on id.
+
+    Entries that predate ``updated_at`` get their creation date there.
+    """
+    table = Entry.__table__
+    update = table.update().where(table.c.id == bindparam('entry_id')).values(
+        dict((column, bindparam(column)) for column in DERIVED_COLUMNS))
+    with engine.begin() as conn:
+        conn.execute(table.update().where(table.c.updated_at.is_(None)).values(
+            updated_at=table.c.creation_date))
+    last_id = 0
+    while True:
+        query = select([table.c.id, table.c.body, table.c.creation_date]).where(
+            table.c.id > last_id).order_by(table.c.id).limit(batch_size)
+        if not everything:
+            query = query.where(table.c.display_date.is_(None))
+        with engine.begin() as conn:
+            rows = conn.execute(query).fetchall()
+            if not rows:
+                return
+            params = []
+            for entry_id, body, creation_date in rows:
+                fields = Entry.derived_fields(body, creation_date)
+                fields['entry_id'] = entry_id
+                params.append(fields)
+            conn.execute(update, params)
+        last_id = rows[-1][0]
+        progress.add(len(rows))
+
+
+def main(argv=sys.argv):
+    if len(argv) < 2:
+        usage(argv)
+    config_uri = argv[1]
+    options = parse_vars(argv[2:])
+    setup_logging(config_uri)
+    settings = get_appsettings(config_uri, options=options)
+    settings["sqlalchemy.url"] = os.environ["DATABASE_URL"]
+
+    engine = get_engine(settings)
+    Base.metadata.create_all(engine)
+    added = add_missing_columns(engine)
+    if added:
+        print('added columns: %s' % ', '.join(added))
+    added = add_missing_indexes(engine)
+    if added:
+        print('added indexes: %s' % ', '.join(added))
+    progress = Progress('backfilled')
+    backfill_entries(
+        engine, int(options.get('batch_size', DEFAULT_BATCH_SIZE)),
+        asbool(options.get('all', False)), progress)
+    progress.finish()
+    with engine.begin() as conn:
+        print('counted entries in %d months' % rebuild_month_counts(conn))
+        rebuild_links(conn, get_related_count(settings))
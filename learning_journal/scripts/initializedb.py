@@ -1,6 +1,8 @@
+import hashlib
 import os
 import sys
 import transaction
+import zope.sqlalchemy
 from datetime import datetime
 
 from pyramid.paster import (
@@ -9,6 +11,7 @@ from pyramid.paster import (
 )
 
 from pyramid.scripts.common import parse_vars
+from pyramid.settings import asbool
 
 from ..models.meta import Base
 from ..models import (
@@ -17,16 +20,120 @@ from ..models import (
     get_tm_session,
 )
 from ..models import Entry
+from ..models.mymodel import utc_to_local
 from ..data.entry_history import ENTRIES
+from ..links import (
+    DEFAULT_RELATED_COUNT,
+    get_related_count,
+    load_index,
+    relink_order,
+    relink_related,
+)
+from ..months import rebuild_month_counts
+from .transfer import reset_id_sequence
 
 
 def usage(argv):
     cmd = os.path.basename(argv[0])
     print('usage: %s <config_uri> [var=value]\n'
-          '(example: "%s development.ini")' % (cmd, cmd))
+          '(example: "%s development.ini")\n'
+          'Seeds only new or changed entries. Pass reset=true to drop and\n'
+          'recreate every table first.' % (cmd, cmd))
     sys.exit(1)
 
 
+def content_hash(title, body, creation_date):
+    """Fingerprint the seeded content of an entry."""
+    content = '\0'.join([title or '', body or '', creation_date.isoformat()])
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+
+def seed_rows(entries):
+    """Turn the seed data into column dicts keyed by the seed ids."""
+    rows = {}
+    for entry in entries:
+        creation_date = utc_to_local(entry['creation_date'])
+        row = {
+            'id': entry['id'],
+            'title': entry['title'],
+            'body': entry['body'],
+            'creation_date': creation_date,
+            'updated_at': creation_date,
+        }
+        row.update(Entry.derived_fields(row['body'], creation_date))
+        rows[entry['id']] = row
+    return rows
+
+
+def relink_seeded(conn, inserts, updates, moved, related_count):
+    """Relink only the seeded rows, and the entries around them.
+
+    ``moved`` are the old ``(creation_date, id)`` sort keys of updated
+    entries whose date changed. Entries from the earliest new, moved or
+    old position on are rechained.
+    """
+    starts = [(row['creation_date'], row['id']) for row in inserts]
+    if moved:
+        starts.extend(moved)
+        starts.extend((row['creation_date'], row['id']) for row in updates)
+    if starts:
+        relink_order(conn, min(starts))
+    if related_count:
+        relink_related(conn, load_index(conn), [
+            (row['id'], row['creation_date'], row['body'])
+            for row in inserts + updates
+        ], related_count)
+
+
+def seed_entries(dbsession, entries, related_count=DEFAULT_RELATED_COUNT):
+    """Insert or update only the seed entries that differ from the db.
+
+    Returns a dict with the ids that were inserted, updated and unchanged.
+    """
+    wanted = seed_rows(entries)
+    existing = dbsession.query(
+        Entry.id, Entry.title, Entry.body, Entry.creation_date
+    ).filter(Entry.id.in_(list(wanted))).all()
+    current = dict(
+        (row.id, content_hash(row.title, row.body, row.creation_date))
+        for row in existing
+    )
+    dates = dict((row.id, row.creation_date) for row in existing)
+
+    inserts, updates, moved, unchanged = [], [], [], []
+    for entry_id, row in sorted(wanted.items()):
+        seeded = content_hash(row['title'], row['body'], row['creation_date'])
+        if entry_id not in current:
+            inserts.append(row)
+        elif current[entry_id] != seeded:
+            row['updated_at'] = datetime.now()
+            updates.append(row)
+            if dates[entry_id] != row['creation_date']:
+                moved.append((dates[entry_id], entry_id))
+        else:
+            unchanged.append(entry_id)
+
+    if inserts:
+        dbsession.bulk_insert_mappings(Entry, inserts)
+    if updates:
+        dbsession.bulk_update_mappings(Entry, updates)
+    if inserts:
+        dbsession.flush()
+        reset_id_sequence(dbsession.connection())
+    if inserts or updates:
+        conn = dbsession.connection()
+        rebuild_month_counts(conn)
+        relink_seeded(conn, inserts, updates, moved, related_count)
+        # Bulk writes bypass the unit of work, so tell the transaction
+        # manager there is something to commit.
+        zope.sqlalchemy.mark_changed(dbsession)
+    return {
+        'inserted': [row['id'] for row in inserts],
+        'updated': [row['id'] for row in updates],
+        'unchanged': unchanged,
+    }
+
+
 def main(argv=sys.argv):
     if len(argv) < 2:
         usage(argv)
@@ -37,21 +144,20 @@ def main(argv=sys.argv):
     settings["sqlalchemy.url"] = os.environ["DATABASE_URL"]
 
     engine = get_engine(settings)
-    Base.metadata.drop_all(engine)
+    if asbool(options.get('reset', False)):
+        Base.metadata.drop_all(engine)
     Base.metadata.create_all(engine)
 
     session_factory = get_session_factory(engine)
 
     with transaction.manager:
         dbsession = get_tm_session(session_factory, transaction.manager)
+        changes = seed_entries(dbsession, ENTRIES,
+                               get_related_count(settings))
 
-        all_entries = []
-        for entry in ENTRIES:
-            all_entries.append(
-                Entry(
-                    title=entry['title'],
-                    body=entry['body'],
-                    creation_date=entry['creation_date']
-                )
-            )
-        dbsession.add_all(all_entries)
+    print('inserted %d, updated %d, unchanged %d entries' % (
+        len(changes['inserted']), len(changes['updated']),
+        len(changes['unchanged'])))
+    for change in ('inserted', 'updated'):
+        if changes[change]:
+            print('%s ids: %s' % (change, changes[change]))
@@ -0,0 +1,52 @@
+"""Rebuild every entry's previous/next and related-entry links.
+
+Writes keep ``entry_links`` current incrementally, weighting new entries
+with the term frequencies of the moment. Run this now and then, from a
+scheduler for example, to recompute the whole table in one transaction
+with the journal's current frequencies.
+"""
+
+
+import os
+import sys
+import time
+
+from pyramid.paster import (
+    get_appsettings,
+    setup_logging,
+)
+
+from pyramid.scripts.common import parse_vars
+
+from ..links import get_related_count, rebuild_links
+from ..models import get_engine
+from ..models.meta import Base
+
+
+def usage(argv):
+    cmd = os.path.basename(argv[0])
+    print('usage: %s <config_uri> [var=value]\n'
+          '(example: "%s development.ini related_count=8")\n'
+          'Recomputes the previous/next and related links of every entry,\n'
+          'linking related_count (by default links.related_count) related\n'
+          'entries to each.'
+          % (cmd, cmd))
+    sys.exit(1)
+
+
+def main(argv=sys.argv):
+    if len(argv) < 2:
+        usage(argv)
+    config_uri = argv[1]
+    options = parse_vars(argv[2:])
+    setup_logging(config_uri)
+    settings = get_appsettings(config_uri, options=options)
+    settings["sqlalchemy.url"] = os.environ["DATABASE_URL"]
+
+    engine = get_engine(settings)
+    Base.metadata.create_all(engine)
+    started = time.time()
+    with engine.begin() as conn:
+        index = rebuild_links(conn, int(options.get(
+            'related_count', get_related_count(settings))))
+    print('linked %d entries in %.1fs' % (len(index), time.time() - started))
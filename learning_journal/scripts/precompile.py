@@ -0,0 +1,48 @@
+"""Compile every template into the Jinja2 bytecode cache directory.
+
+Run before the server starts so the first requests after a restart load
+compiled templates instead of parsing them.
+"""
+
+
+import os
+import sys
+
+from pyramid.config import Configurator
+from pyramid.paster import (
+    get_appsettings,
+    setup_logging,
+)
+
+from pyramid.scripts.common import parse_vars
+from pyramid.settings import asbool
+
+from ..templating import compile_templates, ensure_cache_directory
+
+
+def usage(argv):
+    cmd = os.path.basename(argv[0])
+    print('usage: %s <config_uri> [var=value]\n'
+          '(example: "%s production.ini")\n'
+          'Compiles every template into the jinja2.bytecode_caching_directory.'
+          % (cmd, cmd))
+    sys.exit(1)
+
+
+def main(argv=sys.argv):
+    if len(argv) < 2:
+        usage(argv)
+    config_uri = argv[1]
+    options = parse_vars(argv[2:])
+    setup_logging(config_uri)
+    settings = get_appsettings(config_uri, options=options)
+    if not asbool(settings.get('jinja2.bytecode_caching')):
+        print('jinja2.bytecode_caching is off; nothing to precompile')
+        return
+    ensure_cache_directory(settings)
+    config = Configurator(settings=settings)
+    config.include('pyramid_jinja2')
+    config.commit()
+    names = compile_templates(config.get_jinja2_environment())
+    print('compiled %d templates into %s' % (
+        len(names), settings['jinja2.bytecode_caching_directory']))
@@ -0,0 +1,263 @@
+"""Stream journal entries between the database and JSONL or CSV files.
+
+Entries move in batches: exports read through a server-side cursor and
+imports insert one batch at a time (with COPY on PostgreSQL), so memory
+use depends on the batch size, not on the size of the journal.
+"""
+
+
+import csv
+import io
+import json
+import os
+import sys
+import time
+from datetime import datetime
+
+from pyramid.paster import (
+    get_appsettings,
+    setup_logging,
+)
+
+from pyramid.scripts.common import parse_vars
+from pyramid.settings import asbool
+from sqlalchemy import select
+
+from ..models import get_engine
+from ..models import Entry
+from ..links import get_related_count, rebuild_links
+from ..months import rebuild_month_counts
+
+COLUMNS = ('id', 'title', 'body', 'creation_date', 'updated_at')
+DATE_COLUMNS = ('creation_date', 'updated_at')
+DERIVED_COLUMNS = ('body_html', 'excerpt', 'word_count', 'display_date')
+DATE_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+DEFAULT_BATCH_SIZE = 1000
+
+
+def usage(argv):
+    cmd = os.path.basename(argv[0])
+    print('usage: %s <config_uri> export|import <file> [var=value]\n'
+          '(example: "%s development.ini export entries.jsonl '
+          'batch_size=5000")\n'
+          'The file format follows its extension (.jsonl or .csv) unless\n'
+          'format=jsonl|csv is given. Use "-" for stdin/stdout.\n'
+          'Imports leave the entry links to linkdb2, whose memory use grows\n'
+          'with the journal, unless links=true is given.'
+          % (cmd, cmd))
+    sys.exit(1)
+
+
+class Progress(object):
+    """Report how many entries have moved and how fast."""
+
+    def __init__(self, verb, out=sys.stderr):
+        self.verb = verb
+        self.out = out
+        self.count = 0
+        self.started = time.time()
+
+    def add(self, count):
+        self.count += count
+        self.report()
+
+    def report(self):
+        elapsed = max(time.time() - self.started, 1e-6)
+        self.out.write('%s %d entries (%.0f entries/s)\n' % (
+            self.verb, self.count, self.count / elapsed))
+        self.out.flush()
+
+    def finish(self):
+        self.out.write('done: %s %d entries in %.1fs\n' % (
+            self.verb, self.count, time.time() - self.started))
+
+
+def format_date(value):
+    return value.strftime(DATE_FORMAT) if value else None
+
+
+def parse_date(value):
+    if not value:
+        return None
+    if '.' not in value:
+        value += '.0'
+    return datetime.strptime(value.replace(' ', 'T'), DATE_FORMAT)
+
+
+def write_rows(rows, fileobj, file_format):
+    """Serialize row dicts to an open text file, one line per entry."""
+    if file_format == 'csv':
+        writer = csv.DictWriter(fileobj, fieldnames=COLUMNS)
+        writer.writeheader()
+        writer.writerows(rows)
+    else:
+        for row in rows:
+            fileobj.write(json.dumps(row) + '\n')
+
+
+def read_rows(fileobj, file_format):
+    """Parse entries from an open text file into column dicts.
+
+    Only the authored columns are read; the derived display columns are
+    computed here so imported rows need no backfill.
+    """
+    if file_format == 'csv':
+        records = csv.DictReader(fileobj)
+    else:
+        records = (json.loads(line) for line in fileobj if line.strip())
+    for record in records:
+        row = dict((column, record.get(column)) for column in COLUMNS)
+        row['id'] = int(row['id']) if row['id'] not in (None, '') else None
+        for column in DATE_COLUMNS:
+            row[column] = parse_date(row[column])
+        row['creation_date'] = row['creation_date'] or datetime.now()
+        row['updated_at'] = row['updated_at'] or row['creation_date']
+        row.update(Entry.derived_fields(row['body'], row['creation_date']))
+        yield row
+
+
+def batched(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def export_entries(engine, fileobj, file_format, batch_size, progress):
+    """Write every entry, oldest first, streaming from the database."""
+    table = Entry.__table__
+    query = select([table.c[c] for c in COLUMNS]).order_by(table.c.id)
+    with engine.connect() as conn:
+        result = conn.execution_options(stream_results=True).execute(query)
+
+        def rows():
+            while True:
+                batch = result.fetchmany(batch_size)
+                if not batch:
+                    return
+                for row in batch:
+                    record = dict(zip(COLUMNS, row))
+                    for column in DATE_COLUMNS:
+                        record[column] = format_date(record[column])
+                    yield record
+                progress.add(len(batch))
+
+        write_rows(rows(), fileobj, file_format)
+
+
+def import_entries(engine, fileobj, file_format, batch_size, progress,
+                   related_count=None):
+    """Insert entries from a file, committing one batch at a time.
+
+    The per-month counts are rebuilt once everything is in. The entry
+    links are only rebuilt when ``related_count`` is given: that holds
+    every entry's TF-IDF vector in memory at once, so for a large
+    journal run ``linkdb2`` separately instead.
+    """
+    for batch in batched(read_rows(fileobj, file_format), batch_size):
+        if engine.dialect.name == 'postgresql':
+            copy_batch(engine, batch)
+        else:
+            insert_batch(engine, batch)
+        progress.add(len(batch))
+    with engine.begin() as conn:
+        reset_id_sequence(conn)
+        rebuild_month_counts(conn)
+        if related_count is not None:
+            rebuild_links(conn, related_count)
+
+
+def reset_id_sequence(conn):
+    """Move PostgreSQL's id sequence past rows inserted with explicit ids."""
+    if conn.dialect.name == 'postgresql':
+        conn.execute(
+            "SELECT setval(pg_get_serial_sequence('entries', 'id'), "
+            "coalesce(max(id), 1)) FROM entries"
+        )
+
+
+def insert_batch(engine, batch):
+    """Insert a batch with one executemany per set of columns."""
+    with_ids = [row for row in batch if row['id'] is not None]
+    without_ids = [
+        dict((k, v) for k, v in row.items() if k != 'id')
+        for row in batch if row['id'] is None
+    ]
+    with engine.begin() as conn:
+        for rows in (with_ids, without_ids):
+            if rows:
+                conn.execute(Entry.__table__.insert(), rows)
+
+
+def copy_batch(engine, batch):
+    """Load a batch through PostgreSQL's COPY, the fastest bulk path."""
+    for has_id in (True, False):
+        columns = COLUMNS + DERIVED_COLUMNS
+        if not has_id:
+            columns = columns[1:]
+        rows = [row for row in batch if (row['id'] is not None) == has_id]
+        if not rows:
+            continue
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for row in rows:
+            writer.writerow([
+                format_date(row[c]) if c in DATE_COLUMNS else row[c]
+                for c in columns
+            ])
+        buffer.seek(0)
+        conn = engine.raw_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.copy_expert(
+                'COPY entries ({}) FROM STDIN WITH CSV'.format(
+                    ', '.join(columns)),
+                buffer
+            )
+            conn.commit()
+        finally:
+            conn.close()
+
+
+def open_file(path, mode):
+    if path == '-':
+        return sys.stdout if mode == 'w' else sys.stdin
+    return io.open(path, mode, encoding='utf-8', newline='')
+
+
+def main(argv=sys.argv):
+    if len(argv) < 4 or argv[2] not in ('export', 'import'):
+        usage(argv)
+    config_uri, command, path = argv[1:4]
+    options = parse_vars(argv[4:])
+    setup_logging(config_uri)
+    settings = get_appsettings(config_uri, options=options)
+    settings["sqlalchemy.url"] = os.environ["DATABASE_URL"]
+
+    batch_size = int(options.get('batch_size', DEFAULT_BATCH_SIZE))
+    file_format = options.get('format') or (
+        'csv' if path.endswith('.csv') else 'jsonl'
+    )
+    engine = get_engine(settings)
+
+    if command == 'export':
+        fileobj = open_file(path, 'w')
+        progress = Progress('exported')
+        export_entries(engine, fileobj, file_format, batch_size, progress)
+    else:
+        fileobj = open_file(path, 'r')
+        progress = Progress('imported')
+        related_count = None
+        if asbool(options.get('links', False)):
+            related_count = get_related_count(settings)
+        import_entries(engine, fileobj, file_format, batch_size, progress,
+                       related_count)
+        if related_count is None:
+            progress.out.write('entry links not rebuilt: run linkdb2\n')
+    if fileobj not in (sys.stdin, sys.stdout):
+        fileobj.close()
+    progress.finish()
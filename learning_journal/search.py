@@ -0,0 +1,218 @@
+"""Full-text search over entry titles and bodies.
+
+On PostgreSQL the search runs against a GIN index over a ``tsvector`` of
+the title and body (see ``SEARCH_VECTOR_SQL`` in the models). Other
+databases, such as the SQLite files used for test runs, fall back to an
+in-process inverted index built on first use and kept up to date by the
+views that write entries. Since each process, pre-forked workers
+included, has its own index, every search first adds the entries other
+processes have written since (by ``updated_at``).
+"""
+
+
+import heapq
+import math
+import re
+import threading
+from collections import defaultdict
+from datetime import timedelta
+
+from sqlalchemy import func, literal_column
+
+from learning_journal.models import Entry, EntrySummary
+from learning_journal.models.mymodel import SEARCH_VECTOR_SQL
+
+TAG_RE = re.compile(r'<[^>]*>')
+WORD_RE = re.compile(r"[a-z0-9]+(?:'[a-z]+)?")
+STOP_WORDS = frozenset(
+    'a an and are as at be but by for from had has have i in is it of on '
+    'or that the this to was were will with'.split()
+)
+TITLE_WEIGHT = 2
+# Entries are looked for this long before the newest one indexed, since a
+# transaction may commit a little after it stamped its updated_at.
+CATCH_UP_OVERLAP = timedelta(seconds=60)
+
+
+def tokenize(text):
+    """Split text, with any HTML tags removed, into lowercase terms."""
+    text = TAG_RE.sub(' ', text or '').lower()
+    return [word for word in WORD_RE.findall(text) if word not in STOP_WORDS]
+
+
+class InvertedIndex(object):
+    """A thread safe, in-memory term -> entry index ranked with BM25.
+
+    A query only touches the posting lists of its own terms, walking the
+    shortest one and probing the others, then scores every entry that
+    matches. Its cost follows how many entries contain its rarest term,
+    not the size of the journal: flat for rare terms, however big the
+    journal, but growing with the journal for words common enough to
+    appear in a fixed share of entries (see ``benchmarks/bench_search.py``).
+    """
+
+    k1 = 1.2
+    b = 0.75
+
+    def __init__(self):
+        self._postings = defaultdict(dict)
+        self._terms = {}
+        self._lengths = {}
+        self._total_length = 0
+        self._lock = threading.Lock()
+        # The newest updated_at of the entries indexed from the database.
+        self.seen = None
+
+    def __len__(self):
+        return len(self._lengths)
+
+    def add(self, entry_id, title, body):
+        """Index an entry, replacing anything indexed for it before."""
+        terms = tokenize(title) * TITLE_WEIGHT + tokenize(body)
+        counts = defaultdict(int)
+        for term in terms:
+            counts[term] += 1
+        with self._lock:
+            self._remove(entry_id)
+            for term, count in counts.items():
+                self._postings[term][entry_id] = count
+            self._terms[entry_id] = list(counts)
+            self._lengths[entry_id] = len(terms)
+            self._total_length += len(terms)
+
+    def remove(self, entry_id):
+        """Drop an entry from the index."""
+        with self._lock:
+            self._remove(entry_id)
+
+    def _remove(self, entry_id):
+        length = self._lengths.pop(entry_id, None)
+        if length is None:
+            return
+        self._total_length -= length
+        for term in self._terms.pop(entry_id):
+            postings = self._postings[term]
+            del postings[entry_id]
+            if not postings:
+                del self._postings[term]
+
+    def search(self, query, limit=20, offset=0):
+        """Return ``(total, [(entry_id, score), ...])`` for one page.
+
+        Entries must contain every term of the query.
+        """
+        terms = set(tokenize(query))
+        with self._lock:
+            postings = [self._postings.get(term, {}) for term in terms]
+            if not postings or not all(postings):
+                return 0, []
+            postings.sort(key=len)
+            shortest, rest = postings[0], postings[1:]
+            matches = [
+                entry_id for entry_id in shortest
+                if all(entry_id in other for other in rest)
+            ]
+            count = len(self._lengths)
+            average = float(self._total_length) / count
+            scored = []
+            for entry_id in matches:
+                norm = self.k1 * (
+                    1 - self.b + self.b * self._lengths[entry_id] / average
+                )
+                score = 0.0
+                for other in postings:
+                    idf = math.log(1 + (count - len(other) + 0.5) /
+                                   (len(other) + 0.5))
+                    tf = other[entry_id]
+                    score += idf * tf * (self.k1 + 1) / (tf + norm)
+                scored.append((score, entry_id))
+        top = heapq.nlargest(offset + limit, scored)[offset:]
+        return len(matches), [(entry_id, score) for score, entry_id in top]
+
+
+_index_lock = threading.Lock()
+
+
+def get_index(request):
+    """Return this process's inverted index, caught up with the database."""
+    dbsession = request.dbsession
+    index = request.registry.get('search_index')
+    if index is None:
+        with _index_lock:
+            index = request.registry.get('search_index')
+            if index is None:
+                index = InvertedIndex()
+                index.seen = dbsession.query(
+                    func.max(Entry.updated_at)).scalar()
+                rows = dbsession.query(Entry.id, Entry.title, Entry.body)
+                for entry_id, title, body in rows.yield_per(500):
+                    index.add(entry_id, title, body)
+                request.registry['search_index'] = index
+                return index
+    catch_up(dbsession, index)
+    return index
+
+
+def catch_up(dbsession, index):
+    """Index the entries written since ``index`` was last brought up to date.
+
+    Returns how many entries were (re)indexed.
+    """
+    if index.seen is None:
+        return 0
+    rows = dbsession.query(
+        Entry.id, Entry.title, Entry.body, Entry.updated_at
+    ).filter(Entry.updated_at > index.seen - CATCH_UP_OVERLAP).all()
+    for entry_id, title, body, _ in rows:
+        index.add(entry_id, title, body)
+    if rows:
+        index.seen = max(index.seen, max(row.updated_at for row in rows))
+    return len(rows)
+
+
+def uses_database_index(dbsession):
+    """Whether searches can use PostgreSQL's full-text index."""
+    return dbsession.bind.dialect.name == 'postgresql'
+
+
+def search_entries(request, query, limit, offset=0):
+    """Return ``(total, [EntrySummary, ...])`` best matches first."""
+    dbsession = request.dbsession
+    if uses_database_index(dbsession):
+        document = literal_column(SEARCH_VECTOR_SQL)
+        tsquery = func.plainto_tsquery('english', query)
+        matches = EntrySummary.query(dbsession).filter(
+            document.op('@@')(tsquery)
+        )
+        total = matches.count()
+        rows = matches.order_by(
+            func.ts_rank(document, tsquery).desc(), Entry.id.desc()
+        ).limit(limit).offset(offset)
+        return total, [EntrySummary(*row) for row in rows]
+
+    total, ranked = get_index(request).search(query, limit, offset)
+    ids = [entry_id for entry_id, _ in ranked]
+    if not ids:
+        return total, []
+    rows = EntrySummary.query(dbsession).filter(Entry.id.in_(ids))
+    by_id = {row.id: EntrySummary(*row) for row in rows}
+    return total, [by_id[entry_id] for entry_id in ids if entry_id in by_id]
+
+
+def index_after_commit(request, entry):
+    """Update the in-process index once the entry's transaction commits."""
+    index_many_after_commit(request, [(entry.id, entry.title, entry.body)])
+
+
+def index_many_after_commit(request, rows):
+    """Like ``index_after_commit`` for ``(id, title, body)`` rows."""
+    index = request.registry.get('search_index')
+    if index is None:
+        return
+    rows = list(rows)
+
+    def hook(success):
+        if success:
+            for entry_id, title, body in rows:
+                index.add(entry_id, title, body)
+    request.tm.get().addAfterCommitHook(hook)
@@ -5,12 +5,16 @@ https://github.com/codefellows/expense_tracker_401d7/commit/9e0621753bc7da875028
 """
 
 
+import hmac
 import os
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent import futures
 from pyramid.authentication import AuthTktAuthenticationPolicy
 from pyramid.authorization import ACLAuthorizationPolicy
 from pyramid.security import Authenticated
 from pyramid.security import Allow
-from passlib.apps import custom_app_context as pwd_context
 
 
 class MyRoot(object):
@@ -23,16 +27,191 @@ class MyRoot(object):
     ]
 
 
-def is_authenticated(username, password):
-    """Check if the user's credentials are approved."""
-    if username == os.environ.get('AUTH_USERNAME', ''):
-        if pwd_context.verify(password, os.environ.get('AUTH_PASSWORD', '')):
-            return True
-    return False
+class LoginBusy(Exception):
+    """Raised when too many password checks are already running."""
+
+
+class RateLimiter(object):
+    """Allow at most ``limit`` events per key in a sliding time window.
+
+    Keys whose events have all expired are swept out once per window, and
+    at most ``max_keys`` keys are tracked at all, the least recently seen
+    being dropped first, so a spray of addresses or usernames cannot grow
+    the table without bound.
+    """
+
+    def __init__(self, limit, window, max_keys=10000):
+        self.limit = limit
+        self.window = window
+        self.max_keys = max_keys
+        self._events = OrderedDict()
+        self._lock = threading.Lock()
+        self._swept = time.time()
+
+    def _expire(self, key, now):
+        events = self._events.get(key)
+        if events is None:
+            return deque()
+        while events and events[0] <= now - self.window:
+            events.popleft()
+        if not events:
+            del self._events[key]
+        return events
+
+    def _sweep(self, now):
+        if now - self._swept < self.window:
+            return
+        self._swept = now
+        for key in list(self._events):
+            self._expire(key, now)
+
+    def _record(self, key, now):
+        events = self._events.get(key)
+        if events is None:
+            events = self._events[key] = deque()
+        else:
+            self._events.move_to_end(key)
+        events.append(now)
+        while len(self._events) > self.max_keys:
+            self._events.popitem(last=False)
+
+    def _wait(self, events, now):
+        if len(events) < self.limit:
+            return 0
+        return int(events[0] + self.window - now) + 1
+
+    def retry_after(self, key):
+        """Seconds until ``key`` may try again, or 0 if it may now."""
+        now = time.time()
+        with self._lock:
+            return self._wait(self._expire(key, now), now)
+
+    def hit(self, key):
+        """Record an event for ``key``."""
+        now = time.time()
+        with self._lock:
+            self._sweep(now)
+            self._record(key, now)
+
+    def attempt(self, key):
+        """Record an event for ``key`` unless it is over the limit.
+
+        Returns 0 if the event was recorded, otherwise the seconds until
+        ``key`` may try again. Checking and recording under one lock means
+        concurrent attempts cannot all slip in under the limit.
+        """
+        now = time.time()
+        with self._lock:
+            self._sweep(now)
+            wait = self._wait(self._expire(key, now), now)
+            if not wait:
+                self._record(key, now)
+            return wait
+
+    def forgive(self, key):
+        """Forget the latest event recorded for ``key``."""
+        with self._lock:
+            events = self._events.get(key)
+            if events:
+                events.pop()
+                if not events:
+                    del self._events[key]
+
+
+def client_ip(request, trusted_proxies=0):
+    """The address ``request`` came from.
+
+    Behind ``trusted_proxies`` proxies that each append the address they
+    were reached from to X-Forwarded-For, as the Heroku router does, that
+    is the entry the outermost of them added; anything before it was
+    sent by the client and cannot be trusted.
+    """
+    if trusted_proxies:
+        forwarded = [
+            address.strip() for address in
+            request.headers.get('X-Forwarded-For', '').split(',')
+            if address.strip()
+        ]
+        if len(forwarded) >= trusted_proxies:
+            return forwarded[-trusted_proxies]
+    return request.client_addr
+
+
+def resolve_handler(password_hash):
+    """The passlib handler for ``password_hash``, or None if unrecognised."""
+    if not password_hash:
+        return None
+    from passlib.apps import custom_app_context
+    return custom_app_context.identify(
+        password_hash, resolve=True, required=False)
+
+
+class LoginVerifier(object):
+    """Check the author's credentials off the request threads.
+
+    The password hash is parsed once, when the verifier is made by
+    ``includeme`` before the app serves anything (passlib is imported
+    then, not when this module is), and checked on a small dedicated
+    thread pool. At most ``max_pending`` checks may be running or queued; beyond
+    that ``LoginBusy`` is raised straight away, so a burst of login
+    attempts cannot tie up the threads serving readers.
+    """
+
+    def __init__(self, username, password_hash, workers=2, max_pending=8,
+                 timeout=5):
+        self.username = username
+        self.password_hash = password_hash
+        self.handler = resolve_handler(password_hash)
+        self.timeout = timeout
+        self._executor = futures.ThreadPoolExecutor(max_workers=workers)
+        self._slots = threading.BoundedSemaphore(max_pending)
+
+    def _check(self, username, password):
+        if self.handler is None:
+            return False
+        right_user = hmac.compare_digest(
+            username.encode('utf-8'), self.username.encode('utf-8'))
+        right_password = self.handler.verify(password, self.password_hash)
+        return right_user and right_password
+
+    def verify(self, username, password):
+        """Check the credentials, raising LoginBusy if at capacity."""
+        if not self._slots.acquire(False):
+            raise LoginBusy
+        try:
+            future = self._executor.submit(self._check, username, password)
+        except Exception:
+            self._slots.release()
+            raise
+        # The slot is only freed once the check really finishes, even if
+        # this request has stopped waiting for it.
+        future.add_done_callback(lambda _: self._slots.release())
+        try:
+            return future.result(timeout=self.timeout)
+        except futures.TimeoutError:
+            raise LoginBusy
 
 
 def includeme(config):
     """Set up the authentication process."""
+    settings = config.get_settings()
+    config.registry['login_verifier'] = LoginVerifier(
+        os.environ.get('AUTH_USERNAME', ''),
+        os.environ.get('AUTH_PASSWORD', ''),
+        workers=int(settings.get('login.workers', 2)),
+        max_pending=int(settings.get('login.max_pending', 8)),
+        timeout=float(settings.get('login.timeout', 5)),
+    )
+    max_failures = int(settings.get('login.max_failures', 5))
+    failure_window = int(settings.get('login.failure_window', 300))
+    max_keys = int(settings.get('login.max_tracked', 10000))
+    config.registry['login_limiters'] = {
+        'ip': RateLimiter(max_failures, failure_window, max_keys),
+        'username': RateLimiter(max_failures, failure_window, max_keys),
+    }
+    config.registry['login_trusted_proxies'] = int(
+        settings.get('login.trusted_proxies', 0))
+
     auth_secret = os.environ.get('AUTH_SECRET', '')
     authn_policy = AuthTktAuthenticationPolicy(
         secret=auth_secret,
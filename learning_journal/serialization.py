@@ -0,0 +1,116 @@
+"""Serialize entries for machine clients, as JSON and as Atom.
+
+Each version of an entry is serialized once. The bytes are kept in the
+page cache's backend under a key holding the entry's id and
+``updated_at``, so an edit makes the old fragment unreachable, and a
+listing is assembled by joining cached fragments rather than by loading
+and encoding every entry on it. JSON is encoded with ``orjson`` when it
+is installed.
+"""
+
+
+import json
+import time
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+from xml.sax.saxutils import escape, quoteattr
+
+from .conditional import to_timestamp
+from .models import Entry
+
+FRAGMENT_KEY = 'fragment:{}:{}:{}:{}'
+ATOM_NAMESPACE = 'http://www.w3.org/2005/Atom'
+DEFAULT_FEED_TITLE = 'Learning Journal'
+
+
+def dumps(value):
+    """``value`` as compact UTF-8 JSON bytes."""
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(
+        value, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+
+def rfc3339(local_dt):
+    """One of our naive local datetimes as an RFC 3339 UTC timestamp."""
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ',
+                         time.gmtime(to_timestamp(local_dt)))
+
+
+def entry_json(request, entry):
+    """An entry's ``to_dict``, with its last update, as JSON bytes."""
+    data = entry.to_dict()
+    data['updated'] = rfc3339(entry.updated_at)
+    return dumps(data)
+
+
+def entry_atom(request, entry):
+    """An entry as an Atom ``<entry>`` element."""
+    url = request.route_url('detail', id=entry.id)
+    return (
+        u'<entry><id>{url}</id><title>{title}</title><link href={link}/>'
+        u'<published>{published}</published><updated>{updated}</updated>'
+        u'<summary>{summary}</summary>'
+        u'<content type="html">{content}</content></entry>'
+    ).format(
+        url=escape(url),
+        link=quoteattr(url),
+        title=escape(entry.title or u''),
+        published=rfc3339(entry.creation_date),
+        updated=rfc3339(entry.updated_at),
+        summary=escape(entry.excerpt or u''),
+        content=escape(entry.body_html or u''),
+    ).encode('utf-8')
+
+
+def atom_feed(request, title, author, updated, entries):
+    """Wrap serialized ``<entry>`` elements in an Atom ``<feed>``."""
+    home = request.route_url('home')
+    head = (
+        u'<?xml version="1.0" encoding="utf-8"?>\n'
+        u'<feed xmlns="{namespace}"><title>{title}</title><id>{home}</id>'
+        u'<link href={home_link}/><link rel="self" href={self_link}/>'
+        u'<updated>{updated}</updated><author><name>{author}</name></author>'
+    ).format(
+        namespace=ATOM_NAMESPACE,
+        title=escape(title),
+        home=escape(home),
+        home_link=quoteattr(home),
+        self_link=quoteattr(request.route_url('feed')),
+        updated=rfc3339(updated),
+        author=escape(author),
+    ).encode('utf-8')
+    return head + b''.join(entries) + b'</feed>'
+
+
+def fragments(request, rows, render):
+    """The serialized bytes of each ``(id, updated_at)`` row, in order.
+
+    Fragments missing from the cache are rendered from their entries,
+    loaded in one query, and stored for next time.
+    """
+    cache = request.registry.get('page_cache')
+    backend = cache.backend if cache is not None else None
+
+    def key(entry_id, updated_at):
+        # Atom fragments hold absolute links, so the host is in the key.
+        return FRAGMENT_KEY.format(render.__name__, request.host_url,
+                                   entry_id, updated_at.isoformat())
+    found = {}
+    if backend is not None:
+        for row in rows:
+            value = backend.get(key(row.id, row.updated_at))
+            if value is not None:
+                found[row.id] = value
+    missing = [row.id for row in rows if row.id not in found]
+    if missing:
+        entries = request.dbsession.query(Entry).filter(Entry.id.in_(missing))
+        for entry in entries:
+            found[entry.id] = render(request, entry)
+            if backend is not None:
+                backend.set(key(entry.id, entry.updated_at), found[entry.id])
+    return [found[row.id] for row in rows if row.id in found]
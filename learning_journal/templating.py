@@ -0,0 +1,127 @@
+"""Compile the Jinja2 templates ahead of time and warm the app up.
+
+With ``jinja2.bytecode_caching`` on, compiled templates are kept in
+``jinja2.bytecode_caching_directory`` and survive restarts. The
+``precompile2`` script fills that directory before the server starts,
+and with ``warmup.enabled`` on, ``main`` compiles every template and
+serves each public page once before it returns the app.
+
+``stream_template`` renders a template as it goes, for pages too long
+to build in memory before sending.
+"""
+
+
+import logging
+import os
+
+from jinja2 import meta
+from pyramid.settings import asbool
+from pyramid_jinja2 import IJinja2Environment
+from webob import Request
+
+from .models import Entry
+
+log = logging.getLogger(__name__)
+
+TEMPLATE_DIRECTORY = os.path.join(os.path.dirname(__file__), 'templates')
+TEMPLATE_SPEC = 'learning_journal:templates/{}'
+WARMUP_PATHS = ('/', '/search?q=journal', '/login', '/no-such-page')
+STREAM_CHUNK_SIZE = 16 * 1024
+
+
+def template_names():
+    """Asset specs of every template, as the views name them."""
+    return [
+        TEMPLATE_SPEC.format(name)
+        for name in sorted(os.listdir(TEMPLATE_DIRECTORY))
+        if name.endswith('.jinja2')
+    ]
+
+
+def compile_templates(env, names=None):
+    """Load each template and every template it extends or includes.
+
+    Loading compiles a template, or reads it from the bytecode cache. A
+    parent is cached once per child that extends it, under the name
+    ``env.join_path`` gives it, so parents are loaded that way too.
+    Returns the names loaded.
+    """
+    pending = list(names or template_names())
+    loaded = set()
+    while pending:
+        name = pending.pop()
+        if name in loaded:
+            continue
+        env.get_template(name)
+        loaded.add(name)
+        source = env.loader.get_source(env, name)[0]
+        for reference in meta.find_referenced_templates(env.parse(source)):
+            if reference is not None:
+                pending.append(env.join_path(reference, name))
+    return sorted(loaded)
+
+
+def warm_up(app):
+    """Compile the templates and serve each public page once.
+
+    Failures are logged, not raised: a cold page is better than no app.
+    """
+    compile_templates(
+        app.registry.queryUtility(IJinja2Environment, name='.jinja2'))
+    paths = list(WARMUP_PATHS)
+    dbsession = app.registry['dbsession_factory']()
+    try:
+        latest = dbsession.query(Entry.id).order_by(
+            Entry.creation_date.desc()).first()
+        if latest is not None:
+            paths.append('/journal/{}'.format(latest.id))
+    except Exception:
+        log.exception('Warm-up could not look up the latest entry')
+    finally:
+        dbsession.close()
+    for path in paths:
+        try:
+            response = Request.blank(path).get_response(app)
+        except Exception:
+            log.exception('Warm-up request for %s failed', path)
+            continue
+        log.info('Warmed up %s (%s)', path, response.status)
+
+
+def stream_template(request, name, values, chunk_size=STREAM_CHUNK_SIZE):
+    """Yield the rendered template as UTF-8 chunks of about ``chunk_size``.
+
+    Jinja2's ``generate()`` runs the template only as far as each chunk
+    needs, so iterators in ``values`` are consumed as the page is sent.
+    """
+    env = request.registry.queryUtility(IJinja2Environment, name='.jinja2')
+    template = env.get_template(name)
+    context = dict(values, request=request,
+                   context=getattr(request, 'context', None))
+    pending, size = [], 0
+    for piece in template.generate(context):
+        pending.append(piece)
+        size += len(piece)
+        if size >= chunk_size:
+            yield u''.join(pending).encode('utf-8')
+            pending, size = [], 0
+    if pending:
+        yield u''.join(pending).encode('utf-8')
+
+
+def ensure_cache_directory(settings):
+    """Create the bytecode cache directory, which Jinja2 will not do."""
+    directory = settings.get('jinja2.bytecode_caching_directory')
+    if asbool(settings.get('jinja2.bytecode_caching')) and directory:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+
+def includeme(config):
+    """Prepare the bytecode cache directory.
+
+    Activate this setup using
+    ``config.include('learning_journal.templating')`` after
+    ``pyramid_jinja2``.
+    """
+    ensure_cache_directory(config.registry.settings)
@@ -13,16 +13,19 @@ from learning_journal.models.meta import Base
 from datetime import datetime
 from pyramid.httpexceptions import HTTPNotFound, HTTPFound, HTTPBadRequest
 from faker import Faker
+import os
 import random
 
 FAKE = Faker()
+TEST_DATABASE_URL = os.environ.get(
+    'TEST_DATABASE_URL', 'postgresql://localhost:5432/test-learning-journal')
 
 
 @pytest.fixture(scope='session')
 def configuration(request):
     """Config stuff for testing."""
     config = testing.setUp(settings={
-        'sqlalchemy.url': 'postgres://localhost:5432/test-learning-journal'
+        'sqlalchemy.url': TEST_DATABASE_URL
     })
     config.include('learning_journal.models')
 
@@ -54,13 +57,26 @@ def dummy_req(db_session):
 
 
 def test_list_view_returns_list_of_entries_in_dict(dummy_req):
-    """Test list view returns a list of all the entries as dicts."""
+    """Test list view returns a list of entry summaries in a dict."""
     from learning_journal.views.default import list_view
     response = list_view(dummy_req)
     assert 'entries' in response
     assert isinstance(response['entries'], list)
 
 
+def test_list_view_entries_are_summaries_without_body(dummy_req):
+    """Test list view hands the template summaries, not full entries."""
+    from learning_journal.views.default import list_view
+    from learning_journal.models import Entry, EntrySummary
+    dummy_req.dbsession.add(Entry(title='Title Here', body='Body Here'))
+    dummy_req.dbsession.commit()
+    response = list_view(dummy_req)
+    summary = response['entries'][0]
+    assert isinstance(summary, EntrySummary)
+    assert summary.title == 'Title Here'
+    assert not hasattr(summary, 'body')
+
+
 def test_entry_exisits_and_is_in_list(dummy_req):
     """Test that a dummy request creates a new entry."""
     from learning_journal.views.default import list_view
@@ -72,7 +88,42 @@ def test_entry_exisits_and_is_in_list(dummy_req):
     dummy_req.dbsession.add(new_entry)
     dummy_req.dbsession.commit()
     response = list_view(dummy_req)
-    assert new_entry.to_dict() in response['entries']
+    assert new_entry.id in [entry.id for entry in response['entries']]
+
+
+def test_list_view_pages_entries_newest_first(dummy_req):
+    """Test list view splits entries into pages linked by cursors."""
+    from learning_journal.views.default import list_view
+    from learning_journal.models import Entry
+    for i in range(25):
+        dummy_req.dbsession.add(Entry(
+            title='entry #{}'.format(i),
+            body='body',
+            creation_date=datetime(2017, 11, 1, 0, i)
+        ))
+    dummy_req.dbsession.commit()
+    first = list_view(dummy_req)
+    assert len(first['entries']) == 20
+    assert first['entries'][0].title == 'entry #24'
+    assert first['page'].newer is None
+    dummy_req.GET['before'] = first['page'].older
+    second = list_view(dummy_req)
+    assert [e.title for e in second['entries']] == [
+        'entry #{}'.format(i) for i in range(4, -1, -1)
+    ]
+    assert second['page'].older is None
+    del dummy_req.GET['before']
+    dummy_req.GET['after'] = second['page'].newer
+    back = list_view(dummy_req)
+    assert [e.id for e in back['entries']] == [e.id for e in first['entries']]
+
+
+def test_list_view_raises_httpbadrequest_for_invalid_cursor(dummy_req):
+    """Test list view raises HTTPBadRequest for a garbled cursor."""
+    from learning_journal.views.default import list_view
+    dummy_req.GET['before'] = 'not-a-cursor'
+    with pytest.raises(HTTPBadRequest):
+        list_view(dummy_req)
 
 
 def test_detail_view_returns_details_of_entry_in_dict(dummy_req):
@@ -99,6 +150,72 @@ def test_detail_view_raises_httpnotfound_for_invalid_id(dummy_req):
         detail_view(dummy_req)
 
 
+def test_detail_view_sets_etag_and_last_modified(dummy_req):
+    """Test detail view tags the response with cache validators."""
+    from learning_journal.views.default import detail_view
+    from learning_journal.models import Entry
+    new_entry = Entry(title='Title Here', body='Body Here')
+    dummy_req.dbsession.add(new_entry)
+    dummy_req.dbsession.commit()
+    dummy_req.matchdict['id'] = new_entry.id
+    detail_view(dummy_req)
+    assert dummy_req.response.etag
+    assert dummy_req.response.last_modified
+
+
+def test_detail_view_returns_not_modified_for_matching_etag(dummy_req):
+    """Test detail view answers a matching If-None-Match with a 304."""
+    from learning_journal.views.default import detail_view
+    from learning_journal.models import Entry
+    from pyramid.httpexceptions import HTTPNotModified
+    new_entry = Entry(title='Title Here', body='Body Here')
+    dummy_req.dbsession.add(new_entry)
+    dummy_req.dbsession.commit()
+    dummy_req.matchdict['id'] = new_entry.id
+    detail_view(dummy_req)
+    etag = dummy_req.response.etag
+    revalidation = testing.DummyRequest(dbsession=dummy_req.dbsession)
+    revalidation.matchdict['id'] = new_entry.id
+    revalidation.headers['If-None-Match'] = '"{}"'.format(etag)
+    assert isinstance(detail_view(revalidation), HTTPNotModified)
+
+
+def test_list_view_etag_changes_when_an_entry_is_updated(dummy_req):
+    """Test list view's ETag follows the entries' updated_at."""
+    from learning_journal.views.default import list_view
+    from learning_journal.models import Entry
+    new_entry = Entry(title='Title Here', body='Body Here')
+    dummy_req.dbsession.add(new_entry)
+    dummy_req.dbsession.commit()
+    list_view(dummy_req)
+    etag = dummy_req.response.etag
+    new_entry.updated_at = datetime.now()
+    dummy_req.dbsession.commit()
+    request = testing.DummyRequest(dbsession=dummy_req.dbsession)
+    list_view(request)
+    assert request.response.etag != etag
+
+
+def test_list_view_last_modified_follows_writes_to_other_pages(dummy_req):
+    """Test a write off the page still moves Last-Modified, for the sidebar."""
+    from learning_journal.pagination import DEFAULT_PAGE_SIZE
+    from learning_journal.views.default import list_view
+    old = Entry(title='Old', body='body', creation_date=datetime(2017, 1, 1))
+    dummy_req.dbsession.add(old)
+    dummy_req.dbsession.add_all([
+        Entry(title='New', body='body', creation_date=datetime(2017, 2, day))
+        for day in range(1, DEFAULT_PAGE_SIZE + 1)])
+    dummy_req.dbsession.flush()
+    list_view(dummy_req)
+    before = dummy_req.response.last_modified
+    old.updated_at = datetime(2018, 1, 1)
+    dummy_req.dbsession.flush()
+    request = testing.DummyRequest(dbsession=dummy_req.dbsession)
+    result = list_view(request)
+    assert 'Old' not in [entry.title for entry in result['entries']]
+    assert request.response.last_modified > before
+
+
 def test_create_view_returns_empty_dict(dummy_req):
     """Test create view returns an empty dict."""
     from learning_journal.views.default import create_view
@@ -140,13 +257,13 @@ def testapp(request):
     def main():
         config = Configurator()
         settings = {
-            'sqlalchemy.url': 'postgres://localhost:5432/test-learning-journal'
+            'sqlalchemy.url': TEST_DATABASE_URL
         }
         config = Configurator(settings=settings)
         config.include('pyramid_jinja2')
         config.include('.routes')
         config.include('.models')
-        config.scan()
+        config.include('.views')
         return config.make_wsgi_app()
 
     app = main()
@@ -186,6 +303,34 @@ def test_home_route_has_all_entries(testapp, fill_the_db):
     assert len(ENTRIES) == len(response.html.find_all('hr')) - 1
 
 
+def test_archive_route_streams_every_entry(testapp, fill_the_db):
+    """Test the archive lists every entry, sent without a Content-Length."""
+    from webob import Request
+    response = testapp.get('/archive')
+    titles = [link.text for link in response.html.select('li a')]
+    assert set('title #{}'.format(i) for i in range(20)) <= set(titles)
+    streamed = Request.blank('/archive').get_response(testapp.app)
+    assert streamed.content_length is None
+    assert b''.join(streamed.app_iter) == response.body
+
+
+def test_api_and_feed_routes_serve_entries(testapp, fill_the_db):
+    """Test the JSON API pages entries, revalidates, and the feed parses."""
+    import xml.etree.ElementTree as ElementTree
+    first = testapp.get('/api/entries?limit=5')
+    assert len(first.json['entries']) == 5
+    assert set(first.json['entries'][0]) >= {'id', 'title', 'body'}
+    older = testapp.get(first.json['links']['older'])
+    assert older.json['entries'][0]['id'] not in [
+        entry['id'] for entry in first.json['entries']]
+    testapp.get('/api/entries?limit=5', status=304,
+                headers={'If-None-Match': first.headers['ETag']})
+    entry = testapp.get('/api/entries/1')
+    assert entry.json['id'] == 1
+    feed = ElementTree.fromstring(testapp.get('/feed.atom').body)
+    assert feed.findall('{http://www.w3.org/2005/Atom}entry')
+
+
 def test_create_route_has_empty_form(testapp):
     """Test that the page on the create route has empty form."""
     response = testapp.get('/journal/new-entry')
@@ -205,6 +350,7 @@ def test_detail_route_has_one_entry(testapp):
     response = testapp.get('/journal/1')
     assert 1 == len(response.html.find_all('h2'))
     assert 'title #0' in str(response.html.find('h2'))
+    assert 'History' not in response.text
 
 
 def test_update_route_has_filled_form(testapp):
@@ -218,4 +364,1068 @@ def test_update_route_has_filled_form(testapp):
 #     """Test that the update function correctly updates the original."""
 #     response = testapp.get('/journal/1/edit-entry')
 #     assert 1 == len(response.html.find_all('form'))
-#     assert '
\ No newline at end of file
+#     assert '
+
+
+# Page cache
+# ==========
+
+
+def test_memory_backend_evicts_least_recently_used():
+    """Test the memory cache drops the least recently used key when full."""
+    from learning_journal.cache import MemoryBackend
+    cache = MemoryBackend(max_entries=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+    assert cache.get('a') == 1
+    assert cache.get('b') is None
+    assert cache.get('c') == 3
+
+
+def test_memory_backend_expires_values_after_ttl():
+    """Test the memory cache forgets values older than its TTL."""
+    from learning_journal.cache import MemoryBackend
+    cache = MemoryBackend(ttl=-1)
+    cache.set('a', 1)
+    assert cache.get('a') is None
+
+
+def test_sqlite_backend_round_trips_values(tmpdir):
+    """Test the SQLite cache stores and deletes values."""
+    from learning_journal.cache import SQLiteBackend
+    cache = SQLiteBackend(str(tmpdir.join('cache.sqlite')))
+    cache.set('a', ('200 OK', [], b'body'))
+    assert cache.get('a') == ('200 OK', [], b'body')
+    cache.delete('a')
+    assert cache.get('a') is None
+
+
+def test_sqlite_backend_stores_values_without_pickling(tmpdir):
+    """Test pages, tokens and fragments come back as stored, from columns."""
+    import sqlite3
+    from learning_journal.cache import SQLiteBackend
+    path = str(tmpdir.join('cache.sqlite'))
+    cache = SQLiteBackend(path)
+    page = ('200 OK', [('Content-Type', 'text/html')], b'<p>hi</p>')
+    cache.set('page', page)
+    cache.set('gen:entries', 'abc123')
+    cache.set('fragment', b'{"id":1}')
+    assert cache.get('page') == page
+    assert cache.get('gen:entries') == 'abc123'
+    assert cache.get('fragment') == b'{"id":1}'
+    meta = sqlite3.connect(path).execute(
+        "SELECT meta FROM cache_entries WHERE key = 'page'").fetchone()[0]
+    assert meta == '["200 OK", [["Content-Type", "text/html"]]]'
+
+
+def test_sqlite_backend_evicts_oldest_in_batches(tmpdir):
+    """Test surplus values are dropped, oldest first, every few writes."""
+    from learning_journal.cache import SQLiteBackend
+    cache = SQLiteBackend(str(tmpdir.join('cache.sqlite')), max_entries=2)
+    cache.EVICT_EVERY = 4
+    for number in range(4):
+        cache.set(str(number), b'value')
+    assert [cache.get(str(number)) for number in range(4)] == [
+        None, None, b'value', b'value']
+
+
+def test_cache_page_serves_cached_response_until_invalidated():
+    """Test a cached page is reused until its tag is invalidated."""
+    from pyramid.response import Response
+    from learning_journal.cache import MemoryBackend, PageCache, cache_page
+    calls = []
+
+    def view(context, request):
+        calls.append(1)
+        return Response('call #{}'.format(len(calls)))
+
+    request = testing.DummyRequest()
+    request.matchdict = {'id': '3'}
+    request.matched_route = None
+    cache = PageCache(MemoryBackend())
+    request.registry['page_cache'] = cache
+    try:
+        cached_view = cache_page('entry:{id}')(view)
+        assert cached_view(None, request).text == 'call #1'
+        assert cached_view(None, request).text == 'call #1'
+        cache.invalidate('entry:3')
+        assert cached_view(None, request).text == 'call #2'
+    finally:
+        del request.registry['page_cache']
+
+
+# Full-text search
+# ================
+
+
+def test_inverted_index_ranks_entries_matching_every_term():
+    """Test the inverted index only returns entries with all query terms."""
+    from learning_journal.search import InvertedIndex
+    index = InvertedIndex()
+    index.add(1, 'Heaps', '<p>A heap is a tree.</p>')
+    index.add(2, 'Heaps of heaps', '<p>Heaps, heaps and more heaps.</p>')
+    index.add(3, 'Graphs', '<p>Nothing to see.</p>')
+    total, ranked = index.search('heap tree')
+    assert total == 1
+    assert [entry_id for entry_id, _ in ranked] == [1]
+    total, ranked = index.search('heaps')
+    assert [entry_id for entry_id, _ in ranked] == [2, 1]
+
+
+def test_inverted_index_forgets_removed_entries():
+    """Test a removed entry no longer matches."""
+    from learning_journal.search import InvertedIndex
+    index = InvertedIndex()
+    index.add(1, 'Heaps', 'heap')
+    index.remove(1)
+    assert index.search('heap') == (0, [])
+    assert len(index) == 0
+
+
+@pytest.fixture
+def search_req(dummy_req):
+    """Make a dummy request and drop any search index it builds."""
+    yield dummy_req
+    dummy_req.registry.pop('search_index', None)
+
+
+def test_search_view_finds_matching_entries(search_req):
+    """Test search view returns only the entries matching the query."""
+    from learning_journal.views.default import search_view
+    from learning_journal.models import Entry
+    search_req.dbsession.add(Entry(title='Heaps', body='<p>Heaps today.</p>'))
+    search_req.dbsession.add(Entry(title='Graphs', body='<p>Graphs.</p>'))
+    search_req.dbsession.commit()
+    search_req.GET['q'] = 'heaps'
+    response = search_view(search_req)
+    assert response['total'] == 1
+    assert [entry.title for entry in response['entries']] == ['Heaps']
+
+
+def test_search_finds_entries_written_by_other_processes(search_req):
+    """Test a search catches the index up with writes it never saw."""
+    from learning_journal.views.default import search_view
+    search_req.dbsession.add(Entry(title='Heaps', body='<p>Heaps.</p>'))
+    search_req.dbsession.flush()
+    search_req.GET['q'] = 'heaps'
+    assert search_view(search_req)['total'] == 1
+    search_req.dbsession.connection().execute(Entry.__table__.insert(), {
+        'title': 'More heaps', 'body': 'heaps again',
+        'creation_date': datetime.now(), 'updated_at': datetime.now()})
+    assert search_view(search_req)['total'] == 2
+
+
+def test_search_view_with_no_query_returns_no_entries(search_req):
+    """Test search view without a query just shows the form."""
+    from learning_journal.views.default import search_view
+    response = search_view(search_req)
+    assert response['entries'] == []
+    assert response['total'] == 0
+
+
+# Import, export and seeding scripts
+# ==================================
+
+
+def test_export_entries_streams_every_entry_as_jsonl(db_session):
+    """Test export writes one JSON line per entry, oldest id first."""
+    import io
+    import json
+    from learning_journal.scripts.transfer import Progress, export_entries
+    for i in range(5):
+        db_session.add(Entry(title='title #{}'.format(i), body='body'))
+    db_session.commit()
+    out = io.StringIO()
+    progress = Progress('exported', out=io.StringIO())
+    export_entries(db_session.bind, out, 'jsonl', 2, progress)
+    lines = [json.loads(line) for line in out.getvalue().splitlines()]
+    assert [line['title'] for line in lines] == [
+        'title #{}'.format(i) for i in range(5)
+    ]
+    assert progress.count == 5
+
+
+def test_import_entries_inserts_csv_rows_in_batches(db_session):
+    """Test import loads every CSV row, batch by batch."""
+    import io
+    from learning_journal.models import EntryLink
+    from learning_journal.scripts.transfer import Progress, import_entries
+    data = io.StringIO(
+        'id,title,body,creation_date,updated_at\n'
+        ',First,<p>one</p>,2017-11-01T10:00:00.000000,\n'
+        ',Second,<p>two</p>,2017-11-02T10:00:00,\n'
+        ',Third,<p>three</p>,,\n'
+    )
+    progress = Progress('imported', out=io.StringIO())
+    import_entries(db_session.bind, data, 'csv', 2, progress)
+    titles = [entry.title for entry in db_session.query(Entry)]
+    assert sorted(titles) == ['First', 'Second', 'Third']
+    assert progress.count == 3
+    # Links are left to linkdb2 unless asked for.
+    assert db_session.query(EntryLink).count() == 0
+    import_entries(db_session.bind, io.StringIO('id,title,body\n'), 'csv',
+                   2, progress, related_count=5)
+    assert db_session.query(EntryLink).filter(
+        EntryLink.kind == 'next').count() == 2
+
+
+def test_seed_entries_only_writes_new_or_changed_entries(db_session):
+    """Test seeding twice is a no-op and only changed entries update."""
+    from learning_journal.scripts.initializedb import seed_entries
+    from learning_journal.data.entry_history import ENTRIES
+    from learning_journal.links import rebuild_links
+    from learning_journal.models import EntryLink
+    first = seed_entries(db_session, ENTRIES)
+    assert len(first['inserted']) == len(ENTRIES)
+    again = seed_entries(db_session, ENTRIES)
+    assert again['inserted'] == again['updated'] == []
+    assert len(again['unchanged']) == len(ENTRIES)
+    db_session.query(Entry).get(ENTRIES[0]['id']).title = 'Edited'
+    db_session.flush()
+    repaired = seed_entries(db_session, ENTRIES)
+    assert repaired['updated'] == [ENTRIES[0]['id']]
+    db_session.expire_all()
+    assert db_session.query(Entry).get(ENTRIES[0]['id']).title == (
+        ENTRIES[0]['title']
+    )
+    moved = db_session.query(Entry).order_by(
+        Entry.creation_date.desc(), Entry.id.desc()).first()
+    moved.creation_date = datetime(1900, 1, 1)
+    db_session.flush()
+    rebuild_links(db_session.connection())
+    assert seed_entries(db_session, ENTRIES)['updated'] == [moved.id]
+    in_order = [row.id for row in db_session.query(Entry.id).order_by(
+        Entry.creation_date, Entry.id)]
+    assert in_order[-1] == moved.id
+    following = dict(db_session.query(
+        EntryLink.entry_id, EntryLink.target_id).filter(
+        EntryLink.kind == 'next'))
+    assert [following.get(entry_id) for entry_id in in_order] == (
+        in_order[1:] + [None])
+    assert db_session.query(EntryLink).filter(
+        EntryLink.kind == 'related').count() > 0
+
+
+# Stored entry fields and revisions
+# =================================
+
+
+def test_render_body_strips_unsafe_markup():
+    """Test the stored HTML keeps safe tags and drops scripts and handlers."""
+    from learning_journal.rendering import render_body
+    html, text = render_body(
+        '<p onclick="x()">Hi <a href="javascript:x()">there</a></p>'
+        '<script>alert(1)</script><em>bye'
+    )
+    assert html == '<p>Hi <a>there</a></p><em>bye</em>'
+    assert text == 'Hi there bye'
+
+
+def test_entry_stores_derived_fields_when_written(configuration, dummy_req):
+    """Test an entry's display fields are computed when it is written."""
+    from learning_journal.views.default import update_view
+    configuration.add_route('detail', r'/journal/{id:\d+}')
+    entry = Entry(
+        title='Title', body='<p>one two</p>',
+        creation_date=datetime(2017, 11, 1, 10, 0)
+    )
+    dummy_req.dbsession.add(entry)
+    dummy_req.dbsession.flush()
+    assert entry.body_html == '<p>one two</p>'
+    assert entry.word_count == 2
+    assert entry.display_date == entry.creation_date.strftime(
+        '%A, %B %d, %Y at %I:%M%p')
+    dummy_req.method = 'POST'
+    dummy_req.POST = {'title': 'Title', 'body': '<p>' + 'word ' * 100}
+    dummy_req.matchdict['id'] = entry.id
+    update_view(dummy_req)
+    assert entry.word_count == 100
+    assert entry.excerpt.endswith('\u2026')
+    assert len(entry.excerpt) <= 201
+
+
+def test_delta_rebuilds_new_text_and_is_smaller():
+    """Test a delta turns the old body into the new one compactly."""
+    from learning_journal.revisions import apply_delta, make_delta
+    old = 'Today I learned about  Pyramid.\n\n' + 'More words here. ' * 50
+    new = old.replace('Pyramid', 'Pyramid views') + u'\nCaf\xe9 at  the end '
+    delta = make_delta(old, new)
+    assert apply_delta(old, delta) == new
+    assert len(delta) < len(new) / 4
+    assert apply_delta('', make_delta('', 'x')) == 'x'
+
+
+def test_edits_are_stored_as_revisions_and_rebuilt(configuration, dummy_req):
+    """Test edits add revisions, snapshots bound replay, history shows one."""
+    from learning_journal.models import EntryRevision
+    from learning_journal.revisions import add_revision, reconstruct
+    from learning_journal.views.default import history_view, update_view
+    configuration.add_route('detail', r'/journal/{id:\d+}')
+    entry = Entry(title='First', body='one two three')
+    dummy_req.dbsession.add(entry)
+    dummy_req.dbsession.flush()
+    dummy_req.method = 'POST'
+    dummy_req.matchdict['id'] = entry.id
+    dummy_req.POST = {'title': 'Second', 'body': 'one 2 three'}
+    update_view(dummy_req)
+    revisions = dummy_req.dbsession.query(EntryRevision).order_by(
+        EntryRevision.number).all()
+    assert [(r.number, r.snapshot) for r in revisions] == [
+        (1, True), (2, False)]
+    dummy_req.method = 'GET'
+    dummy_req.GET['revision'] = '2'
+    selected = history_view(dummy_req)['selected']
+    assert selected['body'] == 'one 2 three'
+    assert selected['diff'][-2:] == ['-one two three', '+one 2 three']
+    body = 'one 2 three'
+    for number in range(3, 8):
+        previous, body = body, body + ' {}'.format(number)
+        add_revision(dummy_req.dbsession, entry.id, 'Title', body, previous,
+                     number=number, interval=3)
+    dummy_req.dbsession.flush()
+    revision, rebuilt = reconstruct(dummy_req.dbsession, entry.id, 6)
+    assert rebuilt == 'one 2 three 3 4 5 6'
+    assert dummy_req.dbsession.query(EntryRevision).get(revision.id - 2)\
+        .snapshot
+
+
+# Month archive
+# =============
+
+
+def test_month_counts_follow_writes_and_serve_month_pages(configuration,
+                                                         dummy_req):
+    """Test writes keep the month counts current for the month pages."""
+    from learning_journal.months import (
+        add_month_counts,
+        month_links,
+        rebuild_month_counts,
+    )
+    from learning_journal.views.default import create_view, month_view
+    configuration.add_route('home', '/')
+    dummy_req.method = 'POST'
+    dummy_req.POST = {'title': 'New', 'body': 'body'}
+    create_view(dummy_req)
+    old = [Entry(title='Old {}'.format(day), body='body',
+                 creation_date=datetime(2017, 11, day, 12)) for day in (9, 10)]
+    dummy_req.dbsession.add_all(old)
+    dummy_req.dbsession.flush()
+    conn = dummy_req.dbsession.connection()
+    add_month_counts(conn, [entry.creation_date for entry in old])
+    now = datetime.now()
+    counts = [(now.year, now.month, 1), (2017, 11, 2)]
+    links = month_links(dummy_req.dbsession)
+    assert [(link.year, link.month, link.count) for link in links] == counts
+    assert rebuild_month_counts(conn) == 2
+    assert [(link.year, link.month, link.count)
+            for link in month_links(dummy_req.dbsession)] == counts
+    dummy_req.method = 'GET'
+    dummy_req.matchdict = {'year': '2017', 'month': '11'}
+    result = month_view(dummy_req)
+    assert [entry.title for entry in result['entries']] == ['Old 10', 'Old 9']
+    assert result['total'] == 2
+    dummy_req.matchdict['month'] = '12'
+    with pytest.raises(HTTPNotFound):
+        month_view(dummy_req)
+
+
+# Batch API
+# =========
+
+
+def test_batches_are_validated_whole_then_written_in_bulk(dummy_req):
+    """Test a batch creates and updates entries or, if invalid, nothing."""
+    from learning_journal.batch import BatchError, apply_batch, parse_items
+    from learning_journal.months import month_count
+    from learning_journal.revisions import reconstruct
+    dummy_req.tm = transaction.TransactionManager()
+    entry = Entry(title='Old', body='old body')
+    dummy_req.dbsession.add(entry)
+    dummy_req.dbsession.flush()
+    with pytest.raises(BatchError) as error:
+        parse_items([{'title': 'New', 'body': 'body'},
+                     {'id': entry.id, 'title': 1, 'body': 'body'},
+                     {'id': entry.id, 'title': 'Edit', 'body': 'body'}])
+    assert [e['index'] for e in error.value.errors] == [1, 2]
+    with pytest.raises(BatchError) as error:
+        apply_batch(dummy_req, parse_items([
+            {'title': 'New', 'body': 'body'},
+            {'id': entry.id + 1, 'title': 'Edit', 'body': 'body'}]))
+    assert error.value.errors == [
+        {'index': 1, 'error': 'no entry {}'.format(entry.id + 1)}]
+    assert dummy_req.dbsession.query(Entry).count() == 1
+    results = apply_batch(dummy_req, parse_items([
+        {'title': 'New', 'body': '<b>new</b> body'},
+        {'id': entry.id, 'title': 'Edit', 'body': 'new body'},
+        {'title': 'Newer', 'body': 'newer body'}]))
+    assert results == [
+        (entry.id + 1, True), (entry.id, False), (entry.id + 2, True)]
+    dummy_req.dbsession.expire_all()
+    created = dummy_req.dbsession.query(Entry).get(entry.id + 1)
+    assert created.excerpt == 'new body'
+    assert dummy_req.dbsession.query(Entry).get(entry.id + 2).title == 'Newer'
+    assert reconstruct(dummy_req.dbsession, entry.id + 2, 1)[1] == 'newer body'
+    assert dummy_req.dbsession.query(Entry).get(entry.id).title == 'Edit'
+    assert reconstruct(dummy_req.dbsession, entry.id, 1)[1] == 'old body'
+    assert reconstruct(dummy_req.dbsession, entry.id, 2)[1] == 'new body'
+    now = datetime.now()
+    assert month_count(dummy_req.dbsession, now.year, now.month) == 2
+    dummy_req.tm.abort()
+
+
+def test_batch_view_refuses_bodies_that_are_not_json(dummy_req):
+    """Test a cross-site text/plain post is turned away before parsing."""
+    import json
+    from learning_journal.views.api import api_batch_view
+    dummy_req.method = 'POST'
+    dummy_req.content_type = 'text/plain'
+    dummy_req.body = b'[{"title": "Forged", "body": "body"}]'
+    response = api_batch_view(dummy_req)
+    assert response.status_int == 415
+    assert json.loads(response.text)['errors'][0]['error'] == \
+        'expected application/json'
+    assert dummy_req.dbsession.query(Entry).count() == 0
+
+
+# Entry links
+# ===========
+
+
+def test_entry_links_are_rebuilt_then_kept_current(configuration,
+                                                   dummy_req):
+    """Test the batch links entries by date and body, and writes relink."""
+    from learning_journal.links import entry_links, rebuild_links
+    from learning_journal.views.default import create_view, update_view
+    configuration.add_route('home', '/')
+    configuration.add_route('detail', '/journal/{id}')
+    cats, dogs, kittens = entries = [
+        Entry(title='Cats', body='cats purr and nap in the sun',
+              creation_date=datetime(2017, 1, 1)),
+        Entry(title='Dogs', body='dogs bark and fetch sticks outside',
+              creation_date=datetime(2017, 1, 2)),
+        Entry(title='Kittens', body='kittens purr and nap all day',
+              creation_date=datetime(2017, 1, 3)),
+    ]
+    dummy_req.dbsession.add_all(entries)
+    dummy_req.dbsession.flush()
+    index = rebuild_links(dummy_req.dbsession.connection())
+    dummy_req.registry['related_index'] = index
+    try:
+        links = entry_links(dummy_req.dbsession, dogs.id)
+        assert (links.previous.title, links.next.title) == ('Cats', 'Kittens')
+        assert entry_links(dummy_req.dbsession, cats.id).related[0].title \
+            == 'Kittens'
+        dummy_req.method = 'POST'
+        dummy_req.POST = {'title': 'Naps', 'body': 'kittens nap in the sun'}
+        create_view(dummy_req)
+        links = entry_links(dummy_req.dbsession, kittens.id)
+        assert links.next.title == 'Naps'
+        new = entry_links(dummy_req.dbsession, links.next.id)
+        assert new.previous.title == 'Kittens' and new.next is None
+        assert set(['Cats', 'Kittens']) <= set(
+            target.title for target in new.related)
+        dummy_req.matchdict['id'] = dogs.id
+        dummy_req.POST = {'title': 'Dogs', 'body': 'dogs purr and nap'}
+        update_view(dummy_req)
+        assert 'Dogs' in [target.title for target in entry_links(
+            dummy_req.dbsession, cats.id).related]
+    finally:
+        del dummy_req.registry['related_index']
+
+
+def test_related_index_catches_up_with_other_processes_writes(db_session):
+    """Test entries written elsewhere since the index was built get added."""
+    from learning_journal.links import catch_up, load_index
+    db_session.add(Entry(title='Cats', body='cats purr and nap in the sun',
+                         creation_date=datetime(2017, 1, 1)))
+    db_session.flush()
+    conn = db_session.connection()
+    index = load_index(conn)
+    assert len(index) == 1
+    conn.execute(Entry.__table__.insert(), {
+        'title': 'Kittens', 'body': 'kittens purr and nap',
+        'creation_date': datetime.now(), 'updated_at': datetime.now()})
+    catch_up(conn, index)
+    assert len(index) == 2
+    kittens = conn.execute("SELECT id FROM entries WHERE title = 'Kittens'")
+    assert index.similar(index.vector('kittens'), 1)[0][0] == \
+        kittens.scalar()
+
+
+# Backfill, template and asset scripts
+# ====================================
+
+
+def test_backfill_adds_indexes_missing_from_existing_tables(db_session):
+    """Test indexes declared after a table was created get created."""
+    from sqlalchemy import inspect
+    from learning_journal.scripts.backfill import add_missing_indexes
+    engine = db_session.bind
+    dropped = ['ix_entries_creation_date_id']
+    if engine.dialect.name == 'postgresql':
+        dropped.append('ix_entries_search')
+    with engine.begin() as conn:
+        for name in dropped:
+            conn.execute('DROP INDEX {}'.format(name))
+    assert sorted(add_missing_indexes(engine)) == sorted(dropped)
+    names = [index['name'] for index in inspect(engine).get_indexes('entries')]
+    assert 'ix_entries_creation_date_id' in names
+    assert add_missing_indexes(engine) == []
+
+
+def test_backfill_entries_fills_missing_derived_fields(db_session):
+    """Test the backfill computes the fields of entries that lack them."""
+    import io
+    from learning_journal.scripts.backfill import backfill_entries
+    from learning_journal.scripts.transfer import Progress
+    for i in range(3):
+        db_session.add(Entry(title='t', body='<b>body {}</b>'.format(i)))
+    db_session.flush()
+    db_session.query(Entry).update({'display_date': None, 'body_html': None})
+    db_session.commit()
+    progress = Progress('backfilled', out=io.StringIO())
+    backfill_entries(db_session.bind, 2, False, progress)
+    db_session.expire_all()
+    entries = db_session.query(Entry).order_by(Entry.id).all()
+    assert [entry.body_html for entry in entries] == [
+        '<b>body 0</b>', '<b>body 1</b>', '<b>body 2</b>']
+    assert all(entry.display_date for entry in entries)
+    assert progress.count == 3
+
+
+def test_compile_templates_writes_every_template_to_bytecode_cache(tmpdir):
+    """Test precompiling caches each template and each parent it extends."""
+    from pyramid.config import Configurator
+    from learning_journal.templating import compile_templates, template_names
+    config = Configurator(settings={
+        'jinja2.bytecode_caching': 'true',
+        'jinja2.bytecode_caching_directory': str(tmpdir),
+    })
+    config.include('pyramid_jinja2')
+    config.commit()
+    names = compile_templates(config.get_jinja2_environment())
+    assert set(template_names()) < set(names)
+    assert 'base.jinja2@@FROM_PARENT@@learning_journal:templates/list.jinja2' \
+        in names
+    assert len(tmpdir.listdir()) == len(names)
+
+
+def test_build_assets_fingerprints_files_and_css_references(tmpdir):
+    """Test the asset build renames files by content and fixes CSS urls."""
+    from learning_journal.scripts.assets import build
+    source = tmpdir.mkdir('static')
+    source.mkdir('fonts').join('icons.woff').write_binary(b'font')
+    source.mkdir('css').join('site.css').write(
+        '@font-face { src: url("../fonts/icons.woff?v=1"); }' + ' ' * 300)
+    manifest = build(str(source), str(source.join('_build')))
+    font = manifest['fonts/icons.woff']
+    assert font.startswith('_build/fonts/icons.') and font.endswith('.woff')
+    css = source.join(manifest['css/site.css'])
+    assert 'url("../fonts/{}?v=1")'.format(font.split('/')[-1]) in css.read()
+    assert source.join(manifest['css/site.css'] + '.gz').check()
+
+
+def test_asset_view_serves_precompressed_copy_with_immutable_caching(tmpdir):
+    """Test built assets are served gzipped when accepted, cached forever."""
+    from learning_journal.assets import AssetView
+    tmpdir.join('site.1234.css').write('body {}')
+    tmpdir.join('site.1234.css.gz').write_binary(b'gzipped')
+    request = testing.DummyRequest(subpath=('site.1234.css',))
+    request.headers['Accept-Encoding'] = 'br;q=0, gzip'
+    response = AssetView(str(tmpdir))(None, request)
+    assert response.content_encoding == 'gzip'
+    assert 'immutable' in response.headers['Cache-Control']
+    request = testing.DummyRequest(subpath=('..', 'site.1234.css'))
+    with pytest.raises(HTTPNotFound):
+        AssetView(str(tmpdir))(None, request)
+
+
+# Compression and serving
+# =======================
+
+
+def test_compression_tween_gzips_large_html_only():
+    """Test the tween gzips big HTML, streams huge HTML, skips the rest."""
+    import gzip
+    from pyramid.response import Response
+    from learning_journal.compression import compression_tween_factory
+    from learning_journal.instrumentation import create_metrics
+
+    class Registry(dict):
+        settings = {
+            'compression.min_size': '100',
+            'compression.stream_threshold': '5000',
+        }
+
+    registry = Registry(metrics=create_metrics())
+    bodies = {
+        '/small': ('text/html', b'<p>hi</p>'),
+        '/page': ('text/html', b'<p>journal</p>' * 200),
+        '/huge': ('text/html', b'<p>journal</p>' * 1000),
+        '/image': ('image/jpeg', b'\xff' * 2000),
+    }
+
+    def handler(request):
+        content_type, body = bodies[request.path]
+        return Response(body=body, content_type=content_type)
+    tween = compression_tween_factory(handler, registry)
+
+    def get(path):
+        request = testing.DummyRequest(path=path)
+        request.matched_route = None
+        request.headers['Accept-Encoding'] = 'gzip, deflate'
+        return tween(request)
+    page = get('/page')
+    assert page.content_encoding == 'gzip'
+    assert gzip.decompress(page.body) == bodies['/page'][1]
+    assert 'Accept-Encoding' in page.vary
+    huge = get('/huge')
+    assert huge.content_length is None
+    assert gzip.decompress(b''.join(huge.app_iter)) == bodies['/huge'][1]
+    assert get('/small').content_encoding is None
+    assert get('/image').content_encoding is None
+    assert 'journal_compression_ratio_count{encoding="gzip",route="none"} 2' \
+        in registry['metrics'].render()
+
+
+def test_asgi_bridge_serves_pages_and_static_and_sheds_load():
+    """Test the ASGI bridge runs the app, serves files and turns away excess."""
+    import asyncio
+    import os
+    from learning_journal.asgi import STATIC_DIRECTORY, WSGIBridge
+    path = os.path.join(STATIC_DIRECTORY, 'theme.css')
+
+    def app(environ, start_response):
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return [environ['PATH_INFO'].encode('utf-8'), b'!']
+
+    def call(bridge, path):
+        scope = {'type': 'http', 'method': 'GET', 'path': path,
+                 'headers': []}
+        sent = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': b''}
+
+        async def send(message):
+            sent.append(message)
+        asyncio.run(bridge(scope, receive, send))
+        return sent[0]['status'], b''.join(
+            message.get('body', b'') for message in sent[1:])
+    bridge = WSGIBridge(app, workers=1, backlog=0)
+    assert call(bridge, '/journal/1') == (200, b'/journal/1!')
+    status, body = call(bridge, '/static/theme.css')
+    assert status == 200 and body == open(path, 'rb').read()
+    assert call(bridge, '/static/../__init__.py')[0] == 404
+    assert call(bridge, '/static/theme\x00.css')[0] == 404
+    bridge.pending = 1
+    assert call(bridge, '/') == (503, b'Server busy')
+
+
+def test_asgi_bridge_worker_waits_for_a_slow_client():
+    """Test a streaming worker gets at most a queue's length ahead."""
+    import asyncio
+    from learning_journal.asgi import RESPONSE_QUEUE_SIZE, WSGIBridge
+    produced = []
+
+    def app(environ, start_response):
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        for number in range(100):
+            produced.append(number)
+            yield b'chunk'
+    ahead = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': b''}
+
+    async def send(message):
+        if message.get('body'):
+            ahead.append(len(produced) - len(ahead))
+        await asyncio.sleep(0.001)
+    scope = {'type': 'http', 'method': 'GET', 'path': '/archive',
+             'headers': []}
+    asyncio.run(WSGIBridge(app, workers=1)(scope, receive, send))
+    assert len(ahead) == 100
+    assert max(ahead) <= RESPONSE_QUEUE_SIZE + 2
+
+
+def test_worker_count_prefers_web_concurrency_then_setting_then_cpus():
+    """Test the pre-fork worker count comes from the environment first."""
+    import multiprocessing
+    from learning_journal.prefork import worker_count
+    settings = {'server.workers': '3'}
+    assert worker_count(settings, {'WEB_CONCURRENCY': '5'}) == 5
+    assert worker_count(settings, {}) == 3
+    assert worker_count({}, {}) == multiprocessing.cpu_count()
+    assert worker_count({}, {'WEB_CONCURRENCY': '0'}) == 1
+
+
+# Read replicas and the connection pool
+# =====================================
+
+
+def test_replica_routing_reads_replica_until_client_writes(tmpdir):
+    """Test GETs read a replica round robin and writers stick to primary."""
+    from learning_journal.models import get_replicas, get_session_factory
+    from learning_journal.models.routing import PRIMARY_COOKIE, ReplicaPolicy
+    from pyramid.response import Response
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import Session
+    primary = create_engine('sqlite:///{}'.format(tmpdir.join('primary.db')))
+    replica_urls = ['sqlite:///{}'.format(tmpdir.join(name))
+                    for name in ('one.db', 'two.db')]
+    replicas = get_replicas({'replicas.urls': ' '.join(replica_urls)})
+    for engine in [primary] + replicas.engines:
+        Base.metadata.create_all(engine)
+        session = Session(bind=engine)
+        session.add(Entry(title=str(engine.url), body='body'))
+        session.commit()
+    factory = get_session_factory(primary, replicas)
+    policy = ReplicaPolicy({})
+
+    def read(method='GET', cookies=None):
+        request = testing.DummyRequest(method=method, cookies=cookies or {})
+        request.matched_route = type('Route', (), {'name': 'detail'})()
+        request.response_callbacks = []
+        request.add_response_callback = request.response_callbacks.append
+        session = policy.route(request, factory())
+        title = session.query(Entry.title).scalar()
+        session.close()
+        return title, request
+    assert [read()[0] for _ in range(3)] == [
+        replica_urls[0], replica_urls[1], replica_urls[0]]
+    title, request = read('POST')
+    assert title == str(primary.url)
+    response = Response()
+    request.response_callbacks[0](request, response)
+    until = response.headers['Set-Cookie'].split(';')[0].split('=')[1]
+    assert read(cookies={PRIMARY_COOKIE: until})[0] == str(primary.url)
+    assert read(cookies={PRIMARY_COOKIE: '1'})[0] in replica_urls
+    session = factory()
+    session.use_replica()
+    session.add(Entry(title='written', body='body'))
+    session.flush()
+    assert session.replica is None
+    session.commit()
+    assert Session(bind=primary).query(Entry).filter_by(
+        title='written').count() == 1
+
+
+def test_cache_page_is_skipped_for_clients_sticking_to_primary():
+    """Test a client that has just written never gets a cached page."""
+    import time
+    from pyramid.registry import Registry
+    from pyramid.response import Response
+    from learning_journal.cache import MemoryBackend, PageCache, cache_page
+    from learning_journal.models.routing import PRIMARY_COOKIE, ReplicaPolicy
+    calls = []
+
+    def view(context, request):
+        calls.append(request)
+        return Response('call #{}'.format(len(calls)))
+    cached_view = cache_page('entries')(view)
+    registry = Registry()
+    registry['page_cache'] = PageCache(MemoryBackend())
+    registry['replica_policy'] = ReplicaPolicy({})
+
+    def get(cookies):
+        request = testing.DummyRequest(cookies=cookies)
+        request.registry = registry
+        request.matched_route = None
+        return cached_view(None, request).text
+    assert get({}) == 'call #1'
+    assert get({}) == 'call #1'
+    until = str(int(time.time()) + 10)
+    assert get({PRIMARY_COOKIE: until}) == 'call #2'
+    assert get({}) == 'call #1'
+
+
+def test_invalidate_later_uses_one_thread_for_every_write():
+    """Test delayed invalidations share a worker and coalesce per tag."""
+    import time
+    from learning_journal.cache import MemoryBackend, PageCache
+    cache = PageCache(MemoryBackend())
+    before = cache._generation('entries')
+    cache.invalidate_later(0.05, 'entries')
+    worker = cache._worker
+    cache.invalidate_later(0.1, 'entries', 'entry:1')
+    assert cache._worker is worker
+    assert cache._generation('entries') == before
+    deadline = time.time() + 5
+    while cache._pending and time.time() < deadline:
+        time.sleep(0.01)
+    assert not cache._pending
+    assert cache._generation('entries') != before
+
+
+def test_serialized_entries_are_cached_until_updated(dummy_req):
+    """Test a fragment is reused until the entry's updated_at moves on."""
+    from learning_journal.cache import MemoryBackend, PageCache
+    from learning_journal.serialization import entry_json, fragments
+    from learning_journal.views.api import api_entry_view
+    entry = Entry(title='Cached', body='body')
+    dummy_req.dbsession.add(entry)
+    dummy_req.dbsession.flush()
+    dummy_req.registry['page_cache'] = PageCache(MemoryBackend())
+    try:
+        dummy_req.matchdict['id'] = entry.id
+        assert b'"Cached"' in api_entry_view(dummy_req).body
+        entry.title = 'Changed'
+        dummy_req.dbsession.flush()
+        row = dummy_req.dbsession.query(
+            Entry.id, Entry.updated_at).filter(Entry.id == entry.id).one()
+        assert b'"Cached"' in fragments(dummy_req, [row], entry_json)[0]
+        entry.updated_at = datetime.now()
+        dummy_req.dbsession.flush()
+        row = dummy_req.dbsession.query(
+            Entry.id, Entry.updated_at).filter(Entry.id == entry.id).one()
+        assert b'"Changed"' in fragments(dummy_req, [row], entry_json)[0]
+    finally:
+        del dummy_req.registry['page_cache']
+
+
+# Connection pool and status views
+# ================================
+
+
+def test_get_engine_sizes_pool_to_server_threads():
+    """Test the pool gets one connection per waitress thread by default."""
+    from learning_journal.models import get_engine
+    engine = get_engine({
+        'sqlalchemy.url': 'postgresql://localhost:5432/test-learning-journal',
+        'server.threads': '6',
+        'sqlalchemy.max_overflow': '2',
+        'sqlalchemy.pool_pre_ping': 'false',
+    })
+    assert engine.pool.size() == 6
+    assert engine.pool.metrics.snapshot()['checked_out'] == 0
+
+
+def test_pool_status_view_reports_pool_metrics(dummy_req):
+    """Test the pool status view returns checkout counters."""
+    from learning_journal.views.status import pool_status_view
+    dummy_req.dbsession.query(Entry).count()
+    response = pool_status_view(dummy_req)
+    assert response['checkouts'] >= 1
+    assert 'wait_seconds_total' in response
+
+
+def test_pool_metrics_text_types_counters_and_gauges():
+    """Test running totals are counters ending in _total, levels gauges."""
+    from learning_journal.instrumentation import pool_metrics_text
+    text = pool_metrics_text({
+        'size': 5, 'checked_out': 1, 'overflow': None, 'connects': 2,
+        'checkouts': 9, 'waits': 1, 'wait_seconds_total': 0.5,
+        'wait_seconds_max': 0.5,
+    })
+    assert '# TYPE journal_db_pool_checkouts_total counter' in text
+    assert 'journal_db_pool_checkouts_total 9' in text
+    assert '# TYPE journal_db_pool_wait_seconds_total counter' in text
+    assert '# TYPE journal_db_pool_checked_out gauge' in text
+    assert '# TYPE journal_db_pool_wait_seconds_max gauge' in text
+    assert 'overflow' not in text
+
+
+def test_status_views_need_the_author():
+    """Test anonymous requests for metrics and pool state are refused."""
+    from pyramid.config import Configurator
+    from webtest import TestApp
+    config = Configurator()
+    config.include('learning_journal.security')
+    config.include('learning_journal.routes')
+    config.include('learning_journal.views')
+    app = TestApp(config.make_wsgi_app())
+    app.get('/metrics', status=403)
+    app.get('/status/pool', status=403)
+
+
+# Instrumentation
+# ===============
+
+
+def test_metrics_registry_renders_prometheus_histograms():
+    """Test histograms render cumulative buckets, sum and count."""
+    from learning_journal.instrumentation import MetricsRegistry
+    metrics = MetricsRegistry()
+    metrics.histogram('latency_seconds', 'Latency.', buckets=(0.1, 1.0))
+    metrics.observe('latency_seconds', 0.05, route='home')
+    metrics.observe('latency_seconds', 0.5, route='home')
+    text = metrics.render()
+    assert '# TYPE latency_seconds histogram' in text
+    assert 'latency_seconds_bucket{route="home",le="0.1"} 1' in text
+    assert 'latency_seconds_bucket{route="home",le="1.0"} 2' in text
+    assert 'latency_seconds_count{route="home"} 2' in text
+
+
+def test_timing_tween_counts_requests_and_sql_queries():
+    """Test the tween records each request and the queries it ran."""
+    from sqlalchemy import create_engine, text
+    from pyramid.response import Response
+    from learning_journal import instrumentation
+    engine = create_engine('sqlite://')
+    engine.connect().close()
+    instrumentation.instrument_engine(engine)
+
+    class Registry(dict):
+        settings = {}
+
+    registry = Registry(metrics=instrumentation.create_metrics())
+
+    def handler(request):
+        with engine.connect() as conn:
+            conn.execute(text('SELECT 1'))
+            conn.execute(text('SELECT 2'))
+        return Response('ok')
+
+    tween = instrumentation.timing_tween_factory(handler, registry)
+    request = testing.DummyRequest()
+    request.matched_route = None
+    tween(request)
+    metrics = registry['metrics'].render()
+    assert (
+        'journal_requests_total{method="GET",route="none",status="200"} 1'
+    ) in metrics
+    assert 'journal_request_sql_queries_sum{route="none"} 2' in metrics
+
+
+def test_timing_tween_counts_queries_run_while_streaming():
+    """Test a streamed body's queries are recorded when it is closed."""
+    import threading
+    from sqlalchemy import create_engine, text
+    from pyramid.response import Response
+    from learning_journal import instrumentation
+    engine = create_engine('sqlite://')
+    engine.connect().close()
+    instrumentation.instrument_engine(engine)
+
+    class Registry(dict):
+        settings = {}
+
+    registry = Registry(metrics=instrumentation.create_metrics())
+
+    def body():
+        with engine.connect() as conn:
+            for number in range(3):
+                yield str(conn.execute(text(
+                    'SELECT {}'.format(number))).scalar()).encode()
+
+    def handler(request):
+        response = Response()
+        response.app_iter = body()
+        return response
+
+    tween = instrumentation.timing_tween_factory(handler, registry)
+    request = testing.DummyRequest()
+    request.matched_route = None
+    response = tween(request)
+    assert 'journal_requests_total{' not in registry['metrics'].render()
+    chunks = []
+    reader = threading.Thread(
+        target=lambda: chunks.extend(response.app_iter))
+    reader.start()
+    reader.join()
+    response.app_iter.close()
+    assert chunks == [b'0', b'1', b'2']
+    metrics = registry['metrics'].render()
+    assert 'journal_request_sql_queries_sum{route="none"} 3' in metrics
+
+
+# Login rate limiting and verification
+# ====================================
+
+
+def test_rate_limiter_blocks_after_limit_within_window():
+    """Test a key is blocked once it reaches the limit."""
+    from learning_journal.security import RateLimiter
+    limiter = RateLimiter(limit=2, window=60)
+    limiter.hit('ip')
+    assert limiter.retry_after('ip') == 0
+    limiter.hit('ip')
+    assert 0 < limiter.retry_after('ip') <= 61
+    assert limiter.retry_after('other') == 0
+
+
+def test_rate_limiter_attempt_checks_and_records_together():
+    """Test attempt records only while under the limit, and forgive undoes."""
+    from learning_journal.security import RateLimiter
+    limiter = RateLimiter(limit=2, window=60)
+    assert limiter.attempt('ip') == 0
+    assert limiter.attempt('ip') == 0
+    assert limiter.attempt('ip') > 0
+    limiter.forgive('ip')
+    assert limiter.attempt('ip') == 0
+
+
+def test_rate_limiter_bounds_the_keys_it_tracks():
+    """Test the least recently seen keys are dropped past max_keys."""
+    from learning_journal.security import RateLimiter
+    limiter = RateLimiter(limit=1, window=60, max_keys=2)
+    limiter.hit('a')
+    limiter.hit('b')
+    limiter.hit('a')
+    limiter.hit('c')
+    assert list(limiter._events) == ['a', 'c']
+
+
+def test_rate_limiter_sweeps_expired_keys():
+    """Test keys with only expired events are purged once per window."""
+    from learning_journal.security import RateLimiter
+    limiter = RateLimiter(limit=1, window=60)
+    limiter.hit('old')
+    limiter._events['old'][0] -= 120
+    limiter._swept -= 120
+    limiter.hit('new')
+    assert list(limiter._events) == ['new']
+
+
+def test_client_ip_reads_forwarded_for_behind_trusted_proxies(dummy_req):
+    """Test only the entry added by the trusted proxy is believed."""
+    from learning_journal.security import client_ip
+    dummy_req.client_addr = '10.0.0.1'
+    dummy_req.headers['X-Forwarded-For'] = '1.2.3.4, 203.0.113.9'
+    assert client_ip(dummy_req) == '10.0.0.1'
+    assert client_ip(dummy_req, 1) == '203.0.113.9'
+    assert client_ip(dummy_req, 3) == '10.0.0.1'
+
+
+def test_login_verifier_checks_username_and_password():
+    """Test the verifier approves only the author's credentials."""
+    from passlib.apps import custom_app_context
+    from learning_journal.security import LoginVerifier
+    verifier = LoginVerifier('mike', custom_app_context.hash('secret'))
+    assert verifier.verify('mike', 'secret')
+    assert not verifier.verify('mike', 'wrong')
+    assert not verifier.verify('someone', 'secret')
+
+
+def test_login_verifier_raises_login_busy_when_full():
+    """Test checks beyond max_pending are turned away immediately."""
+    from learning_journal.security import LoginBusy, LoginVerifier
+    verifier = LoginVerifier('mike', '', max_pending=1)
+    verifier._slots.acquire()
+    with pytest.raises(LoginBusy):
+        verifier.verify('mike', 'secret')
+
+
+def test_login_view_returns_too_many_requests_after_failures(dummy_req):
+    """Test repeated failed logins from one address get a 429."""
+    from learning_journal.security import LoginVerifier, RateLimiter
+    from learning_journal.views.default import login
+    from pyramid.httpexceptions import HTTPTooManyRequests
+    dummy_req.registry['login_verifier'] = LoginVerifier('mike', '')
+    dummy_req.registry['login_limiters'] = {
+        'ip': RateLimiter(2, 60), 'username': RateLimiter(2, 60),
+    }
+    try:
+        dummy_req.method = 'POST'
+        dummy_req.client_addr = '10.0.0.1'
+        dummy_req.POST = {'username': 'mike', 'password': 'wrong'}
+        assert 'error' in login(dummy_req)
+        assert 'error' in login(dummy_req)
+        with pytest.raises(HTTPTooManyRequests):
+            login(dummy_req)
+    finally:
+        del dummy_req.registry['login_verifier']
+        del dummy_req.registry['login_limiters']
@@ -0,0 +1,50 @@
+from learning_journal.cache import cache_page
+from learning_journal.views import api, default, notfound, status
+
+
+def includeme(config):
+    """Register the views.
+
+    They are added one by one instead of found by ``config.scan``, which
+    walks every module of the package for decorated callables on each
+    start.
+    """
+    add = config.add_view
+    add(default.list_view, route_name='home',
+        renderer='learning_journal:templates/list.jinja2',
+        decorator=cache_page('entries'))
+    add(default.month_view, route_name='archive_month',
+        renderer='learning_journal:templates/month.jinja2',
+        decorator=cache_page('entries'))
+    add(default.detail_view, route_name='detail',
+        renderer='learning_journal:templates/detail.jinja2',
+        decorator=cache_page('entry:{id}'))
+    add(default.archive_view, route_name='archive')
+    add(default.search_view, route_name='search',
+        renderer='learning_journal:templates/search.jinja2')
+    add(default.create_view, route_name='create',
+        renderer='learning_journal:templates/create.jinja2',
+        permission='secret')
+    add(default.update_view, route_name='update',
+        renderer='learning_journal:templates/edit.jinja2',
+        permission='secret')
+    add(default.history_view, route_name='history',
+        renderer='learning_journal:templates/history.jinja2',
+        permission='secret')
+    add(default.login, route_name='login',
+        renderer='learning_journal:templates/login.jinja2')
+    add(default.logout, route_name='logout')
+
+    add(api.api_entries_view, route_name='api_entries')
+    add(api.api_entry_view, route_name='api_entry')
+    add(api.api_batch_view, route_name='api_batch', request_method='POST',
+        permission='secret')
+    add(api.feed_view, route_name='feed')
+
+    add(status.pool_status_view, route_name='pool_status', renderer='json',
+        permission='secret')
+    add(status.metrics_view, route_name='metrics', permission='secret')
+
+    config.add_notfound_view(
+        notfound.notfound_view,
+        renderer='learning_journal:templates/404.jinja2')
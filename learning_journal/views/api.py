@@ -0,0 +1,150 @@
+"""The Atom feed and the JSON API for feed readers and scripts."""
+
+
+from datetime import datetime
+
+from pyramid.httpexceptions import HTTPBadRequest, HTTPNotFound
+from learning_journal.models import Entry
+from learning_journal.batch import (
+    BatchError,
+    apply_batch,
+    get_max_items,
+    parse_items,
+)
+from learning_journal.conditional import make_etag, not_modified
+from learning_journal.pagination import get_page_size, keyset_page
+from learning_journal.serialization import (
+    DEFAULT_FEED_TITLE,
+    atom_feed,
+    dumps,
+    entry_atom,
+    entry_json,
+    fragments,
+)
+
+MAX_LIMIT = 100
+
+
+def versions(request):
+    """The query for the columns pages and validators are built from."""
+    return request.dbsession.query(
+        Entry.id, Entry.creation_date, Entry.updated_at)
+
+
+def get_limit(request):
+    """``?limit=``, capped at ``MAX_LIMIT``, or the listing page size."""
+    try:
+        limit = int(request.GET.get('limit', get_page_size(request)))
+    except ValueError:
+        raise HTTPBadRequest
+    if limit < 1:
+        raise HTTPBadRequest
+    return min(limit, MAX_LIMIT)
+
+
+def send(request, body, content_type):
+    response = request.response
+    response.content_type = content_type
+    response.body = body
+    return response
+
+
+def api_entries_view(request):
+    """A page of entries as JSON, newest first, with links to the others."""
+    try:
+        page = keyset_page(
+            versions(request),
+            before=request.GET.get('before'),
+            after=request.GET.get('after'),
+            per_page=get_limit(request),
+        )
+    except ValueError:
+        raise HTTPBadRequest
+    rows = page.items
+    response = not_modified(
+        request,
+        make_etag('api_entries', sorted(request.GET.items()),
+                  [(row.id, row.updated_at) for row in rows]),
+        max(row.updated_at for row in rows) if rows else None,
+    )
+    if response is not None:
+        return response
+    limit = {'limit': request.GET['limit']} if 'limit' in request.GET else {}
+    links = {
+        'older': request.route_url('api_entries', _query=dict(
+            limit, before=page.older)) if page.older else None,
+        'newer': request.route_url('api_entries', _query=dict(
+            limit, after=page.newer)) if page.newer else None,
+    }
+    return send(request, b''.join([
+        b'{"entries":[',
+        b','.join(fragments(request, rows, entry_json)),
+        b'],"links":',
+        dumps(links),
+        b'}',
+    ]), 'application/json')
+
+
+def api_entry_view(request):
+    """One entry as JSON."""
+    row = versions(request).filter(
+        Entry.id == int(request.matchdict['id'])).first()
+    if row is None:
+        raise HTTPNotFound
+    response = not_modified(
+        request, make_etag('api_entry', row.id, row.updated_at),
+        row.updated_at)
+    if response is not None:
+        return response
+    return send(request, fragments(request, [row], entry_json)[0],
+                'application/json')
+
+
+def api_batch_view(request):
+    """Create and update a JSON array of entries in one transaction.
+
+    Only ``application/json`` bodies are read: a cross-site form can post
+    the author's cookie with a text/plain body, but not with that type.
+    """
+    if request.content_type != 'application/json':
+        request.response.status = 415
+        return send(request, dumps({'errors': [{
+            'index': None, 'error': 'expected application/json'}]}),
+            'application/json')
+    try:
+        data = request.json_body
+    except ValueError:
+        data = None
+    try:
+        results = apply_batch(request, parse_items(
+            data, get_max_items(request.registry.settings)))
+    except BatchError as error:
+        request.response.status = 400
+        return send(request, dumps({'errors': error.errors}),
+                    'application/json')
+    return send(request, dumps({'results': [{
+        'id': entry_id,
+        'result': 'created' if created else 'updated',
+        'url': request.route_url('api_entry', id=entry_id),
+    } for entry_id, created in results]}), 'application/json')
+
+
+def feed_view(request):
+    """The newest entries as an Atom feed."""
+    rows = keyset_page(
+        versions(request), per_page=get_page_size(request)).items
+    updated = max(row.updated_at for row in rows) if rows else datetime.now()
+    response = not_modified(
+        request,
+        make_etag('feed', request.host_url,
+                  [(row.id, row.updated_at) for row in rows]),
+        updated,
+    )
+    if response is not None:
+        return response
+    settings = request.registry.settings or {}
+    title = settings.get('feed.title', DEFAULT_FEED_TITLE)
+    return send(request, atom_feed(
+        request, title, settings.get('feed.author', title), updated,
+        fragments(request, rows, entry_atom),
+    ), 'application/atom+xml')
@@ -1,42 +1,179 @@
 """Set up the default functions for the various views in my app."""
 
 
-from pyramid.view import view_config
-from pyramid.httpexceptions import HTTPNotFound, HTTPFound, HTTPBadRequest
-from learning_journal.models import Entry
+from pyramid.httpexceptions import (
+    HTTPBadRequest,
+    HTTPFound,
+    HTTPNotFound,
+    HTTPServiceUnavailable,
+    HTTPTooManyRequests,
+)
+from learning_journal.models import Entry, EntryRevision, EntrySummary
+from learning_journal.models.mymodel import DATE_FORMAT
 from pyramid.security import remember, forget
-from learning_journal.security import is_authenticated
+from learning_journal.security import LoginBusy, client_ip
+from learning_journal.pagination import get_page_size, keyset_page
+from learning_journal.cache import invalidate_after_commit
+from learning_journal.conditional import make_etag, not_modified
+from learning_journal.search import index_after_commit, search_entries
+from learning_journal.templating import stream_template
+from learning_journal.links import entry_links, refresh_links
+from learning_journal.months import (
+    add_month_counts,
+    month_bounds,
+    month_count,
+    month_links,
+)
+from learning_journal.revisions import (
+    reconstruct,
+    record_revision,
+    revision_bodies,
+)
+from datetime import datetime
+from sqlalchemy import func
+import difflib
 
 
-@view_config(route_name='home', renderer='learning_journal:templates/list.jinja2')
 def list_view(request):
-    """List of journal entries."""
-    entries = request.dbsession.query(Entry).all()
-    entries = sorted(entries, key=lambda e: e.creation_date, reverse=True)
-    entries = [entry.to_dict() for entry in entries]
+    """List of journal entries, one page at a time, newest first."""
+    return summary_page(request, EntrySummary.query(request.dbsession),
+                        'home')
+
+
+def month_view(request):
+    """Entries written in one month, one page at a time, newest first."""
+    year = int(request.matchdict['year'])
+    month = int(request.matchdict['month'])
+    if not (1 <= year <= 9999 and 1 <= month <= 12):
+        raise HTTPNotFound
+    total = month_count(request.dbsession, year, month)
+    if not total:
+        raise HTTPNotFound
+    start, end = month_bounds(year, month)
+    # A range on creation_date, served by ix_entries_creation_date_id.
+    query = EntrySummary.query(request.dbsession).filter(
+        Entry.creation_date >= start, Entry.creation_date < end)
+    result = summary_page(request, query, 'month', year, month)
+    if isinstance(result, dict):
+        result.update(year=year, month=month, total=total,
+                      label=start.strftime('%B %Y'))
+    return result
+
+
+def summary_page(request, query, name, *etag_parts):
+    """One page of entry summaries and the month sidebar, or a 304."""
+    try:
+        page = keyset_page(
+            query,
+            before=request.GET.get('before'),
+            after=request.GET.get('after'),
+            per_page=get_page_size(request),
+        )
+    except ValueError:
+        raise HTTPBadRequest
+    entries = [EntrySummary(*row) for row in page.items]
+    months = month_links(request.dbsession)
+    # The sidebar counts every entry, so any write anywhere in the
+    # journal changes the page; ix_entries_updated_at makes this cheap.
+    latest = request.dbsession.query(func.max(Entry.updated_at)).scalar()
+    response = not_modified(
+        request,
+        make_etag(
+            name, etag_parts, sorted(request.GET.items()),
+            request.authenticated_userid, latest,
+            [(entry.id, entry.updated_at) for entry in entries],
+            [(link.year, link.month, link.count) for link in months],
+        ),
+        latest,
+    )
+    if response is not None:
+        return response
     return {
-        "entries": entries
+        "entries": entries,
+        "page": page,
+        "months": months,
     }
 
 
-@view_config(route_name='detail', renderer='learning_journal:templates/detail.jinja2')
 def detail_view(request):
     """A single journal entry."""
     entry_id = int(request.matchdict['id'])
-    entry = request.dbsession.query(Entry).get(entry_id)
-    if entry is None:
+    version = request.dbsession.query(Entry.updated_at).filter(
+        Entry.id == entry_id
+    ).first()
+    if version is None:
         raise HTTPNotFound
-    else:
-        return {
-            "entry": entry
-        }
+    links = entry_links(request.dbsession, entry_id)
+    response = not_modified(
+        request,
+        make_etag('detail', entry_id, version.updated_at,
+                  request.authenticated_userid, links),
+        version.updated_at,
+    )
+    if response is not None:
+        return response
+    entry = request.dbsession.query(Entry).get(entry_id)
+    return {
+        "entry": entry,
+        "links": links,
+    }
+
+
+def archive_view(request):
+    """Every entry, newest first, sent while the page is still rendering.
+
+    Memory use and time to the first byte stay the same however many
+    entries there are.
+    """
+    total, latest = request.dbsession.query(
+        func.count(Entry.id), func.max(Entry.updated_at)).one()
+    response = not_modified(
+        request,
+        make_etag('archive', total, latest, request.authenticated_userid),
+        latest,
+    )
+    if response is not None:
+        return response
+    engine = request.dbsession.get_bind()
+
+    def body():
+        entries = EntrySummary.stream(engine)
+        try:
+            for chunk in stream_template(
+                    request, 'learning_journal:templates/archive.jinja2',
+                    {'entries': entries, 'total': total}):
+                yield chunk
+        finally:
+            entries.close()
+    response = request.response
+    response.app_iter = body()
+    return response
+
+
+def search_view(request):
+    """Entries matching a full-text query, best match first."""
+    query = request.GET.get('q', '').strip()
+    try:
+        page_number = int(request.GET.get('page', 1))
+    except ValueError:
+        raise HTTPBadRequest
+    if page_number < 1:
+        raise HTTPBadRequest
+    per_page = get_page_size(request)
+    total, entries = 0, []
+    if query:
+        total, entries = search_entries(
+            request, query, per_page, (page_number - 1) * per_page
+        )
+    return {
+        "query": query,
+        "entries": entries,
+        "total": total,
+        "page_number": page_number,
+        "has_next": page_number * per_page < total,
+    }
 
 
-@view_config(
-    route_name='create',
-    renderer='learning_journal:templates/create.jinja2',
-    permission='secret'
-)
 def create_view(request):
     """Create a new entry."""
     if request.method == "GET":
@@ -50,18 +187,27 @@ def create_view(request):
             body=request.POST['body'],
         )
         request.dbsession.add(new_entry)
+        request.dbsession.flush()
+        add_month_counts(request.dbsession.connection(),
+                         [new_entry.creation_date])
+        record_revision(request, new_entry)
+        refresh_links(request, [
+            (new_entry.id, new_entry.creation_date, new_entry.body)
+        ], created=True)
+        invalidate_after_commit(request, 'entries')
+        index_after_commit(request, new_entry)
         return HTTPFound(request.route_url('home'))
 
 
-@view_config(
-    route_name='update',
-    renderer='learning_journal:templates/edit.jinja2',
-    permission='secret'
-)
 def update_view(request):
     """Update an existing entry."""
     entry_id = int(request.matchdict['id'])
-    entry = request.dbsession.query(Entry).get(entry_id)
+    query = request.dbsession.query(Entry).filter(Entry.id == entry_id)
+    if request.method == "POST":
+        # Concurrent edits wait for each other, so each one's revision is
+        # numbered and diffed against the edit committed before it.
+        query = query.with_for_update()
+    entry = query.first()
     if not entry:
         raise HTTPNotFound
     if request.method == "GET":
@@ -70,17 +216,70 @@ def update_view(request):
             'entry': entry.to_dict()
         }
     if request.method == "POST":
+        previous = (entry.title, entry.body, entry.updated_at)
         entry.title = request.POST['title']
         entry.body = request.POST['body']
+        entry.updated_at = datetime.now()
+        entry.refresh_derived()
         request.dbsession.add(entry)
         request.dbsession.flush()
+        record_revision(request, entry, previous)
+        refresh_links(request, [(entry.id, entry.creation_date, entry.body)])
+        invalidate_after_commit(request, 'entries', 'entry:{}'.format(entry.id))
+        index_after_commit(request, entry)
         return HTTPFound(request.route_url('detail', id=entry.id))
 
 
-@view_config(
-    route_name='login',
-    renderer='learning_journal:templates/login.jinja2',
-)
+def history_view(request):
+    """Every saved version of an entry, and what one of them changed."""
+    entry_id = int(request.matchdict['id'])
+    entry = request.dbsession.query(Entry.id, Entry.title).filter(
+        Entry.id == entry_id).first()
+    if entry is None:
+        raise HTTPNotFound
+    revisions = request.dbsession.query(
+        EntryRevision.number, EntryRevision.title, EntryRevision.created_at,
+    ).filter(
+        EntryRevision.entry_id == entry_id
+    ).order_by(EntryRevision.number.desc()).all()
+    result = {
+        'entry': entry,
+        'revisions': [{
+            'number': number,
+            'title': title,
+            'date': created_at.strftime(DATE_FORMAT) if created_at else '',
+        } for number, title, created_at in revisions],
+        'selected': None,
+    }
+    if 'revision' not in request.GET:
+        return result
+    try:
+        number = int(request.GET['revision'])
+    except ValueError:
+        raise HTTPBadRequest
+    bodies = dict(
+        (revision.number, (revision, body))
+        for revision, body in revision_bodies(
+            request.dbsession, entry_id, number)
+    )
+    if number not in bodies:
+        raise HTTPNotFound
+    revision, body = bodies[number]
+    previous = bodies.get(number - 1) or reconstruct(
+        request.dbsession, entry_id, number - 1)
+    previous_body = previous[1] if previous else u''
+    result['selected'] = {
+        'number': number,
+        'title': revision.title,
+        'body': body,
+        'diff': list(difflib.unified_diff(
+            previous_body.splitlines(), body.splitlines(),
+            'revision {}'.format(number - 1), 'revision {}'.format(number),
+            lineterm='')),
+    }
+    return result
+
+
 def login(request):
     """Establish login post method."""
     if request.authenticated_userid:
@@ -92,7 +291,26 @@ def login(request):
     if request.method == "POST":
         username = request.POST['username']
         password = request.POST['password']
-        if is_authenticated(username, password):
+        limiters = request.registry['login_limiters']
+        address = client_ip(
+            request, request.registry.get('login_trusted_proxies', 0))
+        # Each attempt counts as a failure until it is known not to be.
+        recorded = []
+        for kind, key in (('ip', address), ('username', username)):
+            retry_after = limiters[kind].attempt(key)
+            if retry_after:
+                forgive(limiters, recorded)
+                raise HTTPTooManyRequests(
+                    headers={'Retry-After': str(retry_after)})
+            recorded.append((kind, key))
+        try:
+            approved = request.registry['login_verifier'].verify(
+                username, password)
+        except LoginBusy:
+            forgive(limiters, recorded)
+            raise HTTPServiceUnavailable(headers={'Retry-After': '1'})
+        if approved:
+            forgive(limiters, recorded)
             headers = remember(request, username)
             return HTTPFound(request.route_url('home'), headers=headers)
 
@@ -101,7 +319,11 @@ def login(request):
         }
 
 
-@view_config(route_name='logout')
+def forgive(limiters, recorded):
+    for kind, key in recorded:
+        limiters[kind].forgive(key)
+
+
 def logout(request):
     """Logout and send user to homepage."""
     headers = forget(request)
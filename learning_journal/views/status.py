@@ -0,0 +1,21 @@
+"""Views reporting on the health of the running app.
+
+They show traffic and database load, so only the author may see them.
+"""
+
+
+from pyramid.response import Response
+from learning_journal.instrumentation import pool_metrics_text
+
+
+def pool_status_view(request):
+    """The database connection pool's state and counters."""
+    return request.registry['pool_metrics'].snapshot()
+
+
+def metrics_view(request):
+    """Every collected metric in Prometheus' text format."""
+    metrics = request.registry.get('metrics')
+    text = metrics.render() if metrics is not None else ''
+    text += pool_metrics_text(request.registry['pool_metrics'].snapshot())
+    return Response(text, content_type='text/plain', charset='utf-8')
@@ -1,10 +1,29 @@
 import os
+import sys
 
 from paste.deploy import loadapp
 from waitress import serve
 
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 5000))
+    mode = os.environ.get("SERVER_MODE", "waitress")
+
+    # SERVER_MODE=prefork forks $WEB_CONCURRENCY (or one per CPU) waitress
+    # workers from a master that loads and warms the app once.
+    if mode == "prefork":
+        from learning_journal.prefork import serve as serve_prefork
+        serve_prefork(
+            lambda: loadapp('config:production.ini', relative_to='.'),
+            host='0.0.0.0', port=port)
+        sys.exit()
+
     app = loadapp('config:production.ini', relative_to='.')
+    threads = int(app.registry.settings['server.threads'])
 
-    serve(app, host='0.0.0.0', port=port)
+    # SERVER_MODE=asgi runs the app on a bounded pool behind uvicorn's
+    # event loop instead of waitress (needs the 'asgi' extra).
+    if mode == "asgi":
+        from learning_journal.asgi import serve as serve_asgi
+        serve_asgi(app, host='0.0.0.0', port=port, workers=threads)
+    else:
+        serve(app, host='0.0.0.0', port=port, threads=threads)
@@ -9,7 +9,6 @@ with open(os.path.join(here, 'CHANGES.txt')) as f:
     CHANGES = f.read()
 
 requires = [
-    'faker',
     'passlib',
     'plaster_pastedeploy',
     'psycopg2',
@@ -18,13 +17,15 @@ requires = [
     'pyramid_jinja2',
     'pyramid_retry',
     'pyramid_tm',
-    'SQLAlchemy',
+    # 1.4 for pool_pre_ping, stream_results and bulk return_defaults.
+    'SQLAlchemy >= 1.4, < 2.0',
     'transaction',
-    'zope.sqlalchemy',
+    'zope.sqlalchemy >= 1.2',
     'waitress',
 ]
 
 tests_require = [
+    'faker',
     'WebTest >= 1.3.1',  # py3 compat
     'pytest',
     'pytest-cov',
@@ -37,6 +38,7 @@ setup(
     long_description=README + '\n\n' + CHANGES,
     classifiers=[
         'Programming Language :: Python',
+        'Programming Language :: Python :: 3',
         'Framework :: Pyramid',
         'Topic :: Internet :: WWW/HTTP',
         'Topic :: Internet :: WWW/HTTP :: WSGI :: Application',
@@ -50,7 +52,12 @@ setup(
     zip_safe=False,
     extras_require={
         'testing': tests_require,
+        'assets': ['brotli'],
+        'asgi': ['uvicorn'],
+        'api': ['orjson'],
     },
+    # async def in asgi.py, asyncio.run in the tests.
+    python_requires='>= 3.7',
     install_requires=requires,
     entry_points={
         'paste.app_factory': [
@@ -58,6 +65,11 @@ setup(
         ],
         'console_scripts': [
             'initdb2 = learning_journal.scripts.initializedb:main',
+            'transferdb2 = learning_journal.scripts.transfer:main',
+            'backfilldb2 = learning_journal.scripts.backfill:main',
+            'linkdb2 = learning_journal.scripts.links:main',
+            'precompile2 = learning_journal.scripts.precompile:main',
+            'buildassets2 = learning_journal.scripts.assets:main',
         ],
     },
 )